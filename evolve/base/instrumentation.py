@@ -0,0 +1,230 @@
+"""
+Lightweight per-view instrumentation.
+
+InstrumentationMiddleware records, for the views listed in the
+INSTRUMENTED_VIEWS setting (dotted paths), the number of queries, the time
+spent in the database, the time rendering templates and the total time of
+each request. The last INSTRUMENTATION_WINDOW requests of every view are
+kept in memory, and summarized as percentiles and histograms by summary().
+
+Other views only pay a dictionary lookup. Queries are timed by wrapping the
+cursors of the connections while an instrumented view runs, without the
+SQL formatting done by debug cursors. Samples are kept per process.
+
+ProfilingMiddleware turns on evolve.rules.profiling for single requests.
+"""
+import collections
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.utils import simplejson
+from django.utils.importlib import import_module
+
+from evolve.rules import profiling
+
+DEFAULT_WINDOW = 1000
+
+METRICS = ('queries', 'db_ms', 'template_ms', 'total_ms')
+
+# Upper bounds of the histogram buckets for each metric (the last bucket
+# has everything above)
+BUCKETS = {
+    'queries': (1, 2, 5, 10, 20, 50, 100),
+    'db_ms': (1, 5, 10, 25, 50, 100, 250),
+    'template_ms': (1, 5, 10, 25, 50, 100, 250),
+    'total_ms': (10, 25, 50, 100, 250, 500, 1000),
+}
+
+
+class Window(object):
+    """The last samples recorded for a view, as tuples of METRICS"""
+
+    def __init__(self, size):
+        self.samples = collections.deque(maxlen=size)
+        self.count = 0
+
+    def add(self, sample):
+        self.samples.append(sample)
+        self.count += 1
+
+    def summary(self):
+        """Percentiles and histogram of each metric, over the window"""
+        samples = list(self.samples)
+        result = {'count': self.count, 'window': len(samples)}
+        for i, metric in enumerate(METRICS):
+            values = sorted(s[i] for s in samples)
+            result[metric] = summarize(values, BUCKETS[metric])
+        return result
+
+def percentile(values, percent):
+    """Nearest rank percentile of sorted values"""
+    rank = -(-len(values) * percent // 100) # Rounded up
+    return values[max(rank-1, 0)]
+
+def summarize(values, buckets):
+    """Summary of a sorted list of values, with a histogram over buckets"""
+    if not values:
+        return None
+    histogram = [0] * (len(buckets)+1)
+    for v in values:
+        for i, bound in enumerate(buckets):
+            if v <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[-1] += 1
+    return {
+        'mean': float(sum(values)) / len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': values[-1],
+        'buckets': list(buckets),
+        'histogram': histogram,
+    }
+
+
+_windows = {}
+
+def record(view, queries, db_time, template_time, total_time):
+    """Add a sample for view; times in seconds"""
+    window = _windows.get(view)
+    if window is None:
+        window = _windows.setdefault(view, Window(getattr(settings, 'INSTRUMENTATION_WINDOW', DEFAULT_WINDOW)))
+    window.add((queries, db_time*1000, template_time*1000, total_time*1000))
+
+def summary():
+    """Summary of the recorded samples, by view name"""
+    return dict((view, window.summary()) for view, window in _windows.items())
+
+def reset():
+    """Forget every sample"""
+    _windows.clear()
+
+
+class TimingCursor(object):
+    """Cursor wrapper adding the queries it runs to a Sample"""
+
+    def __init__(self, cursor, sample):
+        self.cursor = cursor
+        self.sample = sample
+
+    def execute(self, *args):
+        start = time.time()
+        try:
+            return self.cursor.execute(*args)
+        finally:
+            self.sample.add_query(time.time() - start)
+
+    def executemany(self, *args):
+        start = time.time()
+        try:
+            return self.cursor.executemany(*args)
+        finally:
+            self.sample.add_query(time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class Sample(object):
+    """Measurements of one request to an instrumented view"""
+
+    def __init__(self, view, start):
+        self.view = view
+        self.start = start
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_start = None
+        self.template_time = 0.0
+        self.connections = []
+
+    def add_query(self, duration):
+        self.queries += 1
+        self.db_time += duration
+
+    def install(self):
+        """Time the queries of every connection (of this thread)"""
+        for connection in connections.all():
+            cursor = connection.cursor
+            connection.cursor = lambda cursor=cursor: TimingCursor(cursor(), self)
+            self.connections.append(connection)
+
+    def uninstall(self):
+        for connection in self.connections:
+            del connection.cursor
+        self.connections = []
+
+    def rendering(self, response):
+        """Time the rendering of a TemplateResponse"""
+        self.template_start = time.time()
+        response.add_post_render_callback(self.rendered)
+
+    def rendered(self, response):
+        self.template_time = time.time() - self.template_start
+
+    def finish(self):
+        self.uninstall()
+        record(self.view, self.queries, self.db_time, self.template_time, time.time() - self.start)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records the samples of the views in INSTRUMENTED_VIEWS. Should be the
+    first middleware, so its time includes the others
+    """
+
+    def __init__(self):
+        self.views = {}
+        for path in getattr(settings, 'INSTRUMENTED_VIEWS', ()):
+            module, name = path.rsplit('.', 1)
+            self.views[getattr(import_module(module), name)] = name
+
+    def process_request(self, request):
+        request._instrumentation_start = time.time()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        name = self.views.get(view_func)
+        if name is not None:
+            start = getattr(request, '_instrumentation_start', time.time())
+            request._instrumentation = Sample(name, start)
+            request._instrumentation.install()
+
+    def process_template_response(self, request, response):
+        sample = getattr(request, '_instrumentation', None)
+        if sample is not None:
+            sample.rendering(response)
+        return response
+
+    def process_response(self, request, response):
+        sample = getattr(request, '_instrumentation', None)
+        if sample is not None:
+            sample.finish()
+            del request._instrumentation
+        return response
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles requests from staff users with a "profile" parameter (see
+    evolve.rules.profiling), returning the totals as JSON in the X-Profile
+    header. If the PROFILING_DUMP_DIR setting is set, cProfile stats are
+    also dumped there. Must come after AuthenticationMiddleware
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if 'profile' in request.GET and request.user.is_staff:
+            request._profile = profiling.Profile(getattr(settings, 'PROFILING_DUMP_DIR', None))
+            request._profiling = profiling.active(request._profile)
+            request._profiling.__enter__()
+
+    def process_response(self, request, response):
+        if getattr(request, '_profiling', None) is not None:
+            request._profiling.__exit__(None, None, None)
+            request._profiling = None
+            response['X-Profile'] = simplejson.dumps(request._profile.summary())
+        return response
@@ -1,9 +1,17 @@
+import os
+
+from django.http import HttpResponse
 from django.shortcuts import redirect
+from django.utils import simplejson
+from django.contrib.admin.views.decorators import staff_member_required
 
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import authenticate, login, logout as auth_logout
 from django.views.generic.edit import CreateView
 
+from evolve.base import instrumentation
+from evolve.rules import economy
+
 def home(request):
     if request.user.is_authenticated():
         return redirect('games')
@@ -31,3 +39,12 @@ class RegisterView(CreateView):
 
 register = RegisterView.as_view()
 
+
+@staff_member_required
+def instrumentation_stats(request):
+    """
+    Summary of the samples recorded by InstrumentationMiddleware in this
+    process, and of the payment prechecks (see economy.precheck())
+    """
+    result = {'pid': os.getpid(), 'views': instrumentation.summary(), 'prechecks': dict(economy.prechecks)}
+    return HttpResponse(simplejson.dumps(result), mimetype="application/json")
@@ -0,0 +1,155 @@
+"""
+Public state of a game, for rendering pages.
+
+Everything players can see of a game (seating, money, buildings, specials,
+battle results, discards, scores, age and turn) is kept as a board: a
+compact JSON blob in Game.board, written with the rest of the game at the
+end of every turn (see Game.update_board()). Pages render it through Board,
+which takes names and effects from the rules catalog, so they only need
+the query loading the game. Hands are private, and not part of a board.
+
+A board records the Game.version it was written at. Boards of another
+version (or format), and missing ones, are rebuilt from the game tables
+when read (see Game.public_board()). Games not started change with every
+player joining, so their boards are rebuilt on every read, and not saved.
+"""
+from django.utils import simplejson
+
+from evolve.rules.models import Score
+from evolve.rules import catalog
+
+# Increase when the layout of dump() changes, so older boards are rebuilt
+FORMAT = 1
+
+# Order of building kinds in building_list(), after the city
+KIND_ORDER = ['bas', 'cpx', 'eco', 'civ', 'sci', 'mil', 'per']
+
+
+def dump(game, table, names, battles, scores=None):
+    """
+    Board data for game, with its state in an engine.Table. names maps
+    player primary keys to user names, battles to lists of (age, direction,
+    result), and scores (optional) to the Scores to show instead of the
+    running ones
+    """
+    scores = scores or {}
+    return {
+        'format': FORMAT,
+        'version': game.version,
+        'started': game.started,
+        'finished': game.finished,
+        'age': game.age_id,
+        'turn': game.turn,
+        'discards': sorted(table.discards),
+        'seats': [{
+            'pk': s.pk,
+            'name': names[s.pk],
+            'city': s.city_id,
+            'variant': s.variant_id,
+            'money': s.money,
+            'specials': s.specials_built,
+            'buildings': list(s.buildings),
+            'battles': [list(b) for b in battles.get(s.pk, ())],
+            'score': list(scores.get(s.pk, s.running)),
+        } for s in table.seats],
+    }
+
+def encode(data):
+    return simplejson.dumps(data, separators=(',', ':'))
+
+def decode(blob):
+    """Board data in blob, None if empty or in another format"""
+    if not blob:
+        return None
+    data = simplejson.loads(blob)
+    return data if data.get('format') == FORMAT else None
+
+def is_current(data, game):
+    """True if board data was written at the current version of game, once started"""
+    return data is not None and game.started and data['started'] and data['version'] == game.version
+
+
+class Board(object):
+    """
+    A board ready for templates: age (an AgeRecord), turn, finished,
+    discards (BuildOptionRecords) and seats (BoardSeats in seating order)
+    """
+
+    def __init__(self, data):
+        rules = catalog.get()
+        self.age = rules.ages[data['age']]
+        self.turn = data['turn']
+        self.finished = data['finished']
+        self.discards = [rules.options[pk] for pk in data['discards']]
+        self.seats = [BoardSeat(self, i, s) for i, s in enumerate(data['seats'])]
+
+    def seat(self, pk):
+        """The BoardSeat of player pk"""
+        for s in self.seats:
+            if s.pk == pk:
+                return s
+        raise KeyError(pk)
+
+
+class BattleToken(object):
+    """A battle result on a board, like a BattleResult"""
+
+    def __init__(self, age_id, direction, result):
+        self.age = catalog.get().ages[age_id]
+        self.direction = direction
+        self.result = result
+
+    def score(self):
+        return self.age.victory_score if self.result == 'v' else self.age.defeat_score
+
+
+class BoardSeat(object):
+    """
+    A player on a board, with the attributes templates use from Player:
+    city and variant (catalog records), money, specials (number built),
+    score (a Score) and battles (BattleTokens, by age)
+    """
+
+    def __init__(self, board, index, data):
+        rules = catalog.get()
+        self.board = board
+        self.index = index
+        self.pk = data['pk']
+        self.name = data['name']
+        self.city = rules.cities[data['city']]
+        self.variant = rules.variants[data['variant']]
+        self.money = data['money']
+        self.specials = data['specials']
+        self.building_ids = data['buildings']
+        self.battles = [BattleToken(*b) for b in data['battles']]
+        self.score = Score(*data['score'])
+
+    def left_player(self):
+        return self.board.seats[self.index-1]
+
+    def right_player(self):
+        seats = self.board.seats
+        return seats[(self.index+1) % len(seats)]
+
+    def all_right_players(self):
+        """Same as Player.all_right_players()"""
+        seats = self.board.seats
+        return [seats[(self.index+offset) % len(seats)] for offset in range(1, len(seats)-1)]
+
+    def building_list(self):
+        """Same as Player.building_list()"""
+        rules = catalog.get()
+        resource = self.city.resource
+        result = [dict(kind='bas' if resource.is_basic else 'cpx', label='City', building=None, effect=resource.name)]
+        for pk in self.building_ids:
+            b = rules.buildings[pk]
+            result.append(dict(kind=b.kind, label=b.name, building=b, effect=b.effect))
+        result.sort(key=lambda b: KIND_ORDER.index(b['kind']))
+        return result
+
+    def all_specials(self):
+        """Every special of the city and variant, by order"""
+        return catalog.get().specials_for(self.city.pk, self.variant.pk)
+
+    def __unicode__(self):
+        return self.name
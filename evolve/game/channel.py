@@ -0,0 +1,126 @@
+"""
+Notification of game changes.
+
+Each game has a version counter that is increased whenever its state
+changes (a player joins or plays, the game starts, a turn ends). Clients
+wait for the version they have seen to change instead of polling the
+database, so idle clients cost no queries.
+
+The broker keeping the counters is set by the GAME_CHANNEL_BROKER setting
+(a dotted path to a class); LocalBroker is enough for a single process.
+The last notification of a game (when it finishes) is marked as final, so
+brokers can forget its counter.
+"""
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.importlib import import_module
+
+DEFAULT_BROKER = 'evolve.game.channel.LocalBroker'
+
+
+class LocalBroker(object):
+    """
+    Broker keeping versions in memory, for a single process. Versions of
+    finished games are moved to a record of the last FINISHED_KEPT ones, so
+    memory doesn't grow with every game played
+    """
+    FINISHED_KEPT = 1000
+
+    def __init__(self):
+        self.versions = {}
+        self.finished = collections.OrderedDict()
+        self.condition = threading.Condition()
+
+    def get(self, game_id):
+        return self.versions.get(game_id) or self.finished.get(game_id, 0)
+
+    def version(self, game_id):
+        """Current version of the game"""
+        with self.condition:
+            return self.get(game_id)
+
+    def notify(self, game_id, final=False):
+        """Announce a change in the game; final if it won't change again"""
+        with self.condition:
+            version = self.get(game_id) + 1
+            if final:
+                self.versions.pop(game_id, None)
+                self.finished[game_id] = version
+                while len(self.finished) > self.FINISHED_KEPT:
+                    self.finished.popitem(last=False)
+            else:
+                self.versions[game_id] = version
+            self.condition.notify_all()
+
+    def wait(self, game_id, since, timeout):
+        """
+        Wait until the version of the game is not since, up to timeout
+        seconds. Returns the version at that moment.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.get(game_id) == since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.get(game_id)
+
+
+class CacheBroker(object):
+    """
+    Broker keeping versions in the Django cache, so it can be shared between
+    processes. Waiting checks the cache every POLL_INTERVAL seconds.
+    Versions are kept for VERSION_TIMEOUT seconds (the longest relative
+    timeout memcached takes), instead of the cache default of 5 minutes
+    """
+    POLL_INTERVAL = 0.5
+    VERSION_TIMEOUT = 30 * 24 * 60 * 60
+
+    def key(self, game_id):
+        return 'evolve.game.channel.%d' % game_id
+
+    def version(self, game_id):
+        return cache.get(self.key(game_id), 0)
+
+    def notify(self, game_id, final=False):
+        # Versions expire on their own
+        key = self.key(game_id)
+        cache.add(key, 0, timeout=self.VERSION_TIMEOUT)
+        try:
+            cache.incr(key)
+        except ValueError: # Evicted since add()
+            cache.set(key, 1, timeout=self.VERSION_TIMEOUT)
+
+    def wait(self, game_id, since, timeout):
+        deadline = time.time() + timeout
+        version = self.version(game_id)
+        while version == since and time.time() < deadline:
+            time.sleep(min(self.POLL_INTERVAL, max(0, deadline - time.time())))
+            version = self.version(game_id)
+        return version
+
+
+_broker = None
+
+def get_broker():
+    """The broker configured in settings"""
+    global _broker
+    if _broker is None:
+        path = getattr(settings, 'GAME_CHANNEL_BROKER', DEFAULT_BROKER)
+        module, name = path.rsplit('.', 1)
+        _broker = getattr(import_module(module), name)()
+    return _broker
+
+def version(game_id):
+    return get_broker().version(game_id)
+
+def notify(game_id, final=False):
+    get_broker().notify(game_id, final)
+
+def wait(game_id, since, timeout):
+    return get_broker().wait(game_id, since, timeout)
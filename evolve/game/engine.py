@@ -0,0 +1,776 @@
+"""
+In-memory game engine.
+
+The rules of what players produce, how they pay and what a turn does are
+written here against plain Python objects, so they can run over a whole
+game loaded at once (a Table of Seats) instead of one query per question.
+Player (the model) shares the same rule computations through PlayerRules.
+"""
+import collections
+import random
+
+from evolve.rules.models import Score, TRADEABLE
+from evolve.rules import constants, economy, catalog, science, profiling
+
+BUILD_ACTION= 'build'
+FREE_ACTION = 'free'
+SELL_ACTION = 'sell'
+SPECIAL_ACTION = 'spec'
+
+
+class PlayerRules(object):
+    """
+    Rule computations for a Player-like object. Subclasses need to provide:
+       - building_ids(): primary keys of the buildings built
+       - city_id, variant_id, specials_built and money attributes
+       - left_player(), right_player(): neighbors, also PlayerRules
+    """
+    __slots__ = ()
+
+    def building_records(self):
+        """Catalog records of the buildings built by this player"""
+        rules = catalog.get()
+        return [rules.buildings[pk] for pk in self.building_ids()]
+
+    def effect_ids(self):
+        """
+        Primary keys of the effects which apply to this player. Subclasses
+        keeping their own index must return the same ones, in any order
+        """
+        # City specials
+        effects = [s.effect.pk for s in catalog.get().built_specials(self.city_id, self.variant_id, self.specials_built)]
+        # Building effects
+        effects.extend(b.effect.pk for b in self.building_records())
+        return effects
+
+    def active_effects(self):
+        """The list of effects (catalog records) which apply to this player"""
+        rules = catalog.get()
+        return [rules.effects[pk] for pk in self.effect_ids()]
+
+    def tradeable_vectors(self):
+        """
+        Resources that can be bought by neighbors, as a list of resource
+        vectors (see RulesCatalog.resource_names) of alternative resources;
+        note that not every resource available is tradeable.
+        """
+        # Basic city resource is tradeable
+        result = [catalog.get().cities[self.city_id].production]
+        # Add in production of resources by tradeable kinds of buildings
+        for b in self.building_records():
+            if b.kind in TRADEABLE and b.effect.production:
+                result.append(b.effect.production.vector)
+        return result
+
+    def trade_prices(self, direction):
+        """
+        Unit prices of trading with player in given direction ('l' or 'r'),
+        as a resource vector
+        """
+        assert direction in ('l', 'r')
+        result = list(catalog.get().default_prices)
+        for e in self.active_effects():
+            if (direction=='l' and e.left_trade) or (direction=='r' and e.right_trade):
+                cost = e.trade.money
+                for i, amount in enumerate(e.trade.vector):
+                    # Pick the better value for each resource
+                    if amount and cost < result[i]:
+                        result[i] = cost
+        return tuple(result)
+
+    def local_vectors(self):
+        """
+        Resources produced by every local effect (not counting trade), as a
+        list of resource vectors of alternative resources
+        """
+        # Basic city resource is local production
+        result = [catalog.get().cities[self.city_id].production]
+        # Add in production of resources by tradeable kinds of buildings
+        for e in self.active_effects():
+            if e.production:
+                result.append(e.production.vector)
+        return result
+
+    def tradeable_resources(self):
+        """
+        Same as tradeable_vectors(), as a [[(amount, resource)]]. Inner
+        lists are alternative resources
+        """
+        return production_pairs(self.tradeable_vectors())
+
+    def trade_costs(self, direction):
+        """Same as trade_prices(), as a dict of resource_name -> money"""
+        return price_dict(self.trade_prices(direction))
+
+    def local_production(self):
+        """
+        Same as local_vectors(), as a [[(amount, resource)]]. Inner lists
+        are alternative resources
+        """
+        return production_pairs(self.local_vectors())
+
+    def next_special(self):
+        """
+        Next special to build (a catalog record), None if all built
+        """
+        return catalog.get().next_special(self.city_id, self.variant_id, self.specials_built)
+
+    def count(self, kind):
+        """Number of buildings of a given kind (a BuildingKind or its name)"""
+        kind = getattr(kind, 'pk', kind)
+        return sum(1 for b in self.building_records() if b.kind == kind)
+
+    def count_kinds(self):
+        """Sorted tuple of (kind name, number of buildings) for kinds built"""
+        kinds = collections.defaultdict(int)
+        for b in self.building_records():
+            kinds[b.kind] += 1
+        return tuple(sorted(kinds.items()))
+
+    def specials(self):
+        """Number of specials built"""
+        return self.specials_built
+
+    def military(self):
+        """Military power"""
+        # Just the sum of the military powers of each effect
+        return sum(e.military for e in self.active_effects())
+
+    def science_score(self):
+        """Amount of science points"""
+        rules = catalog.get()
+        masks = [e.science_mask for e in self.active_effects() if e.science_mask]
+        return science.science_score(masks, len(rules.science_names))
+
+    def payment_options(self, item):
+        """
+        List of ways of paying for item.cost. Empty if unpayable
+
+        item is a building or special catalog record
+        """
+        return payment_options(item, self, self.left_player(), self.right_player())
+
+
+def production_pairs(vectors):
+    """Production resource vectors as a [[(amount, resource)]]"""
+    names = catalog.get().resource_names
+    return [economy.vector_pairs(v, names) for v in vectors]
+
+def price_dict(prices):
+    """Trade prices resource vector as a dict of resource_name -> money"""
+    result = collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST)
+    for name, price in zip(catalog.get().resource_names, prices):
+        if price != constants.DEFAULT_TRADE_COST:
+            result[name] = price
+    return result
+
+def payment_options(item, local, left, right):
+    """
+    List of ways for local to pay for item.cost when its neighbors are left
+    and right. Empty if unpayable
+
+    item is a building or special catalog record. local, left and right are
+    PlayerRules or PlayerView objects
+    """
+    shortcut = payment_shortcut(item, local.building_ids())
+    if shortcut is not None:
+        return shortcut
+    return search_payments(item.cost, local, left, right)
+
+def payment_shortcut(item, built):
+    """
+    Payment options for item that don't depend on its cost, given the
+    primary keys of the buildings built. None if a search is needed
+    """
+    if hasattr(item, 'free_having'):
+        built = set(built)
+        # Can't be bought if we already have it
+        if item.pk in built:
+            return []
+        # Check if we have a dependency of this item that makes it free:
+        if item.free_having & built:
+            # You can get it for free. No more options needed
+            return [economy.PaymentOption()]
+
+def payment_arguments(cost, local, left, right):
+    """
+    Arguments for the economy payment functions (vector_payments() and
+    friends) for local to pay for a cost catalog record
+    """
+    return (
+        catalog.get().resource_names,
+        cost.vector,
+        cost.money,
+        local.money,
+        local.local_vectors(),
+        left.tradeable_vectors(),
+        local.trade_prices('l'),
+        right.tradeable_vectors(),
+        local.trade_prices('r'),
+    )
+
+def search_payments(cost, local, left, right):
+    """Ways for local to pay for a cost catalog record"""
+    return economy.vector_payments(*payment_arguments(cost, local, left, right))
+
+def is_affordable(item, local, left, right):
+    """True if payment_options() is not empty, without computing it all"""
+    shortcut = payment_shortcut(item, local.building_ids())
+    if shortcut is not None:
+        return bool(shortcut)
+    return economy.is_affordable(*payment_arguments(item.cost, local, left, right))
+
+def find_payment(item, local, left, right, trade_left, trade_right):
+    """
+    The option of payment_options() paying exactly trade_left and
+    trade_right in trade, or None. Only cheaper options are searched
+    """
+    shortcut = payment_shortcut(item, local.building_ids())
+    if shortcut is not None:
+        return economy.can_pay(shortcut, trade_left, trade_right)
+    arguments = payment_arguments(item.cost, local, left, right)
+    return economy.find_payment(*arguments + (trade_left, trade_right))
+
+
+class Counters(collections.namedtuple('Counters', 'kind_counts defeats victories military specials_built')):
+    """
+    Player totals kept in PlayerCounters. kind_counts is like
+    PlayerRules.count_kinds()
+    """
+    __slots__ = ()
+
+    def count(self, kind):
+        """Number of buildings of a given kind (a BuildingKind or its name)"""
+        return dict(self.kind_counts).get(getattr(kind, 'pk', kind), 0)
+
+
+class PlayerView(collections.namedtuple('PlayerView', (
+        'pk city_id variant_id money specials_built defeat_count '
+        'buildings kind_counts effects local tradeable left_prices right_prices'))):
+    """
+    Immutable snapshot of a player, with everything rule records ask to
+    their Player-like arguments precomputed. Taken once per turn (see
+    Game.player_views()), so repeated calls for the same player are free.
+    local and tradeable are tuples of resource vectors, shared with the
+    rules catalog.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, player):
+        """Snapshot of a PlayerRules object"""
+        return cls(
+            pk=player.pk,
+            city_id=player.city_id,
+            variant_id=player.variant_id,
+            money=player.money,
+            specials_built=player.specials_built,
+            defeat_count=player.defeats(),
+            buildings=tuple(player.building_ids()),
+            kind_counts=player.count_kinds(),
+            effects=tuple(player.effect_ids()),
+            local=tuple(player.local_vectors()),
+            tradeable=tuple(player.tradeable_vectors()),
+            left_prices=player.trade_prices('l'),
+            right_prices=player.trade_prices('r'),
+        )
+
+    def building_ids(self):
+        return self.buildings
+
+    def building_records(self):
+        """Catalog records of the buildings built by this player"""
+        rules = catalog.get()
+        return [rules.buildings[pk] for pk in self.buildings]
+
+    def effect_ids(self):
+        return self.effects
+
+    def active_effects(self):
+        """The list of effects (catalog records) which apply to this player"""
+        rules = catalog.get()
+        return [rules.effects[pk] for pk in self.effects]
+
+    def count(self, kind):
+        """Number of buildings of a given kind (a BuildingKind or its name)"""
+        kind = getattr(kind, 'pk', kind)
+        for k, amount in self.kind_counts:
+            if k == kind:
+                return amount
+        return 0
+
+    def specials(self):
+        """Number of specials built"""
+        return self.specials_built
+
+    def defeats(self):
+        """Number of defeats suffered"""
+        return self.defeat_count
+
+    def local_vectors(self):
+        return self.local
+
+    def tradeable_vectors(self):
+        return self.tradeable
+
+    def trade_prices(self, direction):
+        assert direction in ('l', 'r')
+        return self.left_prices if direction == 'l' else self.right_prices
+
+    def local_production(self):
+        return production_pairs(self.local)
+
+    def tradeable_resources(self):
+        return production_pairs(self.tradeable)
+
+    def trade_costs(self, direction):
+        return price_dict(self.trade_prices(direction))
+
+    def next_special(self):
+        """Next special to build (a catalog record), None if all built"""
+        return catalog.get().next_special(self.city_id, self.variant_id, self.specials_built)
+
+    def military(self):
+        """Military power"""
+        return sum(e.military for e in self.active_effects())
+
+    def science_score(self):
+        """Amount of science points"""
+        masks = [e.science_mask for e in self.active_effects() if e.science_mask]
+        return science.science_score(masks, len(catalog.get().science_names))
+
+    def payment_options(self, item, left, right):
+        """Same as PlayerRules.payment_options(), given the neighbor views"""
+        return payment_options(item, self, left, right)
+
+    def score(self, left, right, military=0):
+        """
+        Score for this player, given the neighbor views. military is the
+        score of the player's battle results, which views don't keep
+        """
+        specials = catalog.get().built_specials(self.city_id, self.variant_id, self.specials_built)
+        result = Score.new()._replace(
+            treasury=self.money // 3,
+            military=military,
+            special=sum(s.effect.get_score(self, left, right) for s in specials),
+            science=self.science_score(),
+        )
+        for b in self.building_records():
+            result = result + b.score(self, left, right)
+        return result
+
+def add_scores(a, b, sign=1):
+    """a + sign*b, for Score tuples"""
+    return Score(*(x + sign*y for x, y in zip(a, b)))
+
+def depends_on_table(effect):
+    """
+    True if the score of an effect (catalog record) changes with the
+    buildings, specials or defeats of its owner or the neighbors
+    """
+    return bool(
+        (effect.kinds_scored and (effect.score_per_local_building or effect.score_per_neighbor_building))
+        or effect.score_per_local_special or effect.score_per_neighbor_special
+        or effect.score_per_neighbor_defeat)
+
+def item_score(item, local, left, right):
+    """Score of a building or special (catalog records) built by local"""
+    if isinstance(item, catalog.BuildingRecord):
+        return item.score(local, left, right)
+    return Score.new()._replace(special=item.effect.get_score(local, left, right))
+
+@profiling.hook('engine.scoreboard')
+def scoreboard(views, military):
+    """
+    Score of every PlayerView in views (in seating order), as a list.
+    military maps player primary keys to the score of their battle results
+    """
+    n = len(views)
+    return [
+        v.score(views[i-1], views[(i+1) % n], military.get(v.pk, 0))
+        for i, v in enumerate(views)
+    ]
+
+def snapshot(table):
+    """PlayerViews for every seat in table, in seating order"""
+    return tuple(PlayerView.of(s) for s in table.seats)
+
+def around(views, pk):
+    """The (local, left, right) views for player pk, from snapshot() views"""
+    for i, v in enumerate(views):
+        if v.pk == pk:
+            return v, views[i-1], views[(i+1) % len(views)]
+    raise KeyError(pk)
+
+
+class Seat(PlayerRules):
+    """
+    In-memory state of a player during turn resolution. Attributes have the
+    same meaning as in Player, but relations are primary keys
+    """
+    __slots__ = (
+        'table', 'index', 'pk', 'city_id', 'variant_id',
+        'money', 'specials_built', 'buildings', 'effects', 'ages_used', 'defeat_count', 'victory_count', 'options',
+        'action', 'option_picked', 'trade_left', 'trade_right',
+        'running', 'dependent', 'scored',
+        'item', 'payment', 'saved',
+    )
+    # Player fields (not relations) that can change during play
+    SAVED_FIELDS = ('money', 'specials_built', 'action', 'option_picked', 'trade_left', 'trade_right')
+
+    def __init__(self, table, pk, city_id, variant_id, money, specials_built,
+                 buildings, ages_used, defeat_count, victory_count, options,
+                 action, option_picked, trade_left, trade_right,
+                 running, dependent, scored=None):
+        self.table = table
+        self.index = len(table.seats)
+        self.pk = pk
+        self.city_id = city_id
+        self.variant_id = variant_id
+        self.money = money
+        self.specials_built = specials_built
+        self.buildings = list(buildings)
+        # Index of effect_ids(), kept up to date by build()
+        self.effects = PlayerRules.effect_ids(self)
+        self.ages_used = set(ages_used)
+        self.defeat_count = defeat_count
+        self.victory_count = victory_count
+        self.options = list(options)
+        self.action = action
+        self.option_picked = option_picked
+        self.trade_left = trade_left
+        self.trade_right = trade_right
+        # Running score, and the part of it from effects depending on the
+        # table. scored is the scored_state() they are up to date with
+        self.running = running
+        self.dependent = dependent
+        self.scored = self.scored_state() if scored is None else scored
+        self.item = self.payment = None
+        self.saved = None
+        table.seats.append(self)
+
+    def mark_saved(self):
+        """Remember the current state, to know later what changed"""
+        self.saved = dict((name, getattr(self, name)) for name in self.SAVED_FIELDS)
+        self.saved.update(
+            buildings=tuple(self.buildings),
+            ages_used=frozenset(self.ages_used),
+            options=list(self.options),
+            counters=self.counters(),
+            running=(self.running, self.dependent),
+        )
+
+    def state(self):
+        """Plain data with the seat, for JSON (see Table.state())"""
+        return dict(
+            pk=self.pk, city_id=self.city_id, variant_id=self.variant_id,
+            money=self.money, specials_built=self.specials_built,
+            buildings=list(self.buildings), ages_used=sorted(self.ages_used),
+            defeat_count=self.defeat_count, victory_count=self.victory_count,
+            options=list(self.options),
+            action=self.action, option_picked=self.option_picked,
+            trade_left=self.trade_left, trade_right=self.trade_right,
+            running=list(self.running), dependent=list(self.dependent), scored=list(self.scored),
+        )
+
+    def building_ids(self):
+        return self.buildings
+
+    def effect_ids(self):
+        return self.effects
+
+    def defeats(self):
+        """Number of defeats suffered"""
+        return self.defeat_count
+
+    def counters(self):
+        """Current Counters for this seat"""
+        return Counters(self.count_kinds(), self.defeat_count, self.victory_count, self.military(), self.specials_built)
+
+    def scored_state(self):
+        """What the running score depends on: (buildings, specials, defeats)"""
+        return (len(self.buildings), self.specials_built, self.defeat_count)
+
+    def items(self, scored=(0, 0, 0)):
+        """
+        Catalog records of the buildings and specials built, after the ones
+        counted in the given scored_state() (all of them by default)
+        """
+        rules = catalog.get()
+        buildings, specials = scored[:2]
+        result = [rules.buildings[pk] for pk in self.buildings[buildings:]]
+        result.extend(
+            s for s in rules.built_specials(self.city_id, self.variant_id, self.specials_built)
+            if s.order >= specials)
+        return result
+
+    def left_player(self):
+        return self.table.seats[self.index-1]
+
+    def right_player(self):
+        return self.table.seats[(self.index+1) % len(self.table.seats)]
+
+    def can_build_free(self):
+        """Same as Player.can_build_free() for a started game"""
+        return any(e.free_building for e in self.active_effects()) and self.table.age_id not in self.ages_used
+
+    def pre_apply_action(self):
+        """
+        Pre-apply action played: check payment and pay local money.
+        (actions are applied in two phases)
+
+        Payments are checked for every player before anything is built, so
+        raising a commercial building does not affect its own price, and
+        building a resource does not allow to pay for itself.
+        """
+        assert self.action
+        if self.action == BUILD_ACTION:
+            self.item = catalog.get().options[self.option_picked].building
+        elif self.action == FREE_ACTION:
+            assert self.can_build_free()
+            self.item = catalog.get().options[self.option_picked].building
+        elif self.action == SPECIAL_ACTION:
+            self.item = self.next_special()
+            assert self.item is not None
+        if self.action in (BUILD_ACTION, SPECIAL_ACTION):
+            self.payment = find_payment(
+                self.item, self, self.left_player(), self.right_player(),
+                self.trade_left,
+                self.trade_right
+            )
+            assert self.payment is not None
+            # Pay local money. Trade is handled later
+            self.money -= self.payment.money
+
+    def build(self):
+        """
+        Add what was paid for in pre_apply_action. Done for every player
+        before apply_action, so applied effects related to existing buildings
+        count other buildings built in the same turn
+        """
+        if self.action in (BUILD_ACTION, FREE_ACTION):
+            self.buildings.append(self.item.pk)
+            self.effects.append(self.item.effect.pk)
+        elif self.action == SPECIAL_ACTION:
+            self.specials_built = self.item.order + 1
+            self.effects.append(self.item.effect.pk)
+
+    def apply_action(self):
+        """Apply action played"""
+        assert self.action
+        if self.action == SELL_ACTION:
+            # Sell: discard the option
+            self.table.discards.append(self.option_picked)
+            # Get money
+            self.money += constants.SELL_VALUE
+        else:
+            if self.action == FREE_ACTION:
+                # "Pay" with one use of the ability. No actual costs, but ability is disabled for this age
+                self.ages_used.add(self.table.age_id)
+            else:
+                # Pay!
+                self.left_player().money += self.trade_left
+                self.right_player().money += self.trade_right
+                self.money -= self.trade_left + self.trade_right
+            # Earn money if building produces money
+            self.money += self.item.effect.money(
+                self,
+                self.left_player(),
+                self.right_player()
+            )
+        # Option no longer available
+        self.options.remove(self.option_picked)
+
+    def reset_action(self):
+        self.action = ''
+        self.option_picked = None
+        self.trade_left = 0
+        self.trade_right = 0
+        self.item = self.payment = None
+
+
+def battles(strengths):
+    """
+    Battles around a table, given the military strength of each seat in
+    seating order. Every seat fights its left and right neighbors; returns a
+    (seat index, direction, result) for each battle that had a winner, with
+    result 'v' or 'd'
+    """
+    n = len(strengths)
+    result = []
+    for direction, offset in (('l', -1), ('r', 1)):
+        # Strength of the neighbor in that direction, for each seat
+        others = [strengths[(i+offset) % n] for i in range(n)]
+        result.extend(
+            (i, direction, 'v' if own > other else 'd')
+            for i, (own, other) in enumerate(zip(strengths, others))
+            if own != other)
+    result.sort()
+    return result
+
+def age_random(seed, age_id):
+    """Random generator for dealing an age of a game with the given seed"""
+    return random.Random(seed * 1000 + age_id)
+
+def deal(age_id, players, rng):
+    """
+    Hands of INITIAL_OPTIONS BuildOption primary keys for each of the given
+    number of players in an age, shuffled with rng. Personalities replace
+    some of the regular options. None if there are not enough options.
+    """
+    required_options = players * constants.INITIAL_OPTIONS
+
+    options, personalities = catalog.get().deck(age_id, players)
+    rng.shuffle(options)
+    rng.shuffle(personalities)
+
+    # Check that there are enough options for everyone
+    if len(options)+len(personalities) < required_options:
+        return None
+
+    # Figure out how many personalities to use
+    required_personalities = required_options - len(options)
+    recommended_personalities = 2+players
+    #   actual = Clip recommended in range [required..available]
+    actual_personalities = min(max(recommended_personalities, required_personalities), len(personalities))
+
+    # Remove unused personalities
+    del personalities[actual_personalities:]
+    # Remove unused options, replace by personalities
+    options[required_options-len(personalities):] = personalities
+    # Reshuffle, to mix personalities and the rest of the options
+    rng.shuffle(options)
+
+    assert len(options) == required_options
+    return [
+        [o.pk for o in options[i*constants.INITIAL_OPTIONS:(i+1)*constants.INITIAL_OPTIONS]]
+        for i in range(players)
+    ]
+
+class Table(object):
+    """
+    In-memory state of a whole game. seats is the list of Seats in playing
+    order (each seat has the previous one at its left)
+    """
+
+    def __init__(self, game_id, age_id, turn, discards=()):
+        self.game_id = game_id
+        self.age_id = age_id
+        self.turn = turn
+        self.discards = list(discards)
+        self.saved_discards = len(self.discards)
+        self.seats = []
+
+    def state(self):
+        """Plain data with the whole table, for JSON; see from_state()"""
+        return {
+            'game': self.game_id,
+            'age': self.age_id,
+            'turn': self.turn,
+            'discards': list(self.discards),
+            'seats': [s.state() for s in self.seats],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Table from a state(), marked as saved"""
+        table = cls(state['game'], state['age'], state['turn'], state['discards'])
+        for seat in state['seats']:
+            Seat(table, **dict(seat,
+                running=Score(*seat['running']),
+                dependent=Score(*seat['dependent']),
+                scored=tuple(seat['scored'])))
+        table.mark_saved()
+        return table
+
+    def mark_saved(self):
+        """Remember the current state, to know later what changed"""
+        self.saved_discards = len(self.discards)
+        for s in self.seats:
+            s.mark_saved()
+
+    def rotate_options(self):
+        """Pass the options left over to the next player, in the age direction"""
+        opts = [s.options for s in self.seats]
+        if catalog.get().ages[self.age_id].direction=='l':
+            opts = opts[1:]+opts[:1]
+        else:
+            assert catalog.get().ages[self.age_id].direction=='r'
+            opts = opts[-1:]+opts[:-1]
+        for s, os in zip(self.seats, opts):
+            s.options = os
+
+    def end_of_turn(self):
+        """
+        Apply all player actions, pass options and increase the turn
+        counter. Checking for the end of the age is up to the caller.
+        """
+        # Apply all player actions, in stages
+        for s in self.seats:
+            s.pre_apply_action()
+        for s in self.seats:
+            s.build()
+        for s in self.seats:
+            s.apply_action()
+        # Rotate available options
+        self.rotate_options()
+        # increase turn counter
+        self.turn += 1
+        # Reset players so they can play again
+        for s in self.seats:
+            s.reset_action()
+        self.update_scores()
+
+    def update_scores(self):
+        """
+        Bring the running score of every seat up to date. The score of
+        what was built since the last update is added, and the part
+        depending on the table (see depends_on_table()) is recomputed only
+        for seats where it may have changed: the ones that changed or have
+        a neighbor that changed.
+        """
+        n = len(self.seats)
+        changed = [s.scored != s.scored_state() for s in self.seats]
+        for i, s in enumerate(self.seats):
+            left, right = s.left_player(), s.right_player()
+            new_items = s.items(s.scored)
+            for item in new_items:
+                if not depends_on_table(item.effect):
+                    s.running = add_scores(s.running, item_score(item, s, left, right))
+            if changed[i-1] or changed[i] or changed[(i+1) % n]:
+                dependent = Score.new()
+                for item in s.items():
+                    if depends_on_table(item.effect):
+                        dependent = add_scores(dependent, item_score(item, s, left, right))
+                s.running = add_scores(add_scores(s.running, s.dependent, -1), dependent)
+                s.dependent = dependent
+            s.running = s.running._replace(treasury=s.money // 3)
+            if any(item.effect.science_mask for item in new_items):
+                s.running = s.running._replace(science=s.science_score())
+        for s in self.seats:
+            s.scored = s.scored_state()
+
+    def end_of_age(self):
+        """
+        Discard the options left and fight the battles of the age. Returns
+        the battles, as (seat, direction, result) like battles(). Moving to
+        the next age is up to the caller.
+        """
+        for s in self.seats:
+            self.discards.extend(s.options)
+            s.options = []
+        result = [
+            (self.seats[i], direction, outcome)
+            for i, direction, outcome in battles([s.military() for s in self.seats])
+        ]
+        age = catalog.get().ages[self.age_id]
+        for s, direction, outcome in result:
+            if outcome == 'd':
+                s.defeat_count += 1
+                points = age.defeat_score
+            else:
+                s.victory_count += 1
+                points = age.victory_score
+            s.running = s.running._replace(military=s.running.military + points)
+        self.update_scores()
+        return result
@@ -45,6 +45,6 @@ class PlayForm(forms.Form):
         option = self.cleaned_data.get('option')
         action = self.cleaned_data.get('action')
         if payment and option and action:
-            if (payment[0] == -1 and action != Player.SPECIAL_ACTION) or (option.id != payment[0] and action==Player.BUILD_ACTION):
+            if (payment[0] == Player.SPECIAL_PAYMENT and action != Player.SPECIAL_ACTION) or (option.id != payment[0] and action==Player.BUILD_ACTION):
                 raise forms.ValidationError("That is not a valid payment for the selected option")
         return self.cleaned_data
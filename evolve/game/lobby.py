@@ -0,0 +1,133 @@
+"""
+Queries for the game list (the lobby).
+
+Unfinished games are loaded a page at a time in one query, annotated with
+their number of players and whether the current user plays them, and split
+in Python. A game has free cities while it has fewer players than there are
+cities, since each player gets a different one, so joinability needs no
+query per game. Player names and variants are then loaded with one query
+each for the games of the page.
+
+Both unfinished and finished games are paginated by primary key (keyset
+pagination): a page of unfinished games is the games after a given one,
+oldest first, and a page of finished games is the games before a given one,
+newest first, so later pages cost the same as the first.
+
+The first page of each user is cached for LOBBY_CACHE_SECONDS; joining,
+creating or starting a game discards it (see forget()).
+"""
+import collections
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from evolve.rules.models import Variant
+from evolve.rules import catalog, constants
+from evolve.game.models import Game, Player, FinalScore
+
+FINISHED_PAGE_SIZE = 20
+GAMES_PAGE_SIZE = 50
+DEFAULT_CACHE_SECONDS = 5
+
+
+def annotated_games(user=None):
+    """
+    Games annotated with player_count, and is_member (if user plays it;
+    always false without a user), computed by the database
+    """
+    qn = connection.ops.quote_name
+    game_id = '%s.%s' % (qn(Game._meta.db_table), qn('id'))
+    players = 'SELECT %%s FROM %s WHERE %s = %s' % (qn(Player._meta.db_table), qn('game_id'), game_id)
+    select = {'player_count': players % 'COUNT(*)'}
+    params = []
+    if user is not None and user.is_authenticated():
+        select['is_member'] = 'EXISTS (%s AND %s = %%s)' % (players % '1', qn('user_id'))
+        params.append(user.pk)
+    else:
+        select['is_member'] = '0'
+    return Game.objects.extra(select=select, select_params=params)
+
+def lobby(user, before=None, page_size=FINISHED_PAGE_SIZE, after=None, games_page_size=GAMES_PAGE_SIZE):
+    """
+    Context for the game list of user (may be anonymous): my_games,
+    open_games (the joinable ones) and started_games among the page of
+    unfinished games after the given one, with player_names, current_age
+    (an AgeRecord) and startable set, variants set for open_games, the key
+    to pass as after for the next page in next_after (None on the last
+    one), and finished_page() of the user before the given game
+    """
+    rules = catalog.get()
+    unfinished = annotated_games(user).filter(finished=False).order_by('pk')
+    if after is not None:
+        unfinished = unfinished.filter(pk__gt=after)
+    unfinished = list(unfinished[:games_page_size+1])
+    next_after = unfinished[games_page_size-1].pk if len(unfinished) > games_page_size else None
+    games = {}
+    my_games, open_games, started_games = [], [], []
+    for g in unfinished[:games_page_size]:
+        g.player_names = []
+        g.variants = []
+        g.current_age = rules.ages[g.age_id]
+        g.startable = not g.started and g.player_count >= constants.MINIMUM_PLAYERS
+        games[g.pk] = g
+        if g.is_member:
+            my_games.append(g)
+        elif g.started:
+            started_games.append(g)
+        elif g.player_count < len(rules.cities):
+            open_games.append(g)
+    players = Player.objects.filter(game__in=games.keys()).order_by('_order').values_list('game', 'user__username')
+    for game_id, name in players:
+        games[game_id].player_names.append(name)
+    variants = dict((v.pk, v) for v in Variant.objects.all())
+    allowed = Game.allowed_variants.through.objects.filter(game__in=games.keys(), game__started=False)
+    for game_id, variant_id in allowed.order_by('variant').values_list('game', 'variant'):
+        games[game_id].variants.append(variants[variant_id])
+    finished_games, next_before = finished_page(user, before, page_size)
+    return {
+        'my_games': my_games,
+        'open_games': open_games,
+        'started_games': started_games,
+        'next_after': next_after,
+        'finished_games': finished_games,
+        'next_before': next_before,
+    }
+
+def finished_page(user, before=None, page_size=FINISHED_PAGE_SIZE):
+    """
+    (games, next_before): finished games played by user, newest first,
+    starting before the game with primary key before, and the key to pass
+    as before for the next page (None on the last one). Games have their
+    FinalScores in scores, best first
+    """
+    if user is None or not user.is_authenticated():
+        return [], None
+    games = Game.objects.filter(player__user=user, finished=True).order_by('-pk')
+    if before is not None:
+        games = games.filter(pk__lt=before)
+    games = list(games[:page_size+1])
+    next_before = games[page_size-1].pk if len(games) > page_size else None
+    games = games[:page_size]
+    scores = collections.defaultdict(list)
+    for s in FinalScore.objects.filter(player__game__in=games).select_related('player__user').order_by('-total'):
+        scores[s.player.game_id].append(s)
+    for g in games:
+        g.scores = scores[g.pk]
+    return games, next_before
+
+def cache_key(user):
+    return 'evolve.game.lobby.%s' % (user.pk if user.is_authenticated() else 'anonymous')
+
+def cached_lobby(user):
+    """lobby() for the first page, cached per user"""
+    key = cache_key(user)
+    result = cache.get(key)
+    if result is None:
+        result = lobby(user)
+        cache.set(key, result, getattr(settings, 'LOBBY_CACHE_SECONDS', DEFAULT_CACHE_SECONDS))
+    return result
+
+def forget(user):
+    """Discard the cached lobby of user, after it joined or changed games"""
+    cache.delete(cache_key(user))
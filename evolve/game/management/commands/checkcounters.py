@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from evolve.game.models import Game
+
+class Command(BaseCommand):
+    help = 'Check player counters against buildings and battle results, and rebuild the wrong ones'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+            help='Only report wrong counters, without rebuilding them'),
+    )
+
+    def handle(self, *args, **options):
+        checked = wrong = 0
+        for game in Game.objects.filter(started=True):
+            players = game.check_counters(fix=not options['dry_run'])
+            checked += 1
+            wrong += len(players)
+            for pk in players:
+                self.stdout.write("game %d: wrong counters for player %d\n" % (game.pk, pk))
+        self.stdout.write("%d games checked, %d players with wrong counters%s\n" % (
+            checked, wrong, ' (not fixed)' if options['dry_run'] and wrong else ''))
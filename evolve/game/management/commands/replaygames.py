@@ -0,0 +1,38 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from evolve.game import replay
+from evolve.game.models import Game, GameEvent
+
+class Command(BaseCommand):
+    args = '[game id ...]'
+    help = 'Replay games from their log, reporting throughput and games that replay differently'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=1,
+            help='Times to replay each game (default 1)'),
+    )
+
+    def handle(self, *args, **options):
+        games = Game.objects.filter(started=True).order_by('pk')
+        if args:
+            games = games.filter(pk__in=[int(pk) for pk in args])
+        count = turns = 0
+        seconds = 0.0
+        different = []
+        for game in games:
+            start = time.time()
+            for _ in range(options['repeat']):
+                table = replay.replay(game.pk, first=True)
+            seconds += time.time() - start
+            count += 1
+            turns += options['repeat'] * GameEvent.objects.filter(game=game, kind=GameEvent.TURN).count()
+            if table is None or replay.comparable(table) != replay.comparable(game.load_table()):
+                different.append(game.pk)
+                self.stdout.write("game %d: replay differs from the live game\n" % game.pk)
+        self.stdout.write("games: %d turns: %d time: %.2fs\n" % (count, turns, seconds))
+        if seconds:
+            self.stdout.write("turns/sec: %.2f\n" % (turns / seconds))
+        self.stdout.write("%d games replay differently\n" % len(different))
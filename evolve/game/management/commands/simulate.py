@@ -0,0 +1,77 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from evolve.rules.models import Age
+from evolve.rules import constants, economy
+from evolve.game import simulation
+
+class Command(BaseCommand):
+    help = 'Play games between bots and report engine throughput and latencies'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--games', type='int', default=5,
+            help='Games to play (default 5)'),
+        make_option('--min-players', type='int', default=constants.MINIMUM_PLAYERS,
+            help='Fewest players in a game (default %d)' % constants.MINIMUM_PLAYERS),
+        make_option('--max-players', type='int', default=7,
+            help='Most players in a game (default 7)'),
+        make_option('--seed', type='int', default=0,
+            help='Random seed (default 0)'),
+        make_option('--keep', action='store_true', default=False,
+            help='Keep the games played and their users'),
+        make_option('--profile', action='store_true', default=False,
+            help='Report profiling totals for each game'),
+        make_option('--profile-dir',
+            help='Dump cProfile stats for each turn to this directory (implies --profile)'),
+    )
+
+    def handle(self, *args, **options):
+        if not Age.objects.exists():
+            raise CommandError('No rules in the database; load the rules fixtures first')
+        if options['games'] < 1:
+            raise CommandError('At least one game must be played')
+        if not constants.MINIMUM_PLAYERS <= options['min_players'] <= options['max_players']:
+            raise CommandError('Invalid player range')
+        result = simulation.Result()
+        try:
+            simulation.simulate(options['games'], options['min_players'], options['max_players'], options['seed'], result,
+                profile=options['profile'], dump_dir=options['profile_dir'])
+        finally:
+            if not options['keep']:
+                simulation.cleanup(result)
+        self.stdout.write("games: %d turns: %d time: %.2fs\n" % (len(result.games), result.turns, result.seconds))
+        if result.turns and result.seconds:
+            self.stdout.write("turns/sec: %.2f\n" % (result.turns / result.seconds))
+        if result.turns:
+            self.stdout.write("queries/turn: %.1f\n" % (float(result.queries) / result.turns))
+        self.stdout.write("%-15s %8s %10s %10s\n" % ('', 'calls', 'p50(ms)', 'p99(ms)'))
+        stats = result.stats
+        for name in ('payment_table', 'score', 'end_of_turn'):
+            self.stdout.write("%-15s %8d %10s %10s\n" % (
+                name, len(stats.samples[name]), self.milliseconds(stats.percentile(name, 50)),
+                self.milliseconds(stats.percentile(name, 99))))
+        prechecks = result.prechecks
+        checked = sum(prechecks.values())
+        if checked:
+            self.stdout.write("prechecks: %d, %.1f%% without search (%d impossible, %d free)\n" % (
+                checked, 100.0 * (checked - prechecks[economy.SEARCH]) / checked,
+                prechecks[economy.IMPOSSIBLE], prechecks[economy.FREE]))
+        for i, (game, profile) in enumerate(result.profiles):
+            self.write_profile(i+1, game, profile)
+
+    def milliseconds(self, seconds):
+        return '-' if seconds is None else '%.3f' % (seconds * 1000)
+
+    def write_profile(self, number, game, profile):
+        self.stdout.write("\ngame %d (%d players)\n" % (number, len(game.seat_ids())))
+        self.stdout.write("%-30s %8s %10s %6s\n" % ('', 'calls', 'total(ms)', 'depth'))
+        for name in sorted(profile.calls):
+            self.stdout.write("%-30s %8d %10.1f %6d\n" % (name, profile.calls[name], profile.time[name]*1000, profile.depth[name]))
+        searches = profile.searches
+        if searches['count']:
+            self.stdout.write("payment searches: %d, %.1f states and %.1f branches each, depth %d\n" % (
+                searches['count'], float(searches['states'])/searches['count'],
+                float(searches['branches'])/searches['count'], searches['max_depth']))
+        if profile.dumps:
+            self.stdout.write("%d cProfile dumps, like %s\n" % (len(profile.dumps), profile.dumps[0]))
@@ -1,19 +1,38 @@
 import random
-import collections
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import simplejson
 
 from evolve.rules.models import (
-    Score,
-    City, CitySpecial, Variant, Age, Building, BuildOption, Effect, Science,
-    PERSONALITY, TRADEABLE
+    Score, KINDS,
+    City, CitySpecial, Variant, Age, Building, BuildOption,
 )
-from evolve.rules import constants, economy
+from evolve.rules import constants, economy, catalog, profiling
+from evolve.game import engine, channel, resolver, board
+
+# Queries run by Game.end_of_turn() when the age does not end, for loading
+# and writing the whole game and logging it, plus this amount per player.
+# Checked by tests
+END_OF_TURN_QUERIES = 18
+END_OF_TURN_QUERIES_PER_PLAYER = 1
+# Extra queries when the age ends: battle results, finding the next age,
+# dealing, logging and the snapshot
+END_OF_AGE_QUERIES = 6
+# Seconds cached player views and payment searches are kept, unless set in
+# settings.GAME_CACHE_SECONDS
+DEFAULT_CACHE_SECONDS = 60 * 60
 
 
 # Game models where state is kept
 
+def new_seed():
+    """Random seed for a new game"""
+    return random.randrange(2**31)
+
 class Game(models.Model):
     """A single match of the game, including all global game status"""
     # game settings
@@ -22,7 +41,14 @@ class Game(models.Model):
     # game state
     age = models.ForeignKey(Age, default=Age.first)
     turn = models.PositiveIntegerField(default=1)
+    # Increased each time a turn is resolved. Resolving a turn first swaps
+    # the version it was loaded with for the next one, so it happens once
+    # even when the last players submit at the same time
+    version = models.PositiveIntegerField(default=0)
     discards = models.ManyToManyField(BuildOption, blank=True, null=True)
+    # Player primary keys around the table, each one at the left of the next.
+    # Set when starting; seating doesn't change after that
+    seating = models.CommaSeparatedIntegerField(max_length=1024, blank=True)
     
     # status for the join/play/finish cycle
     started = models.BooleanField(default=False)
@@ -30,6 +56,12 @@ class Game(models.Model):
 
     special_use_discards_turn = models.BooleanField(default=False) # set when a player is picking from the discard pile
 
+    # Seed for dealing, so deals can be reproduced
+    seed = models.PositiveIntegerField(default=new_seed)
+
+    # Public state for rendering, as JSON (see evolve.game.board)
+    board = models.TextField(blank=True)
+
     def is_joinable(self, user=None):
         """True if the game has still room for more players and user, is specified, isn't already playing"""
         available_cities = City.objects.exclude(player__game=self)
@@ -53,6 +85,9 @@ class Game(models.Model):
             city=random.choice(available_cities),
         )
         player.save()
+        GameEvent.log(self, GameEvent.JOIN, player_id=player.pk, user=user.pk, city=player.city_id, variant=player.variant_id)
+        self._seated_players = None
+        channel.notify(self.pk)
         # TODO: if all cities assigned, game should auto-start?
         
     def is_startable(self):
@@ -68,116 +103,367 @@ class Game(models.Model):
         assert self.turn == 1
         # Start!
         self.started = True
+        self.seating = ','.join(str(pk) for pk in self.player_set.order_by('_order').values_list('pk', flat=True))
+        self._seated_players = None
         self.save()
+        GameEvent.log(self, GameEvent.START, seating=self.seat_ids(), seed=self.seed)
+        PlayerCounters.objects.bulk_create([PlayerCounters(player_id=pk) for pk in self.seat_ids()])
+        ProjectedScore.objects.bulk_create([
+            ProjectedScore.of(pk, Score.new()._replace(treasury=money // 3), Score.new())
+            for pk, money in self.player_set.values_list('pk', 'money')])
         # Shuffle build options for this age
         self.shuffle()
+        # Write the first board, which turns update from then on
+        self.public_board()
+        channel.notify(self.pk)
     start.alters_data = True
 
-    def shuffle(self):
-        """Assign to each player the build options"""
+    def shuffle(self, table=None):
+        """
+        Assign to each player the build options, and take a GameSnapshot with
+        them. table is the game state as an engine.Table at the end of the
+        previous age, updated here; loaded after dealing if not given
+        """
         assert self.started
         assert not self.finished
 
-        n = self.player_set.count()
-        required_options = n * constants.INITIAL_OPTIONS
-
-        options = list(BuildOption.objects.filter(
-            age=self.age,
-            players_needed__lte=n
-        ).exclude(
-            building__kind__name=PERSONALITY
-        ).order_by('?'))
-        personalities = list(BuildOption.objects.filter(
-            age=self.age,
-            players_needed__lte=n,
-            building__kind__name=PERSONALITY
-        ).order_by('?'))
-
+        seats = self.seat_ids()
+        hands = engine.deal(self.age_id, len(seats), self.age_random())
         # Check that there are enough options for everyone
-        if len(options)+len(personalities) < required_options:
+        if hands is None:
             raise BuildOption.DoesNotExist
 
-        # Figure out how many personalities to use
-        required_personalities = required_options - len(options)
-        recommended_personalities = 2+n
-        #   actual = Clip recommended in range [required..available]
-        actual_personalities = min(max(recommended_personalities, required_personalities), len(personalities))
-
-        # Remove unused personalities
-        del personalities[actual_personalities:]
-        # Remove unused options, replace by personalities
-        options[required_options-len(personalities):] = personalities
-        # Reshuffle, to mix personalities and the rest of the options
-        random.shuffle(options)
-        
-        # Now the set of options is built. Assign
-        assert len(options) == required_options
-        for p in self.player_set.all():
-            assert not p.current_options.all() # No options when shuffling
-            p.current_options.add(*options[:constants.INITIAL_OPTIONS])
-            del options[:constants.INITIAL_OPTIONS]
+        # Assign, in a single insert
+        Hand = Player.current_options.through
+        assert not Hand.objects.filter(player__in=seats).exists() # No options when shuffling
+        Hand.objects.bulk_create([
+            Hand(player_id=pk, buildoption_id=o)
+            for pk, hand in zip(seats, hands)
+            for o in hand
+        ])
+        event = GameEvent.log(self, GameEvent.DEAL, seed=self.seed)
+        if table is None:
+            table = self.load_table()
+        else:
+            table.age_id, table.turn = self.age_id, self.turn
+            for s, hand in zip(table.seats, hands):
+                s.options = hand
+            table.mark_saved()
+        GameSnapshot.of(table, event).save()
     shuffle.alters_data = True
 
+    def age_random(self):
+        """Random generator for dealing this age, from the game seed"""
+        return engine.age_random(self.seed, self.age_id)
+
     def get_player(self, user):
         """Return player for user, or None if user not part of this game"""
         try:
-            return self.player_set.get(user=user)
+            player = self.player_set.get(user=user)
         except Player.DoesNotExist:
             return None
+        player._game_cache = self # Share per game caches, like player_views()
+        return player
 
-    def end_of_age(self):
-        # discard cards for all players
-        for p in self.player_set.all():
-            self.discards.add(*p.current_options.all())
-            p.current_options.clear()
-        # Battles
-        for p in self.player_set.all():
-            for neighbor, d in zip((p.left_player(), p.right_player()),'lr'):
-                local = p.military()
-                foreign = neighbor.military()
-                if local != foreign: # There was a winner
-                    result = 'v' if local > foreign else 'd'
-                    BattleResult.objects.create(owner=p, direction=d, age=self.age, result=result)
+    def player_views(self):
+        """
+        engine.PlayerView for every player, in seating order. Snapshots are
+        taken once per turn, and cached by (game, age, turn, version, rules
+        stamp): the state they capture only changes at the end of a turn,
+        or with the rules. A turn resolved while they are taken (see
+        evolve.game.resolver) increases the version, so the next turn is
+        never read from this key.
+        """
+        if getattr(self, '_player_views', None) is None:
+            key = 'evolve.game.views.%d.%d.%d.%d.%s' % (
+                self.pk, self.age_id, self.turn, self.version, catalog.get().stamp)
+            views = cache.get(key) if self.started else None
+            if views is None:
+                views = engine.snapshot(self.load_table())
+                if self.started:
+                    cache.set(key, views, getattr(settings, 'GAME_CACHE_SECONDS', DEFAULT_CACHE_SECONDS))
+            self._player_views = views
+        return self._player_views
+
+    def seat_ids(self):
+        """Player primary keys in seating order"""
+        if self.seating:
+            return [int(pk) for pk in self.seating.split(',')]
+        # Not started (or started before seating was kept)
+        return list(self.player_set.order_by('_order').values_list('pk', flat=True))
+
+    def seated_players(self):
+        """
+        Players in seating order, loaded once per Game instance. They share
+        this game, so their neighbors are found without queries
+        """
+        if getattr(self, '_seated_players', None) is None:
+            seats = self.seat_ids()
+            players = self.player_set.in_bulk(seats)
+            self._seated_players = [players[pk] for pk in seats]
+            self._seat_index = dict((pk, i) for i, pk in enumerate(seats))
+            for p in self._seated_players:
+                p._game_cache = self
+        return self._seated_players
+
+    def neighbor(self, player_id, offset):
+        """Player offset seats to the right of the given one (left if negative)"""
+        players = self.seated_players()
+        return players[(self._seat_index[player_id] + offset) % len(players)]
+
+    def end_of_age(self, table=None):
+        """
+        Discard the options left, fight the battles and go to the next age
+        (or finish the game). table is the game state as an engine.Table,
+        loaded if not given; it is saved here
+        """
+        if table is None:
+            table = self.load_table()
+        battles = table.end_of_age()
+        self.save_table(table)
+        BattleResult.objects.bulk_create([
+            BattleResult(owner_id=s.pk, direction=direction, age_id=table.age_id, result=result)
+            for s, direction, result in battles])
         next_age = self.age.next()
+        event = GameEvent.log(self, GameEvent.AGE, next=next_age and next_age.pk)
         if next_age is None:
             self.finished = True
+            scores = self.scoreboard(engine.snapshot(table))
+            self.update_board(table, battles, dict(scores))
             self.save()
+            FinalScore.objects.bulk_create([FinalScore.of(pk, score) for pk, score in scores])
+            GameSnapshot.of(table, event).save()
         else:
             # Increase age
             self.age = next_age
             self.turn = 1
+            self.update_board(table, battles)
             # new cards
             self.save()
-            self.shuffle()
+            self.shuffle(table)
     end_of_age.alters_data = True
 
+    def load_table(self):
+        """
+        The whole game state as an engine.Table, loaded in a fixed number of
+        queries
+        """
+        table = engine.Table(self.pk, self.age_id, self.turn, self.discards.values_list('pk', flat=True))
+        buildings, options, ages_used, battles = {}, {}, {}, {}
+        for relation, related, result in (
+                (Player.buildings, 'building', buildings),
+                (Player.current_options, 'buildoption', options),
+                (Player.special_free_building_ages_used, 'age', ages_used)):
+            rows = relation.through.objects.filter(player__game=self).order_by('pk')
+            for player_id, related_id in rows.values_list('player', related):
+                result.setdefault(player_id, []).append(related_id)
+        # Without the default ordering, which would also group by age
+        battle_counts = BattleResult.objects.filter(owner__game=self).order_by().values('owner', 'result')
+        for row in battle_counts.annotate(count=models.Count('pk')):
+            battles[row['owner'], row['result']] = row['count']
+        projected = dict(
+            (s.player_id, s) for s in ProjectedScore.objects.filter(player__game=self))
+        military = self.military_scores() if self.started and len(projected) < len(self.seat_ids()) else {}
+        for p in self.player_set.order_by('_order').values(
+                'pk', 'city', 'variant', 'money', 'specials_built',
+                'action', 'option_picked', 'trade_left', 'trade_right'):
+            engine.Seat(table, p['pk'], p['city'], p['variant'],
+                money=p['money'],
+                specials_built=p['specials_built'],
+                buildings=buildings.get(p['pk'], ()),
+                ages_used=ages_used.get(p['pk'], ()),
+                defeat_count=battles.get((p['pk'], 'd'), 0),
+                victory_count=battles.get((p['pk'], 'v'), 0),
+                options=options.get(p['pk'], ()),
+                action=p['action'],
+                option_picked=p['option_picked'],
+                trade_left=p['trade_left'],
+                trade_right=p['trade_right'],
+                # Without a projected score, start one from scratch
+                running=projected[p['pk']].as_score() if p['pk'] in projected else Score.new()._replace(military=military.get(p['pk'], 0)),
+                dependent=projected[p['pk']].dependent_score() if p['pk'] in projected else Score.new(),
+                scored=None if p['pk'] in projected else (0, 0, 0),
+            )
+        table.mark_saved()
+        return table
+
+    def save_table(self, table):
+        """
+        Write the changes in table since it was loaded (or last saved). Player
+        rows are updated together when the changes are the same, and new
+        relations are inserted in bulk.
+        """
+        assert table.game_id == self.pk
+        updates = {}
+        new_buildings, new_ages_used, new_options, changed_options = [], [], [], []
+        changed_counters, changed_scores = [], []
+        for s in table.seats:
+            saved = s.saved
+            fields = dict(
+                (name, getattr(s, name)) for name in engine.Seat.SAVED_FIELDS
+                if getattr(s, name) != saved[name])
+            if fields:
+                updates.setdefault(tuple(sorted(fields.items())), []).append(s.pk)
+            new_buildings.extend(
+                Player.buildings.through(player_id=s.pk, building_id=b)
+                for b in s.buildings[len(saved['buildings']):])
+            new_ages_used.extend(
+                Player.special_free_building_ages_used.through(player_id=s.pk, age_id=a)
+                for a in s.ages_used - saved['ages_used'])
+            if s.options != saved['options']:
+                changed_options.append(s.pk)
+                new_options.extend(
+                    Player.current_options.through(player_id=s.pk, buildoption_id=o)
+                    for o in s.options)
+            if s.counters() != saved['counters']:
+                changed_counters.append(s)
+            if (s.running, s.dependent) != saved['running']:
+                changed_scores.append(s)
+        for fields, pks in updates.items():
+            Player.objects.filter(pk__in=pks).update(**dict(fields))
+        if new_buildings:
+            Player.buildings.through.objects.bulk_create(new_buildings)
+        if new_ages_used:
+            Player.special_free_building_ages_used.through.objects.bulk_create(new_ages_used)
+        if changed_options:
+            Player.current_options.through.objects.filter(player__in=changed_options).delete()
+            Player.current_options.through.objects.bulk_create(new_options)
+        if changed_counters:
+            self.write_counters(changed_counters)
+        if changed_scores:
+            ProjectedScore.objects.filter(player__in=[s.pk for s in changed_scores]).delete()
+            ProjectedScore.objects.bulk_create([
+                ProjectedScore.of(s.pk, s.running, s.dependent) for s in changed_scores])
+        if len(table.discards) > table.saved_discards:
+            Game.discards.through.objects.bulk_create([
+                Game.discards.through(game_id=self.pk, buildoption_id=o)
+                for o in table.discards[table.saved_discards:]])
+        table.mark_saved()
+    save_table.alters_data = True
+
+    def write_counters(self, seats):
+        """Replace the PlayerCounters of the given engine.Seats"""
+        PlayerCounters.objects.filter(player__in=[s.pk for s in seats]).delete()
+        PlayerCounters.objects.bulk_create([PlayerCounters.of(s) for s in seats])
+
+    def check_counters(self, fix=True):
+        """
+        Compare the PlayerCounters of every player with the totals computed
+        from the buildings, specials and battle results. Returns the primary
+        keys of the players whose counters are wrong or missing, after
+        rewriting them if fix is set
+        """
+        table = self.load_table()
+        stored = dict(
+            (c.player_id, c.as_counters())
+            for c in PlayerCounters.objects.filter(player__game=self))
+        wrong = [s for s in table.seats if stored.get(s.pk) != s.counters()]
+        if fix and wrong:
+            self.write_counters(wrong)
+        return [s.pk for s in wrong]
+    check_counters.alters_data = True
+
+    def military_scores(self):
+        """Score of the battle results of each player, by player primary key"""
+        result = {}
+        for owner, age_id, outcome in BattleResult.objects.filter(owner__game=self).values_list('owner', 'age', 'result'):
+            result[owner] = result.get(owner, 0) + BattleResult(age_id=age_id, result=outcome).score()
+        return result
+
+    def scoreboard(self, views=None):
+        """
+        (player primary key, Score) for every player, in seating order,
+        computed in one pass over the PlayerViews (this turn's if not given)
+        """
+        if views is None:
+            views = self.player_views()
+        scores = engine.scoreboard(views, self.military_scores())
+        return [(v.pk, score) for v, score in zip(views, scores)]
+
+    def projected_scores(self):
+        """ProjectedScores of every player, in seating order"""
+        return ProjectedScore.objects.filter(player__game=self).order_by('player___order')
+
+    def final_scores(self):
+        """FinalScores of a finished game, in seating order"""
+        return FinalScore.objects.filter(player__game=self).select_related('player__user').order_by('player___order')
+
+    @profiling.hook('Game.end_of_turn')
     def end_of_turn(self):
-        # Apply all player actions, in two stages
-        for p in self.player_set.all():
-            p.pre_apply_action()
-        for p in self.player_set.all():
-            p.apply_action()
-        # Rotate available options
-        opts = [list(p.current_options.all()) for p in self.player_set.all()]
-        if self.age.direction=='l':
-            opts = opts[1:]+opts[:1]
-        else:
-            assert self.age.direction=='r'
-            opts = opts[-1:]+opts[:-1]
-        for p, os in zip(self.player_set.all(), opts):
-            p.current_options.clear()
-            p.current_options.add(*os)
-        # increase turn counter
-        self.turn += 1
-        if self.turn > constants.TURN_COUNT:
-            self.end_of_age()
-        else:
-            self.save()
-        # Reset players so they can play again
-        for p in self.player_set.all():
-            p.reset_action()
+        """
+        Resolve the turn. The whole game is loaded once, every change is
+        computed in memory (see engine.Table.end_of_turn()), and written in a
+        single transaction.
+
+        The turn is claimed first by increasing the version, if it is still
+        the one of this instance. Returns False without changing anything if
+        it isn't (the turn was already resolved by someone else)
+        """
+        with profiling.dumping('game-%d-age-%d-turn-%d' % (self.pk, self.age_id, self.turn)):
+            with transaction.commit_on_success():
+                if not Game.objects.filter(pk=self.pk, version=self.version).update(version=F('version')+1):
+                    return False
+                self.version += 1
+                table = self.load_table()
+                table.end_of_turn()
+                GameEvent.log(self, GameEvent.TURN)
+                self.turn = table.turn
+                if self.turn > constants.TURN_COUNT:
+                    self.end_of_age(table)
+                else:
+                    self.save_table(table)
+                    self.update_board(table)
+                    self.save()
+        self._player_views = None # Taken before the turn ended
+        channel.notify(self.pk, final=self.finished)
+        return True
     end_of_turn.alters_data = True
 
+    def update_board(self, table, battles=(), scores=None):
+        """
+        Set board to the state in table, to be saved with the game. battles
+        are the ones just fought, as returned by engine.Table.end_of_age();
+        the earlier ones, and user names, are taken from the previous board.
+        scores maps player primary keys to the Scores to show instead of the
+        running ones
+        """
+        previous = board.decode(self.board)
+        if previous is None:
+            names, tokens = self.player_names(), self.battle_tokens() # Includes the new battles
+        else:
+            names = dict((s['pk'], s['name']) for s in previous['seats'])
+            tokens = dict((s['pk'], s['battles']) for s in previous['seats'])
+            for s, direction, result in battles:
+                tokens[s.pk].append((table.age_id, direction, result))
+        self.board = board.encode(board.dump(self, table, names, tokens, scores))
+
+    def public_board(self):
+        """
+        The board.Board of the game, rebuilt first if the one in board is not
+        current, and saved if the game started
+        """
+        data = board.decode(self.board)
+        if not board.is_current(data, self):
+            scores = dict((s.player_id, s.as_score()) for s in FinalScore.objects.filter(player__game=self))
+            data = board.dump(self, self.load_table(), self.player_names(), self.battle_tokens(), scores)
+            self.board = board.encode(data)
+            if self.started:
+                # Unless the game moved on meanwhile
+                Game.objects.filter(pk=self.pk, version=self.version, started=True).update(board=self.board)
+        return board.Board(data)
+
+    def player_names(self):
+        """User names by player primary key"""
+        return dict(self.player_set.values_list('pk', 'user__username'))
+
+    def battle_tokens(self):
+        """(age, direction, result) of the battles of each player, by age, by player primary key"""
+        result = {}
+        for owner, age_id, direction, outcome in BattleResult.objects.filter(owner__game=self).order_by('age__order', 'pk').values_list(
+                'owner', 'age', 'direction', 'result'):
+            result.setdefault(owner, []).append((age_id, direction, outcome))
+        return result
+
     def missing_players(self):
         """This is the list of players who haven't played yet"""
         return self.player_set.filter(action='')
@@ -187,9 +473,16 @@ class Game(models.Model):
         return self.player_set.exclude(action='')
 
     def turn_check(self):
-        """Checks if we need to do end of turn"""
+        """
+        Checks if we need to do end of turn, and hands it to the resolver (see
+        evolve.game.resolver and resolve_turn()). Returns True if it did.
+        This instance may be older than the turn checked, so the resolver
+        loads the game again
+        """
         if not self.missing_players():
-            self.end_of_turn()
+            resolver.submit(('turn', self.pk), resolve_turn, self.pk)
+            return True
+        return False
     turn_check.alters_data = True
 
     def discard(self, option):
@@ -201,13 +494,35 @@ class Game(models.Model):
         return ('game-detail', [], {'pk': self.id})
 
 
-class Player(models.Model):
+def resolve_turn(game_id):
+    """
+    Resolve the current turn of the game, if everybody played. Returns True
+    if this call resolved it.
+
+    When the turn is claimed by someone else first (see Game.end_of_turn()),
+    the game is loaded and checked again: it may have been loaded before
+    the previous turn ended, and the claim only shows its turn was resolved
+    """
+    while True:
+        try:
+            game = Game.objects.get(pk=game_id, started=True, finished=False)
+        except Game.DoesNotExist: # Finished, or deleted
+            return False
+        if game.missing_players().exists():
+            return False
+        if game.end_of_turn():
+            return True
+
+
+class Player(engine.PlayerRules, models.Model):
     """Single player information for given game"""
 
-    BUILD_ACTION= 'build'
-    FREE_ACTION = 'free'
-    SELL_ACTION = 'sell'
-    SPECIAL_ACTION = 'spec'
+    BUILD_ACTION = engine.BUILD_ACTION
+    FREE_ACTION = engine.FREE_ACTION
+    SELL_ACTION = engine.SELL_ACTION
+    SPECIAL_ACTION = engine.SPECIAL_ACTION
+    # Key for the next special in payment_table(), and the form payment choices
+    SPECIAL_PAYMENT = -1
     ACTIONS = (
         (BUILD_ACTION, 'Build'),
         (FREE_ACTION, 'Build(free, use special)'),
@@ -257,85 +572,101 @@ class Player(models.Model):
         result.sort(key=lambda b:ORDERING.index(b['kind']))
         return result
 
-    def active_effects(self):
-        """The set of effects which apply to this player"""
-        # City specials
-        city_effects = Effect.objects.filter(cityspecial__city=self.city, cityspecial__variant=self.variant, cityspecial__order__lt=self.specials_built)
-        # Building effects
-        effects = city_effects | Effect.objects.filter(building__player=self)
-        return effects
-
     def left_player(self):
-        try:
-            return self.get_previous_in_order()
-        except:
-            return self.game.player_set.order_by('-_order')[0]
+        return self.game.neighbor(self.pk, -1)
 
     def right_player(self):
-        try:
-            return self.get_next_in_order()
-        except:
-            return self.game.player_set.order_by('_order')[0]
+        return self.game.neighbor(self.pk, 1)
     
     def all_right_players(self):
         """
         A list of every player except self and player at the left, starting
         by the player at the right and going around to the right
         """
-        p = self.right_player()
-        result = []
-        for _ in range(self.game.player_set.count()-2):
-            result.append(p)
-            p = p.right_player()
-        assert p == self.left_player()
-        return result
+        players = self.game.seated_players()
+        return [self.game.neighbor(self.pk, offset) for offset in range(1, len(players)-1)]
     
-    def tradeable_resources(self):
+    def building_ids(self):
+        """Primary keys of the buildings built"""
+        return self.buildings.values_list('pk', flat=True)
+
+    def view(self):
+        """(local, left, right) PlayerViews for this player and its neighbors"""
+        return engine.around(self.game.player_views(), self.pk)
+
+    def payment_options(self, item):
         """
-        List of resources that can be bought by neighbors; note that not
-        every resource available is tradeable.
-        
-        This a [[(amount, resource)]]. Inner list are alternative resources
-        """
-        # Basic city resource is tradeable
-        result = [[(1, self.city.resource.name)]]
-        # Add in production of resources by tradeable kinds of buildings
-        for b in self.buildings.filter(kind__in=TRADEABLE):
-            if b.effect.production:
-                result.append(b.effect.production.to_list())
-        return result
+        List of ways of paying for item.cost. Empty if unpayable
 
-    def trade_costs(self, direction):
+        Computed on this turn's PlayerViews; item is a building or special
+        catalog record
         """
-        Costs of trading with player in given direction ('l' or 'r')
-        
-        dict of resource_name -> money
-        """
-        assert direction in ('l', 'r')
-        result = collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST)
-        for e in self.active_effects():
-            if (direction=='l' and e.left_trade) or (direction=='r' and e.right_trade):
-                cost = e.trade.money
-                for _, resource in e.trade.to_list():
-                    # Pick the better value for each resource
-                    result[resource] = min(result[resource], cost)
-        return result
-        
+        local, left, right = self.view()
+        return local.payment_options(item, left, right)
 
-    def local_production(self):
+    def payment_table(self):
         """
-        List of resources produced by every local effect (not counting trade)
-        
-        This a [[(amount, resource)]]. Inner list are alternative resources
-        """
-        # Basic city resource is local production
-        result = [[(1, self.city.resource.name)]]
-        # Add in production of resources by tradeable kinds of buildings
-        for e in self.active_effects():
-            if e.production:
-                result.append(e.production.to_list())
-        return result
-    
+        Payment options for everything the player can build this turn: a
+        dict from BuildOption primary key to list of PaymentOption, with the
+        next special (if any) under SPECIAL_PAYMENT.
+
+        Payment searches depend only on the cost, the player's money,
+        production and trade costs, and the neighbors' tradeable resources,
+        so their results are cached by cost for each player, and discarded
+        when one of those inputs, or the rules, change.
+        """
+        if getattr(self, '_payment_table', None) is None:
+            local, left, right = self.view()
+            rules = catalog.get()
+            fingerprint = (local.money, local.local, local.left_prices, local.right_prices,
+                left.tradeable, right.tradeable)
+            key = 'evolve.game.payments.%d.%d.%s' % (self.game_id, self.pk, rules.stamp)
+            cached = cache.get(key)
+            searches = cached[1] if cached is not None and cached[0] == fingerprint else {}
+            searched = len(searches)
+            built = local.building_ids()
+
+            def options_for(item):
+                result = engine.payment_shortcut(item, built)
+                if result is None:
+                    if item.cost.pk not in searches:
+                        searches[item.cost.pk] = engine.search_payments(item.cost, local, left, right)
+                    result = searches[item.cost.pk]
+                return result
+
+            table = dict(
+                (pk, options_for(rules.options[pk].building))
+                for pk in self.current_options.values_list('pk', flat=True))
+            special = local.next_special()
+            if special is not None:
+                table[self.SPECIAL_PAYMENT] = options_for(special)
+            if len(searches) != searched:
+                cache.set(key, (fingerprint, searches), getattr(settings, 'GAME_CACHE_SECONDS', DEFAULT_CACHE_SECONDS))
+            self._payment_table = table
+        return self._payment_table
+
+    def can_pay(self, action, option, trade_left, trade_right):
+        """
+        True if the player can pay trade_left and trade_right to build
+        option (one of current_options) with action, or the next special.
+        Actions that don't pay always can.
+
+        Checked against payment_table() if it was already computed, and
+        otherwise by searching just the payment asked for
+        """
+        if action == self.BUILD_ACTION:
+            key = option.pk
+        elif action == self.SPECIAL_ACTION:
+            key = self.SPECIAL_PAYMENT
+        else:
+            return True
+        table = getattr(self, '_payment_table', None)
+        if table is not None:
+            return economy.can_pay(table.get(key, []), trade_left, trade_right) is not None
+        local, left, right = self.view()
+        item = catalog.get().options[option.pk].building if key == option.pk else local.next_special()
+        return item is not None and engine.find_payment(item, local, left, right, trade_left, trade_right) is not None
+
     def can_play(self):
         return self.game.started and not self.game.finished and self.action == ''
 
@@ -346,10 +677,12 @@ class Player(models.Model):
         """
         # This only makes sense on started games
         if not self.game.started: return False
-        # Check that the player has the free build ability
-        if not self.active_effects().filter(free_building=True): return False
+        # Check that the player has the free build ability, with the effects
+        # of this turn's PlayerView
+        local = self.view()[0]
+        if not any(e.free_building for e in local.active_effects()): return False
         # Check that the effect hasn't been already used
-        if special_free_building_ages_used.filter(game=self.game): return False
+        if self.special_free_building_ages_used.filter(game=self.game): return False
         # Otherwise, the effect can be used
         return True
 
@@ -358,138 +691,39 @@ class Player(models.Model):
         Choose to play the given action with the given build option.
         
         Note that this is the selection of the option, the action is not applied
-        until the end of turn (which is checked at the end of this method).
+        until the end of turn (which is checked at the end of this method, and
+        resolved by the resolver, maybe after returning; see turn_check()).
+
+        The action is only recorded if the player hasn't played yet this turn,
+        and the turn is still the one of self.game (by its version), checked
+        in the same update: concurrent submissions for the same player can't
+        both succeed, and late ones are not taken for the next turn. Returns
+        True if it was recorded.
         
         Preconditions:
          - action is one of the Player.ACTIONS
          - option in self.current_options.all()
-         - option == FREE_ACTION implies self.can_build_free()
-         - option == SPECIAL_ACTION implies self.can_build_special()
-         - option == BUILD_ACTION implies option.cost can be paid with given trade
+         - action == FREE_ACTION implies self.can_build_free()
+         - action == SPECIAL_ACTION implies self.can_build_special()
+         - self.can_pay(action, option, trade_left, trade_right)
         """
         assert action in (name for name,label in self.ACTIONS)
         assert option in self.current_options.all()
-        assert option != self.FREE_ACTION or self.can_build_free()
-        assert option != self.SPECIAL_ACTION or self.can_build_special()
-        assert option != self.BUILD_ACTION or economy.can_pay(self.payment_options(option.building), trade_left, trade_right)
+        assert action != self.FREE_ACTION or self.can_build_free()
+        assert self.can_pay(action, option, trade_left, trade_right)
         
-        self.action = action
-        self.option_picked = option
-        self.trade_left = trade_left
-        self.trade_right = trade_right
-        self.save()
+        fields = dict(action=action, option_picked=option, trade_left=trade_left, trade_right=trade_right)
+        with transaction.commit_on_success():
+            if not Player.objects.filter(pk=self.pk, action='', game__version=self.game.version).update(**fields):
+                return False
+            GameEvent.log(self.game, GameEvent.PLAY, player_id=self.pk,
+                action=action, option=option.pk, trade_left=trade_left, trade_right=trade_right)
+        for name, value in fields.items():
+            setattr(self, name, value)
+        channel.notify(self.game_id)
         
         self.game.turn_check()
-
-    def reset_action(self):
-        self.action = ''
-        self.option_picked = None
-        self.trade_left = 0
-        self.trade_right = 0
-        self.save()
-    reset_action.alters_data = True
-
-    def pre_apply_action(self):
-        """
-        Pre-apply action played
-        (actions are applied in two phases)
-        """
-        assert self.action
-        # Buildings need to be added first, so applied effects related to
-        # existing buildings count other buildings built in the same turn
-        if self.action in (self.BUILD_ACTION, self.FREE_ACTION):
-            if self.action==self.BUILD_ACTION:
-                item = self.option_picked.building
-            else:
-                item = self.next_special() 
-            # Check payment. This needs to be done before building, so raising
-            # a commercial building does not affect its own price, and building
-            # a resource does not allow to pay for itself.
-            # Anyway, build options should try to avoid that happening
-            payment = economy.can_pay(
-                self.payment_options(item), 
-                self.trade_left,
-                self.trade_right
-            )
-            assert payment is not None
-            # Pay local money. Trade is handled later
-            self.money -= payment.money
-            self.buildings.add(self.option_picked.building)
-        
-    def apply_action(self):
-        """Apply action played"""
-        assert self.action
-        if self.action == self.SELL_ACTION:
-            # Sell: discard the option
-            self.game.discard(self.option_picked)
-            # Get money
-            self.money += constants.SELL_VALUE
-
-            self.save()
-
-        elif self.action == self.BUILD_ACTION:
-            # Pay!
-            if self.trade_left:
-                self.left_player().money += self.trade_left
-                self.money -= self.trade_left
-                self.left_player().save()
-            if self.trade_right:
-                self.right_player().money += self.trade_right
-                self.money -= self.trade_right
-                self.right_player().save()
-            # Earn money if building produces money
-            self.money += self.option_picked.building.effect.money(
-                self,
-                self.left_player(),
-                self.right_player()
-            )
-            self.save()
-        elif self.action == self.FREE_ACTION:
-            assert self.can_build_free()
-            # "Pay" with one use of the ability. No actual costs, but ability is disabled for this age
-            special_free_building_ages_used.add(self.game.age)
-            # Earn money if building produces money
-            self.money += self.option_picked.building.effect.money(
-                self,
-                self.left_player(),
-                self.right_player()
-            )
-            self.save()
-            # Build
-        elif self.action == self.SPECIAL_ACTION:
-            assert self.can_build_special()
-            special = self.next_special()
-            # Pay!
-            if self.trade_left:
-                self.left_player().money += self.trade_left
-                self.money -= self.trade_left
-                self.left_player().save()
-            if self.trade_right:
-                self.right_player().money += self.trade_right
-                self.money -= self.trade_right
-                self.right_player().save()
-            # Earn money if building produces money
-            self.money += special.effect.money(
-                self,
-                self.left_player(),
-                self.right_player()
-            )
-            # "Build"
-            self.specials_built = special.order + 1
-            self.save()
-        else:
-            raise AssertionError
-        # Option no longer available
-        self.current_options.remove(self.option_picked)
-    apply_action.alters_data = True
-
-    def next_special(self):
-        """
-        Next special to build, None if all built
-        """
-        specials = CitySpecial.objects.filter(city=self.city, variant=self.variant, order__gte=self.specials_built).order_by('order')
-        if specials:
-            return specials[0]
+        return True
 
     def can_build_special(self):
         """
@@ -498,96 +732,56 @@ class Player(models.Model):
         """
         # This only makes sense on started games
         if not self.game.started: return False
-        # Check that there is a next special to build
-        special = self.next_special()
-        if special is None: return False
-        # Check that the player can pay for the special
-        return bool(self.payment_options(special))
+        # Check that there is a next special, and that the player can pay it
+        table = getattr(self, '_payment_table', None)
+        if table is not None:
+            return bool(table.get(self.SPECIAL_PAYMENT))
+        local, left, right = self.view()
+        special = local.next_special()
+        return special is not None and engine.is_affordable(special, local, left, right)
+
+    def get_counters(self):
+        """
+        Totals for this player, as an engine.Counters. Counted from the game
+        tables if its PlayerCounters are missing; the checkcounters command
+        rebuilds them
+        """
+        try:
+            return self.counters.as_counters()
+        except PlayerCounters.DoesNotExist:
+            return [s for s in self.game.load_table().seats if s.pk == self.pk][0].counters()
 
     def count(self, kind):
-        """Number of buildings of a given kind"""
-        return self.buildings.filter(kind=kind).count()
-    
-    def specials(self):
-        """Number of specials built"""
-        return self.specials_built
+        """Number of buildings of a given kind (a BuildingKind or its name)"""
+        return self.get_counters().count(kind)
 
     def defeats(self):
         """Number of defeats suffered"""
-        return self.battleresult_set.filter(result='d').count() # FIXME: hardcoded constant
+        return self.get_counters().defeats
 
-    def all_specials(self):
-        """The complete list of specials for our city+variant"""
-        return CitySpecial.objects.filter(city=self.city, variant=self.variant).order_by('order')
+    def victories(self):
+        """Number of victories"""
+        return self.get_counters().victories
 
     def military(self):
         """Military power"""
-        # Just the sum of the military powers of each effect
-        return self.active_effects().aggregate(models.Sum('military'))
-
-    def science_score(self):
-        """Amount of science points"""
-        ### Science score
-        # Build auxiliar science class
-        sciences = Science.objects.values_list('name', flat=True)
-        ScienceScore = collections.namedtuple('ScienceScore', ' '.join(sciences))
-        # compute list of science producing effects
-        options = [e.sciences.all() for e in self.active_effects() if e.sciences.count()]
-        
-        combinations = oldcombinations = set([ScienceScore(*[0]*len(sciences))]) # Science score for a player with no science effects
-        for o in options:
-            combinations = set()
-            for science in o:
-                for b in oldcombinations:
-                    combinations.add(b._replace(**{science.name: getattr(b, science.name)+1}))
-            oldcombinations = combinations
-
-        result = 0
-        for s in combinations:
-            value = min(s)*constants.SCIENCE_SCORE_PER_GROUP + sum(amount**2 for amount in s)
-            result = max(result, value)
-        return result
-    
-    def score(self):
-        """Score for this player"""
-        treasury_score = self.money // 3
-
-        military_score = sum(b.score() for b in self.battleresult_set.all())
+        return self.get_counters().military
 
-        specials_built = Effect.objects.filter(cityspecial__city=self.city, cityspecial__variant=self.variant, cityspecial__order__lt=self.specials_built)    
-        special_score = sum(s.get_score(self, self.left_player(), self.right_player()) for s in specials_built)
-        
-        # Accumulate building effects
-        result = Score.new()._replace(
-            treasury=treasury_score,
-            military=military_score,
-            special=special_score,
-            science=self.science_score()
-        )
-        for b in self.buildings.all():
-            result = result + b.score(self, self.left_player(), self.right_player())
-
-        return result
+    def all_specials(self):
+        """The complete list of specials for our city+variant"""
+        return CitySpecial.objects.filter(city=self.city, variant=self.variant).order_by('order')
 
-    def payment_options(self, item):
-        """List of ways of paying for item.cost. Empty if unpayable"""
-        # Can't be bought if we already have it
-        if item in self.buildings.all():
-            return []
-        # Check if we have a dependency of this item that makes it free:
-        if hasattr(item, 'free_having'):
-            if item.free_having in self.buildings.all():
-                # You can get it for free. No more options needed
-                return [economy.PaymentOption()]
-        return economy.get_payments(
-            item.cost.to_dict(),
-            self.money,
-            self.local_production(),
-            self.left_player().tradeable_resources(),
-            self.trade_costs('l'),
-            self.right_player().tradeable_resources(),
-            self.trade_costs('r'),
-        )            
+    @profiling.hook('Player.score')
+    def score(self):
+        """Score for this player; the stored one if the game finished"""
+        if self.game.finished:
+            try:
+                return self.final_score.as_score()
+            except FinalScore.DoesNotExist:
+                pass
+        local, left, right = self.view()
+        military = sum(b.score() for b in self.battleresult_set.all())
+        return local.score(left, right, military)
 
     class Meta:
         unique_together = (
@@ -599,6 +793,118 @@ class Player(models.Model):
     def __unicode__(self):
         return unicode(self.user)
 
+class PlayerCounters(models.Model):
+    """
+    Totals for a player, so they can be read without counting buildings and
+    battles. Written with the rest of the game state at the end of each turn
+    (see Game.save_table()); Game.check_counters() rebuilds them from the
+    source tables.
+    """
+    # Field with the number of buildings of each kind
+    KIND_FIELDS = dict((kind, '%s_buildings' % kind) for kind, label in KINDS)
+
+    player = models.OneToOneField(Player, related_name='counters')
+    mil_buildings = models.PositiveIntegerField(default=0)
+    civ_buildings = models.PositiveIntegerField(default=0)
+    bas_buildings = models.PositiveIntegerField(default=0)
+    cpx_buildings = models.PositiveIntegerField(default=0)
+    eco_buildings = models.PositiveIntegerField(default=0)
+    sci_buildings = models.PositiveIntegerField(default=0)
+    per_buildings = models.PositiveIntegerField(default=0)
+    defeats = models.PositiveIntegerField(default=0)
+    victories = models.PositiveIntegerField(default=0)
+    military = models.PositiveIntegerField(default=0)
+    specials_built = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def of(cls, seat):
+        """Unsaved counters for an engine.Seat"""
+        counters = seat.counters()
+        return cls(
+            player_id=seat.pk,
+            defeats=counters.defeats,
+            victories=counters.victories,
+            military=counters.military,
+            specials_built=counters.specials_built,
+            **dict((cls.KIND_FIELDS[kind], amount) for kind, amount in counters.kind_counts)
+        )
+
+    def kind_counts(self):
+        """Sorted tuple of (kind name, number of buildings) for kinds built"""
+        return tuple(
+            (kind, getattr(self, field)) for kind, field in sorted(self.KIND_FIELDS.items())
+            if getattr(self, field))
+
+    def count(self, kind):
+        """Number of buildings of a given kind (a BuildingKind or its name)"""
+        return getattr(self, self.KIND_FIELDS[getattr(kind, 'pk', kind)])
+
+    def as_counters(self):
+        """The same totals as an engine.Counters"""
+        return engine.Counters(self.kind_counts(), self.defeats, self.victories, self.military, self.specials_built)
+
+    def __unicode__(self):
+        return u'Counters for %s' % self.player
+
+class ProjectedScore(models.Model):
+    """
+    Running score of a player, as if the game finished now. Kept up to date
+    incrementally at the end of each turn (see engine.Table.update_scores())
+    """
+    player = models.OneToOneField(Player, related_name='projected_score')
+    treasury = models.IntegerField(default=0)
+    military = models.IntegerField(default=0)
+    special = models.IntegerField(default=0)
+    civilian = models.IntegerField(default=0)
+    economy = models.IntegerField(default=0)
+    science = models.IntegerField(default=0)
+    personality = models.IntegerField(default=0)
+    # Part of the score from effects depending on the table (see
+    # engine.depends_on_table()), included in the fields above
+    dependent_treasury = models.IntegerField(default=0)
+    dependent_military = models.IntegerField(default=0)
+    dependent_special = models.IntegerField(default=0)
+    dependent_civilian = models.IntegerField(default=0)
+    dependent_economy = models.IntegerField(default=0)
+    dependent_science = models.IntegerField(default=0)
+    dependent_personality = models.IntegerField(default=0)
+
+    @classmethod
+    def of(cls, player_id, score, dependent):
+        """Unsaved ProjectedScore for Score tuples"""
+        fields = score._asdict()
+        fields.update(('dependent_' + name, value) for name, value in dependent._asdict().items())
+        return cls(player_id=player_id, **fields)
+
+    def as_score(self):
+        return Score(*(getattr(self, name) for name in Score._fields))
+
+    def dependent_score(self):
+        return Score(*(getattr(self, 'dependent_' + name) for name in Score._fields))
+
+class FinalScore(models.Model):
+    """Score of a player when the game finished, so it is never recomputed"""
+    player = models.OneToOneField(Player, related_name='final_score')
+    treasury = models.IntegerField()
+    military = models.IntegerField()
+    special = models.IntegerField()
+    civilian = models.IntegerField()
+    economy = models.IntegerField()
+    science = models.IntegerField()
+    personality = models.IntegerField()
+    total = models.IntegerField()
+
+    @classmethod
+    def of(cls, player_id, score):
+        """Unsaved FinalScore for a Score"""
+        return cls(player_id=player_id, total=score.total(), **score._asdict())
+
+    def as_score(self):
+        return Score(*(getattr(self, name) for name in Score._fields))
+
+    def __unicode__(self):
+        return u'%s: %d' % (self.player, self.total)
+
 class BattleResult(models.Model):
     """
     Result of a battle where a player fought.
@@ -610,10 +916,90 @@ class BattleResult(models.Model):
     result = models.CharField(max_length=1, choices=(('v', 'Victory'),('d','Defeat')))
 
     def score(self):
+        age = catalog.get().ages[self.age_id]
         if self.result == 'v':
-            return self.age.victory_score
+            return age.victory_score
         else: 
-            return self.age.defeat_score
+            return age.defeat_score
         
     class Meta:
         ordering = ('age',)
+
+
+# Game history
+
+class GameEvent(models.Model):
+    """
+    Entry in the append-only log of a game, which keeps every change in the
+    order of the primary keys. age and turn are the ones of the game when
+    the event happened, and data has the details of each kind, as JSON:
+     - JOIN: user, city and variant of the new player
+     - START: seating (player primary keys) and seed
+     - DEAL: seed, dealing the options of the age (see engine.deal())
+     - PLAY: action, option, trade_left and trade_right of the player
+     - TURN: the turn was resolved
+     - AGE: the age ended; next is the next age, or None if the game finished
+    With the GameSnapshots, the log rebuilds the game at any turn (see
+    evolve.game.replay)
+    """
+    JOIN = 'join'
+    START = 'start'
+    DEAL = 'deal'
+    PLAY = 'play'
+    TURN = 'turn'
+    AGE = 'age'
+    KINDS = (
+        (JOIN, 'Join'),
+        (START, 'Start'),
+        (DEAL, 'Deal'),
+        (PLAY, 'Play'),
+        (TURN, 'End of turn'),
+        (AGE, 'End of age'),
+    )
+
+    game = models.ForeignKey(Game)
+    kind = models.CharField(max_length=5, choices=KINDS)
+    player = models.ForeignKey(Player, blank=True, null=True)
+    age = models.ForeignKey(Age)
+    turn = models.PositiveIntegerField()
+    data = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def log(cls, game, kind, player_id=None, **data):
+        """Append an event to the log of game, at its current age and turn"""
+        return cls.objects.create(
+            game_id=game.pk, kind=kind, player_id=player_id, age_id=game.age_id, turn=game.turn,
+            data=simplejson.dumps(data))
+
+    def values(self):
+        """data, decoded"""
+        return simplejson.loads(self.data)
+
+    def __unicode__(self):
+        return u'%s %d.%d: %s' % (self.get_kind_display(), self.age_id, self.turn, self.data)
+
+    class Meta:
+        ordering = ('pk',)
+
+class GameSnapshot(models.Model):
+    """
+    The whole state of a game (see engine.Table.state()) right after an event
+    of its log. Taken after every deal, so replays only need to run the turns
+    of one age, and when the game finishes
+    """
+    game = models.ForeignKey(Game)
+    event = models.ForeignKey(GameEvent)
+    age = models.ForeignKey(Age)
+    turn = models.PositiveIntegerField()
+    state = models.TextField()
+
+    @classmethod
+    def of(cls, table, event):
+        """Unsaved GameSnapshot of an engine.Table, after event"""
+        return cls(game_id=table.game_id, event=event, age_id=table.age_id, turn=table.turn,
+            state=simplejson.dumps(table.state(), separators=(',', ':')))
+
+    def table(self):
+        """The snapshot as an engine.Table"""
+        return engine.Table.from_state(simplejson.loads(self.state))
@@ -0,0 +1,78 @@
+"""
+Rebuilding games from their log.
+
+Every change to a game is appended to its GameEvent log, and its whole state
+is kept in a GameSnapshot after every deal and when it finishes. replay()
+restores the latest snapshot before the turn asked for, and applies the
+events after it to the in-memory engine.Table, the same way Game.end_of_turn()
+and Game.end_of_age() do. The live game tables are not read.
+
+Replays use the rules in the catalog, so they only match the games played
+while those rules don't change.
+"""
+from evolve.rules import catalog
+from evolve.game import engine
+from evolve.game.models import GameEvent, GameSnapshot
+
+
+def position(age_id, turn):
+    """Sortable position of a turn in any game"""
+    return (catalog.get().ages[age_id].order, turn)
+
+def comparable(table):
+    """
+    engine.snapshot() of table, with the effects sorted: tables with the same
+    state may index them in a different order (see Seat.effect_ids())
+    """
+    return tuple(v._replace(effects=tuple(sorted(v.effects))) for v in engine.snapshot(table))
+
+def apply(table, event):
+    """Apply a GameEvent to table"""
+    data = event.values()
+    if event.kind == GameEvent.PLAY:
+        seat = [s for s in table.seats if s.pk == event.player_id][0]
+        seat.action = data['action']
+        seat.option_picked = data['option']
+        seat.trade_left = data['trade_left']
+        seat.trade_right = data['trade_right']
+    elif event.kind == GameEvent.TURN:
+        assert (table.age_id, table.turn) == (event.age_id, event.turn)
+        table.end_of_turn()
+    elif event.kind == GameEvent.AGE:
+        table.end_of_age()
+        if data['next'] is not None:
+            table.age_id, table.turn = data['next'], 1
+    elif event.kind == GameEvent.DEAL:
+        rng = engine.age_random(data['seed'], table.age_id)
+        for s, hand in zip(table.seats, engine.deal(table.age_id, len(table.seats), rng)):
+            s.options = hand
+    # Joining and starting happen before the first snapshot
+
+def replay(game_id, age_id=None, turn=None, first=False):
+    """
+    The game as an engine.Table when the given turn of age started (before
+    anybody played), or as it is now if no turn is given. None if it has no
+    snapshot (it didn't start) or it didn't reach that turn. With first,
+    every turn is replayed from the first snapshot instead of the latest
+    one.
+    """
+    target = None if age_id is None else position(age_id, turn)
+    snapshots = sorted(
+        (position(a, t), pk)
+        for pk, a, t in GameSnapshot.objects.filter(game=game_id).values_list('pk', 'age', 'turn')
+        if target is None or position(a, t) <= target)
+    if not snapshots:
+        return None
+    at, pk = snapshots[0] if first else snapshots[-1]
+    snapshot = GameSnapshot.objects.get(pk=pk)
+    table = snapshot.table()
+    if at == target:
+        return table
+    for event in GameEvent.objects.filter(game=game_id, pk__gt=snapshot.event_id):
+        # A new age starts with its deal
+        if target is not None and event.kind != GameEvent.DEAL and position(table.age_id, table.turn) == target:
+            return table
+        apply(table, event)
+    if target is not None and position(table.age_id, table.turn) != target:
+        return None
+    return table
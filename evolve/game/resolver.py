@@ -0,0 +1,162 @@
+"""
+Resolution of turns outside the requests.
+
+When the last player of a turn plays, the turn is handed to the resolver
+instead of being resolved in that player's request, which would wait for
+the end of turn (and the end of age, when it comes). Clients learn about
+the new turn through evolve.game.channel, as with any other change.
+
+Work is submitted with a key; ThreadResolver runs it in a pool of worker
+threads, and skips work whose key is already waiting in the queue. Turns
+are keyed by game only, as ('turn', game.pk): the work resolves whatever
+turn the game is at when it runs, so a game has at most one resolution
+waiting. The key leaves the queue when the work starts, so the same game
+may be submitted again while it runs; this is safe because resolve_turn()
+loads the game again and does nothing unless every player played, and
+Game.end_of_turn() claims the turn by its version, so a turn is never
+resolved twice (see evolve.game.models.resolve_turn).
+Work raising an exception is retried a few times, waiting longer each time
+(GAME_TURN_RESOLVER_RETRIES and GAME_TURN_RESOLVER_RETRY_DELAY), so a
+transient failure, like a lost database connection, doesn't leave the game
+waiting for a turn nobody resolves. ImmediateResolver runs the work in the
+submitting thread, for tests and the simulator.
+
+The resolver is set by the GAME_TURN_RESOLVER setting (a dotted path to a
+class), and can be replaced with set_resolver() or using().
+"""
+import contextlib
+import logging
+import Queue
+import threading
+
+from django.conf import settings
+from django.db import close_connection
+from django.utils.importlib import import_module
+
+DEFAULT_RESOLVER = 'evolve.game.resolver.ImmediateResolver'
+DEFAULT_WORKERS = 2
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class ImmediateResolver(object):
+    """Resolver running the work right away, in the submitting thread"""
+
+    def submit(self, key, function, *args):
+        function(*args)
+
+
+class ThreadResolver(object):
+    """
+    Resolver running the work in a pool of daemon threads, started on the
+    first submission. Failed work is submitted again up to retries times,
+    after retry_delay seconds, doubled on each retry. The size of the pool
+    and the retries are the GAME_TURN_RESOLVER_* settings unless given
+    """
+
+    def __init__(self, workers=None, retries=None, retry_delay=None):
+        self.workers = workers or getattr(settings, 'GAME_TURN_RESOLVER_WORKERS', DEFAULT_WORKERS)
+        if retries is None:
+            retries = getattr(settings, 'GAME_TURN_RESOLVER_RETRIES', DEFAULT_RETRIES)
+        if retry_delay is None:
+            retry_delay = getattr(settings, 'GAME_TURN_RESOLVER_RETRY_DELAY', DEFAULT_RETRY_DELAY)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.timers = set()
+
+    def submit(self, key, function, *args):
+        self.put(key, function, args, 0)
+
+    def put(self, key, function, args, attempt):
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            if not self.threads:
+                self.start()
+        self.queue.put((key, function, args, attempt))
+
+    def retry(self, key, function, args, attempt):
+        """Submit failed work again after a delay, unless it failed too many times"""
+        if attempt >= self.retries:
+            logger.error('Giving up resolving %r after %d attempts', key, attempt + 1)
+            return
+        timer = threading.Timer(self.retry_delay * 2 ** attempt, self.retried, (key, function, args, attempt + 1))
+        timer.daemon = True
+        with self.lock:
+            self.timers.add(timer)
+        timer.start()
+
+    def retried(self, key, function, args, attempt):
+        self.put(key, function, args, attempt)
+        with self.lock:
+            self.timers.discard(threading.current_thread())
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name='resolver-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            key, function, args, attempt = self.queue.get()
+            with self.lock:
+                self.pending.discard(key)
+            try:
+                function(*args)
+            except Exception:
+                logger.exception('Resolving %r failed', key)
+                self.retry(key, function, args, attempt)
+            finally:
+                close_connection() # Connections are per thread, and would be kept open
+                self.queue.task_done()
+
+    def join(self):
+        """Wait until the work submitted so far is done, retries included"""
+        while True:
+            self.queue.join()
+            with self.lock:
+                timers = list(self.timers)
+            if not timers:
+                return
+            for timer in timers:
+                timer.join()
+
+
+_resolver = None
+
+def get_resolver():
+    """The resolver in use; the one configured in settings by default"""
+    global _resolver
+    if _resolver is None:
+        path = getattr(settings, 'GAME_TURN_RESOLVER', DEFAULT_RESOLVER)
+        module, name = path.rsplit('.', 1)
+        _resolver = getattr(import_module(module), name)()
+    return _resolver
+
+def set_resolver(resolver):
+    """Use resolver from now on (None for the configured one). Returns the previous one"""
+    global _resolver
+    previous, _resolver = _resolver, resolver
+    return previous
+
+@contextlib.contextmanager
+def using(resolver):
+    """Use resolver inside the block"""
+    previous = set_resolver(resolver)
+    try:
+        yield resolver
+    finally:
+        set_resolver(previous)
+
+def submit(key, function, *args):
+    """Run function(*args) in the resolver, unless work with key is already waiting"""
+    get_resolver().submit(key, function, *args)
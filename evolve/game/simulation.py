@@ -0,0 +1,185 @@
+"""
+Headless games between bots, for measuring the engine.
+
+Bots play through the same entry points as the web views (Game.start,
+Player.play, which runs Game.end_of_turn when everybody played), picking a
+random legal move among the ones offered by the play form. Turns are
+resolved right away, with an ImmediateResolver, so they are measured and
+bots see the next one. Games use the rules in the database, and are
+deterministic for a given seed.
+"""
+import collections
+import contextlib
+import math
+import random
+import time
+
+from django.db import connection, reset_queries
+from django.contrib.auth.models import User
+
+from evolve.rules.models import Variant
+from evolve.rules import economy, profiling
+from evolve.game import resolver
+from evolve.game.models import Game, Player
+
+
+class count_queries(object):
+    """Context manager counting the queries run inside it"""
+
+    def __enter__(self):
+        self.old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection.use_debug_cursor = self.old_debug_cursor
+        self.count = len(connection.queries) - self.start
+
+
+class Stats(object):
+    """Latency samples in seconds, by name"""
+
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+
+    def add(self, name, seconds):
+        self.samples[name].append(seconds)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """Record the time spent inside the block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    @contextlib.contextmanager
+    def timing(self, owner, attr, name=None):
+        """
+        Record every call to the function owner.attr (a method if owner is a
+        class) while inside the block
+        """
+        original = vars(owner)[attr]
+        name = name or attr
+        def timed(*args, **kwargs):
+            with self.measure(name):
+                return original(*args, **kwargs)
+        setattr(owner, attr, timed)
+        try:
+            yield
+        finally:
+            setattr(owner, attr, original)
+
+    def percentile(self, name, percent):
+        """Nearest rank percentile of the samples for name, None if there are none"""
+        samples = sorted(self.samples[name])
+        if not samples:
+            return None
+        rank = int(math.ceil(percent / 100.0 * len(samples)))
+        return samples[max(rank-1, 0)]
+
+
+def legal_moves(player):
+    """
+    Every (action, option, trade_left, trade_right) the play form would
+    accept from player
+    """
+    options = list(player.current_options.all())
+    table = player.payment_table()
+    built = set(player.building_ids())
+    moves = []
+    for o in options:
+        moves.append((Player.SELL_ACTION, o, 0, 0))
+        for po in table[o.pk]:
+            moves.append((Player.BUILD_ACTION, o, po.left_trade.cost(), po.right_trade.cost()))
+    if player.can_build_free():
+        moves.extend((Player.FREE_ACTION, o, 0, 0) for o in options if o.building_id not in built)
+    for po in table.get(Player.SPECIAL_PAYMENT, []):
+        moves.extend((Player.SPECIAL_ACTION, o, po.left_trade.cost(), po.right_trade.cost()) for o in options)
+    return moves
+
+
+class Result(object):
+    """Totals for a simulation run"""
+
+    def __init__(self):
+        self.games = []
+        self.turns = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.stats = Stats()
+        # (game, evolve.rules.profiling.Profile), when profiling
+        self.profiles = []
+        # Outcomes of economy.precheck()
+        self.prechecks = collections.Counter()
+
+
+def play_game(users, rng, result, profile=None):
+    """
+    Play a game between users until it finishes, adding to result. Returns
+    the finished game. If a Profile is given, it is active while playing
+    """
+    game = Game.objects.create()
+    game.allowed_variants.add(*Variant.objects.all())
+    for user in users:
+        game.join(user)
+    game.start()
+    result.games.append(game)
+    if profile is not None:
+        result.profiles.append((game, profile))
+        with profiling.active(profile):
+            return play_turns(game, rng, result)
+    return play_turns(game, rng, result)
+
+def play_turns(game, rng, result):
+    """Play game until it finishes, adding to result"""
+    while not game.finished:
+        start = time.time()
+        with count_queries() as queries:
+            for player in game.player_set.order_by('pk'):
+                player.play(*rng.choice(legal_moves(player)))
+            game = Game.objects.get(pk=game.pk)
+        result.seconds += time.time() - start
+        result.queries += queries.count
+        result.turns += 1
+        reset_queries()
+        for player in game.player_set.all():
+            player.score()
+    return game
+
+def simulate(games, min_players, max_players, seed=0, result=None, profile=False, dump_dir=None):
+    """
+    Play games between bots, with min_players to max_players each. Returns
+    a Result with the time and queries spent on turns, and latencies for
+    payment tables, scores and ends of turn, and how many payments were
+    decided without a search (see economy.precheck()). With profile, each
+    game is profiled separately, dumping cProfile stats to dump_dir if
+    given.
+
+    The global random generator is seeded too, as it is used for joining
+    and dealing.
+    """
+    result = result or Result()
+    rng = random.Random(seed)
+    random.seed(seed)
+    stats = result.stats
+    economy.reset_prechecks()
+    with stats.timing(Player, 'payment_table'), stats.timing(Player, 'score'), \
+            stats.timing(Game, 'end_of_turn'), resolver.using(resolver.ImmediateResolver()):
+        for i in range(games):
+            users = [
+                User.objects.create(username='simulate-%d-%d-%d' % (seed, i, j))
+                for j in range(rng.randint(min_players, max_players))
+            ]
+            play_game(users, rng, result, profiling.Profile(dump_dir) if profile or dump_dir else None)
+    result.prechecks.update(economy.prechecks)
+    return result
+
+def cleanup(result):
+    """Delete the games played in result, and their users"""
+    for game in result.games:
+        users = list(User.objects.filter(player__game=game).values_list('pk', flat=True))
+        game.delete()
+        User.objects.filter(pk__in=users).delete()
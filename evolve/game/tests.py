@@ -1,16 +1,1302 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from StringIO import StringIO
 
-Replace this with more appropriate tests for your application.
-"""
+import mock
 
-from django.test import TestCase
+from django.db import connection, DatabaseError
+from django.utils import simplejson
+from django.core.cache import cache
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.core.management import call_command
+from django.contrib.auth.models import User, AnonymousUser
 
+from evolve.base import instrumentation
+from evolve.rules import models as rules, constants, catalog, economy, profiling
+from evolve.game import models, channel, engine, simulation, lobby, resolver, replay, board
+from evolve.game.simulation import count_queries
+from evolve.game.models import Game, Player, GameEvent, GameSnapshot
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+RESOURCES = (('Wood', True), ('Stone', True), ('Ore', True), ('Clay', True), ('Glass', False), ('Paper', False), ('Textile', False))
+SCIENCES = ('Compass', 'Gear', 'Tablet')
+AGES = (('I', 'l', 1), ('II', 'r', 3), ('III', 'l', 5))
+CITIES = 7
+
+def create_cost(money=0, **resources):
+    cost = rules.Cost.objects.create(money=money)
+    for name, amount in resources.items():
+        rules.CostLine.objects.create(cost=cost, amount=amount, resource=rules.Resource.objects.get(name=name))
+    return cost
+
+def create_building(name, kind, age, players_needed=3, cost=None, **effect):
+    """Create a building with its effect and a build option for it"""
+    sciences = effect.pop('sciences', ())
+    kinds_scored = effect.pop('kinds_scored', ())
+    e = rules.Effect.objects.create(**effect)
+    for s in sciences:
+        e.sciences.add(rules.Science.objects.get(name=s))
+    for k in kinds_scored:
+        e.kinds_scored.add(k)
+    building = rules.Building.objects.create(
+        name=name,
+        kind_id=kind,
+        effect=e,
+        cost=cost or create_cost()
+    )
+    rules.BuildOption.objects.create(building=building, age=age, players_needed=players_needed)
+    return building
+
+def create_rules():
+    """
+    A small but complete set of rules: enough options for 7 players in each
+    age, and buildings of every kind
+    """
+    for name, label in rules.KINDS:
+        rules.BuildingKind.objects.create(name=name)
+    for name, is_basic in RESOURCES:
+        rules.Resource.objects.create(name=name, is_basic=is_basic)
+    for name in SCIENCES:
+        rules.Science.objects.create(name=name)
+    variants = [rules.Variant.objects.create(label=label) for label in ('A', 'B')]
+    ages = [
+        rules.Age.objects.create(name=name, order=i, direction=direction, victory_score=score)
+        for i, (name, direction, score) in enumerate(AGES)
+    ]
+    basic = [name for name, is_basic in RESOURCES if is_basic]
+    complex = [name for name, is_basic in RESOURCES if not is_basic]
+    for i in range(CITIES):
+        resource = RESOURCES[i % len(RESOURCES)][0]
+        city = rules.City.objects.create(name='City %d' % i, resource=rules.Resource.objects.get(name=resource))
+        for variant in variants:
+            for order, (cost, effect) in enumerate((
+                    (create_cost(**{resource: 2}), dict(score=3)),
+                    (create_cost(money=2), dict(military=2)),
+                    (create_cost(**{resource: 3}), dict(score=7)))):
+                rules.CitySpecial.objects.create(
+                    city=city, variant=variant, order=order, cost=cost,
+                    effect=rules.Effect.objects.create(**effect))
+    for a, age in enumerate(ages):
+        for i in range(49):
+            name = '%s-%d' % (age.name, i)
+            players_needed = max(3, i//7 + 1) # 21 options for 3 players, 7 more per extra player
+            resource = basic[i % len(basic)] if a == 0 else complex[i % len(complex)]
+            cost = create_cost(money=a, **{resource: a+1}) if i % 3 else None
+            kind = ('bas', 'cpx', 'civ', 'eco', 'sci', 'mil', 'civ')[i % 7]
+            if kind == 'bas':
+                create_building(name, kind, age, players_needed, cost,
+                    production=create_cost(**{basic[i % len(basic)]: 1, basic[(i+1) % len(basic)]: 1}) if i % 2 else create_cost(**{basic[i % len(basic)]: a+1}))
+            elif kind == 'cpx':
+                create_building(name, kind, age, players_needed, cost, production=create_cost(**{complex[i % len(complex)]: 1}))
+            elif kind == 'civ':
+                create_building(name, kind, age, players_needed, cost, score=2+a+i % 3)
+            elif kind == 'eco':
+                if i % 2:
+                    create_building(name, kind, age, players_needed, cost,
+                        trade=create_cost(money=1, **dict((r, 1) for r in basic)), left_trade=True, right_trade=i % 4 == 1)
+                else:
+                    create_building(name, kind, age, players_needed, cost,
+                        production=create_cost(money=3), kind_payed_id='bas', money_per_neighbor_building=1, money_per_local_building=1)
+            elif kind == 'sci':
+                sciences = SCIENCES if i % 5 == 0 else (SCIENCES[i % 3],)
+                create_building(name, kind, age, players_needed, cost, sciences=sciences)
+            else:
+                create_building(name, kind, age, players_needed, cost, military=a+1)
+        # Personalities
+        if a == len(ages)-1:
+            for i in range(10):
+                create_building('Personality %d' % i, rules.PERSONALITY, age, 3, None,
+                    kinds_scored=['civ', 'mil'], score_per_neighbor_building=1, score_per_local_building=i % 2)
+    catalog.invalidate()
+
+def create_game(players=3, start=True):
+    game = Game.objects.create()
+    game.allowed_variants.add(*rules.Variant.objects.all())
+    for i in range(players):
+        game.join(User.objects.create(username='player%d-%d' % (game.pk, i)))
+    if start:
+        game.start()
+    return game
+
+def play_all(game, action=Player.SELL_ACTION):
+    """Every player plays action with its first option"""
+    for p in game.player_set.all():
+        p.play(action, p.current_options.all()[0], 0, 0)
+
+class GameSetUp(object):
+    """Rules and a started game for each test"""
+    players = 3
+
+    def setUp(self):
+        # Game ids are reused between tests, so cached snapshots would be stale
+        cache.clear()
+        # Resolve turns in the test thread, which has the test database
+        self.addCleanup(resolver.set_resolver, resolver.set_resolver(resolver.ImmediateResolver()))
+        create_rules()
+        self.game = create_game(self.players)
+        self.players = list(self.game.player_set.all())
+
+class GameTestCase(GameSetUp, TestCase):
+    pass
+
+class PlayerTest(GameTestCase):
+
+    def test_next_special(self):
+        p = self.players[0]
+        special = p.next_special()
+        self.assertEqual(special.order, 0)
+        p.specials_built = 3
+        self.assertIsNone(p.next_special())
+
+    def test_local_production(self):
+        p = self.players[0]
+        self.assertEqual(p.local_production(), [[(1, p.city.resource.name)]])
+        self.assertEqual(p.local_vectors(), [catalog.get().cities[p.city_id].production])
+        self.assertEqual(p.trade_prices('l'), catalog.get().default_prices)
+
+    def test_payment_options_already_built(self):
+        p = self.players[0]
+        building = rules.Building.objects.get(name='I-2')
+        p.buildings.add(building)
+        self.assertEqual(p.payment_options(catalog.get().buildings[building.pk]), [])
+
+    def test_payment_options_free_having(self):
+        p = self.players[0]
+        building = rules.Building.objects.get(name='II-1')
+        dependency = rules.Building.objects.get(name='I-2')
+        building.free_having.add(dependency)
+        catalog.invalidate()
+        record = catalog.get().buildings[building.pk]
+        self.assertEqual(p.payment_options(record), [])
+        p.buildings.add(dependency)
+        cache.clear() # Buildings are never added during a turn, but we just did
+        p = Player.objects.get(pk=p.pk)
+        self.assertEqual(len(p.payment_options(record)), 1)
+
+    def test_payment_options_trade(self):
+        p = self.players[0]
+        resource = p.right_player().city.resource.name
+        building = create_building('Test', 'civ', rules.Age.first(), cost=create_cost(**{resource: 1}))
+        catalog.invalidate()
+        options = p.payment_options(catalog.get().buildings[building.pk])
+        self.assertEqual(len(options), 1)
+        self.assertIsNotNone(economy.can_pay(options, 0, 2))
+
+    def test_military(self):
+        p = self.players[0]
+        self.assertEqual(p.military(), 0)
+        p.buildings.add(rules.Building.objects.get(name='I-5'))
+        self.assertEqual(self.game.check_counters(), [p.pk]) # Added outside a turn
+        p = Player.objects.get(pk=p.pk)
+        self.assertEqual(p.military(), 1)
+
+    def test_science_score(self):
+        p = self.players[0]
+        self.assertEqual(p.science_score(), 0)
+        p.buildings.add(*rules.Building.objects.filter(name__in=['I-4', 'I-11', 'I-25']))
+        # Gear, Tablet and a wildcard completing the group
+        self.assertEqual(p.science_score(), 10)
+
+    def test_view(self):
+        p = self.players[0]
+        p.buildings.add(*rules.Building.objects.filter(name__in=['I-0', 'I-2', 'I-9']))
+        self.game.check_counters()
+        local, left, right = p.view()
+        self.assertEqual(local.pk, p.pk)
+        self.assertEqual(left.pk, p.left_player().pk)
+        self.assertEqual(right.pk, p.right_player().pk)
+        self.assertEqual(local.count('civ'), p.count('civ'))
+        self.assertEqual(local.count('bas'), 1)
+        self.assertEqual(local.count('mil'), 0)
+        self.assertEqual(local.local_production(), p.local_production())
+        self.assertEqual(local.tradeable_resources(), p.tradeable_resources())
+        self.assertEqual(local.trade_costs('l'), p.trade_costs('l'))
+        self.assertEqual(local.local, tuple(p.local_vectors()))
+        self.assertEqual(local.right_prices, p.trade_prices('r'))
+        self.assertEqual(sorted(e.pk for e in local.active_effects()), sorted(e.pk for e in p.active_effects()))
+
+    def test_views_cached_per_turn(self):
+        views = self.game.player_views()
+        game = Game.objects.get(pk=self.game.pk)
+        with count_queries() as queries:
+            self.assertEqual(game.player_views(), views)
+        self.assertEqual(queries.count, 0)
+        play_all(self.game)
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual([v.money for v in game.player_views()], [v.money+constants.SELL_VALUE for v in views])
+
+    def test_views_cached_per_rules(self):
+        self.game.player_views()
+        # Changed behind the cache, which rules changes invalidate
+        building = rules.Building.objects.get(name='I-5')
+        self.players[0].buildings.add(building)
+        catalog.invalidate() # Like the rules admin does
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertIn(building.pk, game.player_views()[0].buildings)
+
+    def test_views_cached_per_version(self):
+        # Views taken by an instance loaded before its turn was resolved are
+        # not shared with the instances loaded after it
+        stale = Game.objects.get(pk=self.game.pk)
+        play_all(self.game)
+        stale.player_views()
+        # A later change, in a turn numbered like the stale one
+        Player.objects.filter(game=self.game).update(money=0)
+        Game.objects.filter(pk=self.game.pk).update(turn=1)
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual([v.money for v in game.player_views()], [0] * len(self.players))
+
+    def test_score_initial(self):
+        p = self.players[0]
+        self.assertEqual(p.score(), rules.Score.new()._replace(treasury=1))
+
+class ShuffleTest(GameTestCase):
+
+    def hands(self, game):
+        return [
+            sorted(game.player_set.get(pk=pk).current_options.values_list('building__name', flat=True))
+            for pk in game.seat_ids()
+        ]
+
+    def test_dealt(self):
+        dealt = sum(self.hands(self.game), [])
+        self.assertEqual(len(dealt), 3 * constants.INITIAL_OPTIONS)
+        self.assertEqual(len(set(dealt)), len(dealt))
+        self.assertFalse([name for name in dealt if name.startswith('Personality')])
+
+    def test_reproducible(self):
+        other = create_game(3, start=False)
+        other.seed = self.game.seed
+        other.save()
+        other.start()
+        self.assertEqual(self.hands(other), self.hands(self.game))
+        another = create_game(3, start=False)
+        another.seed = self.game.seed + 1
+        another.save()
+        another.start()
+        self.assertNotEqual(self.hands(another), self.hands(self.game))
+
+    def test_personalities(self):
+        for turn in range(2 * constants.TURN_COUNT):
+            play_all(self.game)
+            self.game = Game.objects.get(pk=self.game.pk)
+        dealt = sum(self.hands(self.game), [])
+        personalities = [name for name in dealt if name.startswith('Personality')]
+        self.assertEqual(len(personalities), 2+3)
+
+    def test_queries(self):
+        game = create_game(7, start=False)
+        game.started = True
+        game.seating = ','.join(str(pk) for pk in game.player_set.values_list('pk', flat=True))
+        table = game.load_table()
+        with count_queries() as queries:
+            game.shuffle(table)
+        # Check for empty hands, the insert, the log and the snapshot
+        self.assertEqual(queries.count, 4)
+        self.assertEqual([sorted(s.options) for s in table.seats], [
+            sorted(game.player_set.get(pk=pk).current_options.values_list('pk', flat=True))
+            for pk in game.seat_ids()])
+
+class SeatingTest(GameTestCase):
+    players = 5
+
+    def test_seating(self):
+        order = list(self.game.player_set.order_by('_order').values_list('pk', flat=True))
+        self.assertEqual(self.game.seat_ids(), order)
+        self.assertEqual(Game.objects.get(pk=self.game.pk).seat_ids(), order)
+
+    def test_neighbors(self):
+        game = Game.objects.get(pk=self.game.pk)
+        seats = game.seat_ids()
+        for i, pk in enumerate(seats):
+            p = game.player_set.get(pk=pk)
+            self.assertEqual(p.left_player().pk, seats[i-1])
+            self.assertEqual(p.right_player().pk, seats[(i+1) % len(seats)])
+            self.assertEqual([r.pk for r in p.all_right_players()], [seats[(i+k) % len(seats)] for k in range(1, len(seats)-1)])
+
+    def test_neighbor_queries(self):
+        game = Game.objects.get(pk=self.game.pk)
+        p = game.seated_players()[0]
+        with count_queries() as queries:
+            for other in p.all_right_players():
+                other.left_player().right_player()
+        self.assertEqual(queries.count, 0)
+
+class PaymentTableTest(GameTestCase):
+
+    def count_searches(self):
+        """Wrap engine.search_payments in a mock counting its calls, until the test ends"""
+        patcher = mock.patch.object(engine, 'search_payments', wraps=engine.search_payments)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_table(self):
+        p = self.players[0]
+        table = p.payment_table()
+        rules = catalog.get()
+        options = list(p.current_options.all())
+        self.assertEqual(set(table), set(o.pk for o in options) | set([Player.SPECIAL_PAYMENT]))
+        summary = lambda options: [unicode(po) for po in options]
+        for o in options:
+            self.assertEqual(summary(table[o.pk]), summary(p.payment_options(rules.options[o.pk].building)))
+        self.assertEqual(summary(table[Player.SPECIAL_PAYMENT]), summary(p.payment_options(p.next_special())))
+
+    def test_cached(self):
+        self.players[0].payment_table()
+        calls = self.count_searches()
+        p = Player.objects.get(pk=self.players[0].pk)
+        p.payment_table()
+        self.assertEqual(calls.call_count, 0)
+
+    def test_invalidated_by_money(self):
+        self.players[0].payment_table()
+        calls = self.count_searches()
+        play_all(self.game)
+        p = Player.objects.get(pk=self.players[0].pk)
+        p.payment_table()
+        self.assertNotEqual(calls.call_count, 0)
+
+    def test_invalidated_by_rules(self):
+        self.players[0].payment_table()
+        calls = self.count_searches()
+        catalog.invalidate() # Like the rules admin does
+        Player.objects.get(pk=self.players[0].pk).payment_table()
+        self.assertNotEqual(calls.call_count, 0)
+
+    def test_play_validates_trade(self):
+        p, right = self.players[0], self.players[1]
+        resource = right.city.resource.name
+        building = create_building('Test', 'civ', rules.Age.first(), cost=create_cost(**{resource: 1}))
+        catalog.invalidate()
+        option = rules.BuildOption.objects.get(building=building)
+        p.current_options.add(option)
+        self.assertFalse(p.can_pay(Player.BUILD_ACTION, option, 0, 0))
+        self.assertRaises(AssertionError, p.play, Player.BUILD_ACTION, option, 0, 0)
+        self.assertTrue(p.can_pay(Player.BUILD_ACTION, option, 0, constants.DEFAULT_TRADE_COST))
+        self.assertTrue(p.can_pay(Player.SELL_ACTION, option, 0, 0))
+
+    def test_checks_without_table(self):
+        p = self.players[0]
+        calls = self.count_searches()
+        p.can_build_special()
+        for o in p.current_options.all():
+            p.can_pay(Player.BUILD_ACTION, o, 0, 0)
+        self.assertEqual(calls.call_count, 0)
+        table = Player.objects.get(pk=p.pk).payment_table()
+        self.assertEqual(p.can_build_special(), bool(table[Player.SPECIAL_PAYMENT]))
+        for o in p.current_options.all():
+            for tl, tr in [(0, 0), (0, 2), (2, 0), (1, 1)]:
+                self.assertEqual(p.can_pay(Player.BUILD_ACTION, o, tl, tr), economy.can_pay(table[o.pk], tl, tr) is not None)
+
+class EndOfTurnTest(GameTestCase):
+
+    def reload(self):
+        self.game = Game.objects.get(pk=self.game.pk)
+        self.players = list(self.game.player_set.all())
+
+    def test_sell(self):
+        hands = [list(p.current_options.all()) for p in self.players]
+        play_all(self.game)
+        self.reload()
+        self.assertEqual(self.game.turn, 2)
+        self.assertEqual(self.game.discards.count(), 3)
+        for i, p in enumerate(self.players):
+            self.assertEqual(p.money, constants.INITIAL_MONEY + constants.SELL_VALUE)
+            self.assertEqual(p.action, '')
+            self.assertIsNone(p.option_picked)
+            # Age I passes to the left: the hand comes from the right player
+            passed = hands[(i+1) % len(hands)]
+            self.assertEqual(set(p.current_options.all()), set(passed[1:]))
+
+    def test_build(self):
+        p = self.players[0]
+        option = p.current_options.all()[0]
+        p.current_options.remove(option)
+        free = rules.BuildOption.objects.get(building__name='I-0') # Free basic resource
+        p.current_options.add(free)
+        p.play(Player.BUILD_ACTION, free, 0, 0)
+        for other in self.players[1:]:
+            other.play(Player.SELL_ACTION, other.current_options.all()[0], 0, 0)
+        self.reload()
+        self.assertEqual(list(self.players[0].buildings.all()), [free.building])
+        self.assertEqual(self.players[0].money, constants.INITIAL_MONEY)
+
+    def test_effect_index(self):
+        free = rules.BuildOption.objects.get(building__name='I-0') # Free basic resource
+        self.players[0].current_options.add(free)
+        table = self.game.load_table()
+        for seat in table.seats:
+            seat.action, seat.option_picked = engine.SELL_ACTION, seat.options[0]
+        seat = table.seats[0]
+        seat.action, seat.option_picked = engine.BUILD_ACTION, free.pk
+        table.end_of_turn()
+        self.assertIn(catalog.get().buildings[free.building_id].effect.pk, seat.effect_ids())
+        seat.action, seat.item = engine.SPECIAL_ACTION, seat.next_special()
+        seat.build()
+        self.assertIn(seat.item.effect.pk, seat.effect_ids())
+        for s in table.seats:
+            self.assertEqual(sorted(s.effect_ids()), sorted(engine.PlayerRules.effect_ids(s)))
+        self.assertEqual(engine.snapshot(table)[0].effect_ids(), tuple(seat.effect_ids()))
+
+    def test_trade(self):
+        p, right = self.players[0], self.players[1]
+        resource = right.city.resource.name
+        building = create_building('Test', 'civ', rules.Age.first(), cost=create_cost(**{resource: 1}))
+        catalog.invalidate()
+        option = rules.BuildOption.objects.get(building=building)
+        p.current_options.add(option)
+        p.play(Player.BUILD_ACTION, option, 0, constants.DEFAULT_TRADE_COST)
+        for other in self.players[1:]:
+            other.play(Player.SELL_ACTION, other.current_options.all()[0], 0, 0)
+        self.reload()
+        self.assertEqual(self.players[0].money, constants.INITIAL_MONEY - constants.DEFAULT_TRADE_COST)
+        self.assertEqual(self.players[1].money, constants.INITIAL_MONEY + constants.SELL_VALUE + constants.DEFAULT_TRADE_COST)
+        self.assertIn(building, self.players[0].buildings.all())
+
+    def test_end_of_age(self):
+        for turn in range(constants.TURN_COUNT):
+            play_all(self.game)
+            self.game = Game.objects.get(pk=self.game.pk)
+        self.reload()
+        self.assertEqual(self.game.age, rules.Age.first().next())
+        self.assertEqual(self.game.turn, 1)
+        for p in self.players:
+            self.assertEqual(p.current_options.count(), constants.INITIAL_OPTIONS)
+
+    def test_battles(self):
+        p = self.players[0]
+        p.buildings.add(rules.Building.objects.get(name='I-5')) # Military 1
+        for turn in range(constants.TURN_COUNT):
+            play_all(self.game)
+            self.game = Game.objects.get(pk=self.game.pk)
+        results = set(models.BattleResult.objects.values_list('owner', 'direction', 'result', 'age'))
+        age = rules.Age.first().pk
+        self.assertEqual(results, set([
+            (p.pk, 'l', 'v', age), (p.pk, 'r', 'v', age),
+            (p.left_player().pk, 'r', 'd', age), (p.right_player().pk, 'l', 'd', age),
+        ]))
+        self.assertEqual(self.game.discards.count(), 3 * constants.INITIAL_OPTIONS)
+
+class CountersTest(GameTestCase):
+
+    def test_initial(self):
+        for p in self.players:
+            self.assertEqual(p.counters.as_counters(), engine.Counters((), 0, 0, 0, 0))
+
+    def test_build(self):
+        p = self.players[0]
+        military = rules.BuildOption.objects.get(building__name='I-33') # Free
+        p.current_options.add(military)
+        p.play(Player.BUILD_ACTION, military, 0, 0)
+        for other in self.players[1:]:
+            other.play(Player.SELL_ACTION, other.current_options.all()[0], 0, 0)
+        p = Player.objects.get(pk=p.pk)
+        self.assertEqual(p.count('mil'), 1)
+        self.assertEqual(p.military(), 1)
+        self.assertEqual(list(models.PlayerCounters.objects.filter(mil_buildings=1).values_list('player', flat=True)), [p.pk])
+        self.assertEqual(self.game.check_counters(fix=False), [])
+
+    def test_every_kind(self):
+        for kind, label in rules.KINDS:
+            models.PlayerCounters._meta.get_field(models.PlayerCounters.KIND_FIELDS[kind])
+
+    def test_end_of_age(self):
+        p = self.players[0]
+        p.buildings.add(rules.Building.objects.get(name='I-5'))
+        self.game.check_counters()
+        for turn in range(constants.TURN_COUNT):
+            play_all(self.game)
+            self.game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(Player.objects.get(pk=p.pk).victories(), 2)
+        self.assertEqual(p.left_player().defeats(), 1)
+        self.assertEqual(self.game.check_counters(fix=False), [])
+
+    def test_missing(self):
+        p = self.players[0]
+        p.buildings.add(rules.Building.objects.get(name='I-5'))
+        self.game.check_counters()
+        models.PlayerCounters.objects.filter(player=p).delete()
+        p = Player.objects.get(pk=p.pk)
+        self.assertEqual(p.military(), 1)
+        self.assertEqual(p.count('mil'), 1)
+        # Reading doesn't rebuild them, the command does
+        self.assertEqual(self.game.check_counters(fix=False), [p.pk])
+        call_command('checkcounters', stdout=StringIO())
+        self.assertEqual(self.game.check_counters(fix=False), [])
+
+    def test_command(self):
+        models.PlayerCounters.objects.filter(player=self.players[0]).update(military=5)
+        out = StringIO()
+        call_command('checkcounters', stdout=out)
+        self.assertIn('1 players with wrong counters', out.getvalue())
+        self.assertEqual(self.game.check_counters(fix=False), [])
+
+class ScoreboardTest(GameTestCase):
+
+    def finish(self):
+        for turn in range(len(AGES) * constants.TURN_COUNT):
+            play_all(self.game)
+            self.game = Game.objects.get(pk=self.game.pk)
+        self.assertTrue(self.game.finished)
+
+    def test_scoreboard(self):
+        self.players[0].buildings.add(*rules.Building.objects.filter(name__in=['I-2', 'I-3', 'I-4', 'I-5']))
+        self.game.check_counters()
+        cache.clear()
+        board = Game.objects.get(pk=self.game.pk).scoreboard()
+        self.assertEqual([pk for pk, score in board], self.game.seat_ids())
+        for pk, score in board:
+            self.assertEqual(score, Player.objects.get(pk=pk).score())
+
+    def test_final_scores(self):
+        self.finish()
+        self.assertNotIn(self.game.pk, channel.get_broker().versions)
+        self.assertTrue(channel.version(self.game.pk) > 0)
+        stored = [(s.player_id, s.as_score()) for s in self.game.final_scores()]
+        self.assertEqual(stored, self.game.scoreboard())
+        for pk, score in stored:
+            self.assertEqual(models.FinalScore.objects.get(player=pk).total, score.total())
+
+    def test_views(self):
+        self.finish()
+        p = self.players[0]
+        p.user.set_password('secret')
+        p.user.save()
+        self.client.login(username=p.user.username, password='secret')
+        with count_queries() as queries:
+            response = self.client.get('/game/%d/score/' % self.game.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<td>%d</td>' % p.final_score.total)
+        self.assertLessEqual(queries.count, 4) # Session, user, game and scores
+        response = self.client.get('/game/')
+        self.assertContains(response, '%s (%d)' % (p.user, p.final_score.total))
+
+class ProjectedScoreTest(GameTestCase):
+    players = 4
+
+    def projected(self, game):
+        return [(s.player_id, s.as_score()) for s in game.projected_scores()]
+
+    def test_initial(self):
+        self.assertEqual(self.projected(self.game), self.game.scoreboard())
+
+    def test_random_game(self):
+        rng = random.Random(0)
+        game = self.game
+        while not game.finished:
+            for p in game.player_set.order_by('pk'):
+                p.play(*rng.choice(simulation.legal_moves(p)))
+            game = Game.objects.get(pk=game.pk)
+            self.assertEqual(self.projected(game), game.scoreboard())
+        self.assertEqual(self.projected(game), [(s.player_id, s.as_score()) for s in game.final_scores()])
+
+    def test_dependent(self):
+        p = self.players[0]
+        dependent = rules.Score(0, 0, 0, 2, 1, 0, 3)
+        models.ProjectedScore.objects.filter(player=p).delete()
+        models.ProjectedScore.of(p.pk, dependent, dependent).save()
+        stored = models.ProjectedScore.objects.get(dependent_personality=3)
+        self.assertEqual(stored.player_id, p.pk)
+        self.assertEqual(stored.dependent_score(), dependent)
+
+    def test_rebuilt_when_missing(self):
+        p = self.players[0]
+        p.buildings.add(*rules.Building.objects.filter(name__in=['I-2', 'I-4', 'I-9']))
+        models.ProjectedScore.objects.filter(player=p).delete()
+        play_all(self.game)
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(self.projected(game), game.scoreboard())
+
+    def test_view(self):
+        response = self.client.get('/game/%d/ajax/scores.json' % self.game.pk)
+        data = simplejson.loads(response.content)
+        self.assertEqual([row['player'] for row in data], self.game.seat_ids())
+        self.assertEqual(data[0]['treasury'], constants.INITIAL_MONEY // 3)
+        self.assertEqual(data[0]['total'], constants.INITIAL_MONEY // 3)
+
+class BattlesTest(TestCase):
+
+    def test_battles(self):
+        self.assertEqual(engine.battles([1, 1, 1]), [])
+        self.assertEqual(engine.battles([2, 1, 1]), [(0, 'l', 'v'), (0, 'r', 'v'), (1, 'l', 'd'), (2, 'r', 'd')])
+
+    def test_large_table(self):
+        rng = random.Random(0)
+        strengths = [rng.randint(0, 5) for _ in range(24)]
+        expected = []
+        for i, own in enumerate(strengths):
+            for direction, other in (('l', strengths[i-1]), ('r', strengths[(i+1) % 24])):
+                if own != other:
+                    expected.append((i, direction, 'v' if own > other else 'd'))
+        self.assertEqual(engine.battles(strengths), sorted(expected))
+
+class EndOfTurnQueriesTest(GameTestCase):
+    players = 7
+
+    def prepare(self):
+        for i, p in enumerate(self.game.player_set.all()):
+            p.money = i # So every player needs a different update
+            p.action = Player.SELL_ACTION
+            p.option_picked = p.current_options.all()[0]
+            p.save()
+        catalog.get()
+
+    def test_query_budget(self):
+        self.prepare()
+        with count_queries() as queries:
+            self.game.end_of_turn()
+        self.assertLessEqual(queries.count, models.END_OF_TURN_QUERIES + 7*models.END_OF_TURN_QUERIES_PER_PLAYER)
+
+    def test_end_of_age_query_budget(self):
+        self.prepare()
+        Game.objects.filter(pk=self.game.pk).update(turn=constants.TURN_COUNT)
+        game = Game.objects.get(pk=self.game.pk)
+        with count_queries() as queries:
+            game.end_of_turn()
+        self.assertEqual(game.turn, 1)
+        self.assertLessEqual(queries.count, models.END_OF_TURN_QUERIES + 7*models.END_OF_TURN_QUERIES_PER_PLAYER + models.END_OF_AGE_QUERIES)
+
+class ConcurrentPlayTest(GameTestCase):
+    players = 4
+
+    def test_play_twice(self):
+        p = self.players[0]
+        options = list(p.current_options.all())
+        stale = Player.objects.get(pk=p.pk) # Loaded before playing, like a second request
+        self.assertTrue(p.play(Player.SELL_ACTION, options[0], 0, 0))
+        self.assertFalse(stale.play(Player.SELL_ACTION, options[1], 0, 0))
+        self.assertEqual(Player.objects.get(pk=p.pk).option_picked, options[0])
+
+    def test_end_of_turn_once(self):
+        stale = Game.objects.get(pk=self.game.pk)
+        play_all(self.game)
+        self.assertFalse(stale.end_of_turn())
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual((game.turn, game.version), (2, 1))
+
+    def test_play_after_turn(self):
+        # Submitted for a turn resolved meanwhile
+        stale = Player.objects.select_related('game').get(pk=self.players[0].pk)
+        play_all(self.game)
+        self.assertFalse(stale.play(Player.SELL_ACTION, stale.current_options.all()[0], 0, 0))
+        self.assertEqual(Game.objects.get(pk=self.game.pk).missing_players().count(), 4)
+
+    def test_turn_check_with_stale_game(self):
+        stale = Game.objects.get(pk=self.game.pk)
+        play_all(self.game)
+        with resolver.using(DeferredResolver()):
+            play_all(self.game)
+        self.assertTrue(stale.turn_check())
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual((game.turn, game.version), (3, 2))
+
+class ConcurrentTurnTest(GameSetUp, TransactionTestCase):
+    """
+    Submissions from several threads at once, each with its own database
+    connection like concurrent requests (so the test database is a file,
+    see settings.DATABASES)
+    """
+    players = 4
+
+    def run_threads(self, function, arguments):
+        """Call function with each item of arguments at once, in threads. Returns the results and errors"""
+        start = threading.Event()
+        results, errors = [], []
+        def run(*args):
+            start.wait()
+            try:
+                results.append(function(*args))
+            except Exception, e:
+                errors.append(e)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=run, args=args) for args in arguments]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        return results, errors
+
+    def test_simultaneous_end_of_turn(self):
+        with resolver.using(DeferredResolver()):
+            play_all(self.game)
+        stale = [(Game.objects.get(pk=self.game.pk),) for _ in range(4)]
+        results, errors = self.run_threads(Game.end_of_turn, stale)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(results), [False, False, False, True])
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual((game.turn, game.version), (2, 1))
+        self.assertEqual(game.discards.count(), 4)
+        self.assertEqual(game.missing_players().count(), 4)
+
+    def test_simultaneous_plays(self):
+        # Every player but the first submits three times at once; the last
+        # one recorded resolves the turn
+        first = self.players[0]
+        first.play(Player.SELL_ACTION, first.current_options.all()[0], 0, 0)
+        submissions = []
+        for p in self.players[1:]:
+            option = p.current_options.all()[0]
+            for _ in range(3):
+                submissions.append((Player.objects.get(pk=p.pk), option))
+        def play(player, option):
+            return player.pk, player.play(Player.SELL_ACTION, option, 0, 0)
+        results, errors = self.run_threads(play, submissions)
+        self.assertEqual(errors, [])
+        for p in self.players[1:]:
+            self.assertEqual(sorted(ok for pk, ok in results if pk == p.pk), [False, False, True])
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual((game.turn, game.version), (2, 1))
+        self.assertEqual(game.discards.count(), 4)
+        self.assertEqual(game.missing_players().count(), 4)
+
+class DeferredResolver(object):
+    """Resolver keeping the work submitted, for running it later"""
+
+    def __init__(self):
+        self.work = []
+
+    def submit(self, key, function, *args):
+        self.work.append((key, function, args))
+
+class ResolverTest(GameTestCase):
+
+    def test_deferred(self):
+        deferred = DeferredResolver()
+        with resolver.using(deferred):
+            play_all(self.game)
+        self.assertEqual(Game.objects.get(pk=self.game.pk).turn, 1)
+        self.assertEqual(len(deferred.work), 1)
+        key, function, args = deferred.work[0]
+        self.assertEqual(key, ('turn', self.game.pk))
+        version = channel.version(self.game.pk)
+        self.assertTrue(function(*args))
+        self.assertTrue(channel.version(self.game.pk) > version)
+        self.assertFalse(function(*args)) # Already resolved
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual((game.turn, game.version), (2, 1))
+
+    def test_resolve_missing_players(self):
+        self.assertFalse(models.resolve_turn(self.game.pk))
+        self.assertEqual(Game.objects.get(pk=self.game.pk).turn, 1)
+
+    def test_thread_resolver(self):
+        pool = resolver.ThreadResolver(workers=1)
+        release = threading.Event()
+        done = []
+        pool.submit('blocked', release.wait) # Keeps the only worker busy
+        for i in range(3):
+            pool.submit('work', done.append, i) # Waiting in the queue after the first time
+        pool.submit('other', done.append, 'other')
+        release.set()
+        pool.join()
+        self.assertEqual(sorted(done), [0, 'other'])
+        pool.submit('work', done.append, 1)
+        pool.join()
+        self.assertEqual(sorted(done), [0, 1, 'other'])
+
+    def test_thread_resolver_retries(self):
+        pool = resolver.ThreadResolver(workers=1, retries=2, retry_delay=0.01)
+        calls = []
+        def flaky(fails):
+            calls.append(fails)
+            if len(calls) <= fails:
+                raise ValueError('failure %d' % len(calls))
+        pool.submit('flaky', flaky, 2)
+        pool.join()
+        self.assertEqual(len(calls), 3) # Failed twice, then succeeded
+        del calls[:]
+        pool.submit('failing', flaky, 5)
+        pool.join()
+        self.assertEqual(len(calls), 3) # Gave up after the retries
+
+class ThreadResolverTurnTest(GameSetUp, TransactionTestCase):
+
+    def test_retried_turn(self):
+        pool = resolver.ThreadResolver(workers=1, retry_delay=0.01)
+        end_of_turn = Game.end_of_turn
+        failures = []
+        def failing_once(game):
+            if not failures:
+                failures.append(game.pk)
+                raise DatabaseError('connection lost')
+            return end_of_turn(game)
+        with mock.patch.object(Game, 'end_of_turn', failing_once):
+            with resolver.using(pool):
+                play_all(self.game)
+                pool.join()
+        self.assertEqual(failures, [self.game.pk])
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(game.turn, 2)
+        self.assertEqual(game.missing_players().count(), 3)
+
+class ReplayTest(GameTestCase):
+
+    def play_turns(self, turns, rng):
+        for _ in range(turns):
+            for p in self.game.player_set.order_by('pk'):
+                p.play(*rng.choice(simulation.legal_moves(p)))
+        self.game = Game.objects.get(pk=self.game.pk)
+
+    def live(self):
+        return replay.comparable(self.game.load_table())
+
+    def test_log(self):
+        kinds = list(GameEvent.objects.filter(game=self.game).values_list('kind', flat=True))
+        self.assertEqual(kinds, [GameEvent.JOIN]*3 + [GameEvent.START, GameEvent.DEAL])
+        p = self.players[0]
+        option = p.current_options.all()[0]
+        p.play(Player.SELL_ACTION, option, 0, 0)
+        event = GameEvent.objects.filter(game=self.game).reverse()[0]
+        self.assertEqual((event.kind, event.player_id, event.turn), (GameEvent.PLAY, p.pk, 1))
+        self.assertEqual(event.values(), {'action': Player.SELL_ACTION, 'option': option.pk, 'trade_left': 0, 'trade_right': 0})
+        self.assertEqual(GameSnapshot.objects.filter(game=self.game).count(), 1)
+
+    def test_state(self):
+        table = self.game.load_table()
+        self.assertEqual(engine.snapshot(engine.Table.from_state(table.state())), engine.snapshot(table))
+
+    def test_replay_turn(self):
+        rng = random.Random(0)
+        self.play_turns(2, rng)
+        at_turn_3 = self.live()
+        self.play_turns(2, rng)
+        with count_queries() as queries:
+            table = replay.replay(self.game.pk, self.game.age_id, 3)
+        self.assertEqual(queries.count, 3) # Snapshots, the snapshot and the events
+        self.assertEqual(replay.comparable(table), at_turn_3)
+        self.assertEqual(replay.comparable(replay.replay(self.game.pk)), self.live())
+        self.assertIsNone(replay.replay(self.game.pk, self.game.age_id, 6))
+
+    def test_replay_plays(self):
+        p = self.players[0]
+        p.play(Player.SELL_ACTION, p.current_options.all()[0], 0, 0)
+        table = replay.replay(self.game.pk)
+        self.assertEqual(table.seats[0].state(), self.game.load_table().seats[0].state())
+        self.assertEqual(replay.replay(self.game.pk, self.game.age_id, 1).seats[0].action, '')
+
+    def test_replay_game(self):
+        game = simulation.play_turns(self.game, random.Random(0), simulation.Result())
+        self.assertTrue(game.finished)
+        self.assertEqual(GameSnapshot.objects.filter(game=game).count(), 4)
+        self.game = game
+        for first in (False, True):
+            table = replay.replay(game.pk, first=first)
+            self.assertEqual(replay.comparable(table), self.live())
+            self.assertEqual([s.running for s in table.seats], [s.as_score() for s in game.final_scores()])
+        second_age = rules.Age.objects.get(order=1)
+        self.assertEqual([sorted(s.options) for s in replay.replay(game.pk, second_age.pk, 1, first=True).seats],
+            [sorted(s.options) for s in replay.replay(game.pk, second_age.pk, 1).seats])
+
+    def test_command(self):
+        simulation.play_turns(self.game, random.Random(0), simulation.Result())
+        out = StringIO()
+        call_command('replaygames', str(self.game.pk), stdout=out)
+        self.assertIn('games: 1 turns: %d' % (3 * constants.TURN_COUNT), out.getvalue())
+        self.assertIn('0 games replay differently', out.getvalue())
+
+class CacheBrokerTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.broker = channel.CacheBroker()
+
+    def test_notify(self):
+        self.assertEqual(self.broker.version(1), 0)
+        self.broker.notify(1)
+        self.broker.notify(1)
+        self.assertEqual(self.broker.version(1), 2)
+        self.assertEqual(self.broker.version(2), 0)
+
+    def test_versions_kept(self):
+        self.broker.notify(1)
+        later = time.time() + 24 * 60 * 60 # Well past the cache default timeout
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(self.broker.version(1), 1)
+
+class LocalBrokerTest(TestCase):
+
+    def setUp(self):
+        self.broker = channel.LocalBroker()
+
+    def test_notify(self):
+        self.assertEqual(self.broker.version(1), 0)
+        self.broker.notify(1)
+        self.assertEqual(self.broker.version(1), 1)
+        self.assertEqual(self.broker.version(2), 0)
+
+    def test_wait_timeout(self):
+        self.assertEqual(self.broker.wait(1, 0, 0.01), 0)
+
+    def test_finished(self):
+        self.broker.FINISHED_KEPT = 2
+        self.broker.notify(1)
+        self.broker.notify(1, final=True)
+        self.assertEqual(self.broker.versions, {})
+        self.assertEqual(self.broker.version(1), 2)
+        self.assertEqual(self.broker.wait(1, 1, 10), 2)
+        for game_id in (2, 3):
+            self.broker.notify(game_id, final=True)
+        self.assertEqual(self.broker.finished.keys(), [2, 3])
+        self.assertEqual(self.broker.version(1), 0)
+
+    def test_wait_changed(self):
+        self.broker.notify(1)
+        self.assertEqual(self.broker.wait(1, 0, 10), 1)
+
+    def test_wait_notified(self):
+        timer = threading.Timer(0.05, self.broker.notify, [1])
+        timer.start()
+        self.assertEqual(self.broker.wait(1, 0, 10), 1)
+        timer.join()
+
+class WaitPlayersViewTest(GameTestCase):
+
+    def get(self, **params):
+        response = self.client.get('/game/%d/ajax/wait-players.json' % self.game.pk, params)
+        self.assertEqual(response.status_code, 200)
+        return simplejson.loads(response.content)
+
+    def test_initial(self):
+        data = self.get()
+        self.assertEqual(data['version'], channel.version(self.game.pk))
+        self.assertEqual(data['players'], [])
+
+    def test_unchanged(self):
+        version = self.get()['version']
+        with count_queries() as queries:
+            data = self.get(version=version, timeout=0)
+        self.assertEqual(data, {'version': version})
+        self.assertEqual(queries.count, 0)
+
+    def test_play_notifies(self):
+        version = self.get()['version']
+        p = self.players[0]
+        p.play(Player.SELL_ACTION, p.current_options.all()[0], 0, 0)
+        data = self.get(version=version, timeout=0)
+        self.assertTrue(data['version'] > version)
+        self.assertEqual(data['players'], [p.pk])
+
+    @override_settings(GAME_CHANNEL_TIMEOUT=0.1)
+    def test_invalid_timeout(self):
+        # Nothing changes, so they wait for the longest timeout at most
+        version = self.get()['version']
+        for timeout in ('nan', 'inf', '-inf', '-5', 'soon'):
+            start = time.time()
+            self.assertEqual(self.get(version=version, timeout=timeout), {'version': version})
+            self.assertLess(time.time() - start, 2)
+
+    def test_wait_for_play(self):
+        version = self.get()['version']
+        timer = threading.Timer(0.05, channel.notify, [self.game.pk])
+        timer.start()
+        data = self.get(version=version, timeout=10)
+        timer.join()
+        self.assertEqual(data['version'], version+1)
+        self.assertIn('players', data)
+
+class SimulateTest(GameTestCase):
+
+    def test_legal_moves(self):
+        p = self.players[0]
+        moves = simulation.legal_moves(p)
+        self.assertIn((Player.SELL_ACTION, p.current_options.all()[0], 0, 0), moves)
+        for move in moves:
+            self.assertTrue(p.can_pay(*move))
+
+    def test_simulate(self):
+        result = simulation.simulate(1, 3, 3, seed=1)
+        game = result.games[0]
+        self.assertTrue(Game.objects.get(pk=game.pk).finished)
+        self.assertEqual(result.turns, len(AGES) * constants.TURN_COUNT)
+        self.assertEqual(len(result.stats.samples['end_of_turn']), result.turns)
+        simulation.cleanup(result)
+        self.assertFalse(Game.objects.filter(pk=game.pk).exists())
+        self.assertFalse(User.objects.filter(username__startswith='simulate-').exists())
+
+    def test_command(self):
+        out = StringIO()
+        call_command('simulate', games=1, min_players=3, max_players=4, stdout=out)
+        self.assertIn('turns/sec', out.getvalue())
+        self.assertIn('end_of_turn', out.getvalue())
+        self.assertIn('without search', out.getvalue())
+
+    def test_command_no_games(self):
+        err = StringIO()
+        with self.assertRaises(SystemExit):
+            call_command('simulate', games=0, stdout=StringIO(), stderr=err)
+        self.assertIn('At least one game', err.getvalue())
+
+    def test_percentile_no_samples(self):
+        self.assertIsNone(simulation.Stats().percentile('score', 50))
+
+    def test_profile(self):
+        dump_dir = tempfile.mkdtemp()
+        try:
+            result = simulation.simulate(1, 3, 3, seed=1, profile=True, dump_dir=dump_dir)
+            game, profile = result.profiles[0]
+            self.assertEqual(profile.calls['Game.end_of_turn'], result.turns)
+            self.assertGreater(profile.calls['economy.vector_payments'], 0)
+            self.assertGreater(profile.searches['count'], 0)
+            self.assertEqual(len(profile.dumps), result.turns)
+            self.assertIn('game-%d-age-1-turn-1.pstats' % game.pk, os.listdir(dump_dir))
+            simulation.cleanup(result)
+        finally:
+            shutil.rmtree(dump_dir)
+
+    def test_command_profile(self):
+        out = StringIO()
+        call_command('simulate', games=1, min_players=3, max_players=3, profile=True, stdout=out)
+        self.assertIn('Game.end_of_turn', out.getvalue())
+        self.assertIn('payment searches', out.getvalue())
+
+class LobbyTest(GameTestCase):
+
+    def setUp(self):
+        super(LobbyTest, self).setUp()
+        self.user = self.players[0].user
+        self.open = create_game(1, start=False)
+        self.full = create_game(CITIES, start=False)
+        self.started = create_game(3)
+        self.finished = []
+        for i in range(3):
+            game = create_game(0, start=False)
+            game.join(self.user)
+            Game.objects.filter(pk=game.pk).update(finished=True)
+            self.finished.append(game)
+
+    def test_lobby(self):
+        context = lobby.lobby(self.user)
+        self.assertEqual(context['my_games'], [self.game])
+        self.assertEqual(context['open_games'], [self.open])
+        self.assertEqual(context['started_games'], [self.started])
+        mine = context['my_games'][0]
+        self.assertEqual(mine.player_count, 3)
+        self.assertEqual(mine.player_names, [p.user.username for p in self.game.player_set.order_by('_order')])
+        self.assertEqual(mine.current_age.pk, self.game.age_id)
+        self.assertFalse(mine.startable)
+        self.assertEqual(context['open_games'][0].variants, list(rules.Variant.objects.all()))
+        self.assertEqual(context['finished_games'], self.finished[::-1])
+
+    def test_anonymous(self):
+        context = lobby.lobby(AnonymousUser())
+        self.assertEqual(context['my_games'], [])
+        self.assertEqual(context['open_games'], [self.open])
+        self.assertEqual(context['started_games'], [self.game, self.started])
+        self.assertEqual(context['finished_games'], [])
+
+    def test_queries(self):
+        with count_queries() as queries:
+            lobby.lobby(self.user)
+        for i in range(3):
+            create_game(2, start=False)
+            create_game(3)
+        with count_queries() as more_games:
+            lobby.lobby(self.user)
+        self.assertEqual(more_games.count, queries.count)
+        self.assertLessEqual(queries.count, 6)
+
+    def test_pages(self):
+        first, next_before = lobby.finished_page(self.user, page_size=2)
+        self.assertEqual(first, self.finished[:0:-1])
+        self.assertEqual(next_before, self.finished[1].pk)
+        second, next_before = lobby.finished_page(self.user, next_before, page_size=2)
+        self.assertEqual(second, self.finished[:1])
+        self.assertIsNone(next_before)
+
+    def test_games_pages(self):
+        first = lobby.lobby(AnonymousUser(), games_page_size=2)
+        self.assertEqual(first['started_games'], [self.game])
+        self.assertEqual(first['open_games'], [self.open])
+        self.assertEqual(first['next_after'], self.open.pk)
+        second = lobby.lobby(AnonymousUser(), after=first['next_after'], games_page_size=2)
+        self.assertEqual(second['started_games'], [self.started])
+        self.assertEqual(second['open_games'], [])
+        self.assertIsNone(second['next_after'])
+        with count_queries() as queries:
+            lobby.lobby(AnonymousUser(), games_page_size=2)
+        for i in range(3):
+            create_game(2, start=False)
+        with count_queries() as more_games:
+            lobby.lobby(AnonymousUser(), games_page_size=2)
+        self.assertEqual(more_games.count, queries.count)
+
+    def test_cached(self):
+        lobby.cached_lobby(self.user)
+        with count_queries() as queries:
+            lobby.cached_lobby(self.user)
+        self.assertEqual(queries.count, 0)
+        self.open.join(self.user)
+        lobby.forget(self.user)
+        self.assertIn(self.open, lobby.cached_lobby(self.user)['my_games'])
+
+    def test_view(self):
+        self.user.set_password('secret')
+        self.user.save()
+        self.client.login(username=self.user.username, password='secret')
+        response = self.client.get('/game/')
+        self.assertContains(response, self.open.player_set.get().user.username)
+        self.assertNotContains(response, self.full.player_set.all()[0].user.username)
+        self.assertNotContains(response, 'Older games')
+        response = self.client.get('/game/?before=%d' % self.finished[1].pk)
+        self.assertContains(response, 'View', count=1)
+        response = self.client.get('/game/?after=%d' % self.full.pk)
+        self.assertNotContains(response, self.open.player_set.get().user.username)
+        self.assertContains(response, 'Watch', count=1)
+
+class PlayViewTest(GameTestCase):
+    players = 5
+
+    def setUp(self):
+        super(PlayViewTest, self).setUp()
+        user = self.players[0].user
+        user.set_password('secret')
+        user.save()
+        self.assertTrue(self.client.login(username=user.username, password='secret'))
+
+    def test_render(self):
+        response = self.client.get('/game/%d/play/' % self.game.pk)
+        self.assertEqual(response.status_code, 200)
+        for p in self.players[1:]:
+            self.assertContains(response, 'player-info-%d' % p.pk)
+
+class BoardTest(GameTestCase):
+    players = 5
+    maxDiff = None
+
+    def setUp(self):
+        super(BoardTest, self).setUp()
+        user = self.players[0].user
+        user.set_password('secret')
+        user.save()
+        self.assertTrue(self.client.login(username=user.username, password='secret'))
+
+    def reload(self):
+        self.game = Game.objects.get(pk=self.game.pk)
+        return self.game
+
+    def rebuilt(self, game):
+        """Board data of game built from scratch"""
+        game.board = ''
+        game.public_board()
+        return board.decode(game.board)
+
+    def test_public_board(self):
+        b = self.game.public_board()
+        self.assertEqual([s.pk for s in b.seats], self.game.seat_ids())
+        self.assertEqual(b.seats[0].name, self.players[0].user.username)
+        self.assertEqual(b.seats[0].money, constants.INITIAL_MONEY)
+        self.assertEqual(b.seats[0].left_player(), b.seats[-1])
+        self.assertEqual(b.seats[0].all_right_players(), b.seats[1:-1])
+        self.assertEqual(self.reload().board, self.game.board) # Saved
+        with count_queries() as queries:
+            self.reload().public_board()
+        self.assertEqual(queries.count, 1) # Loading the game
+
+    def test_updated_at_end_of_turn(self):
+        self.game.public_board()
+        play_all(self.game)
+        data = board.decode(self.reload().board)
+        self.assertEqual((data['version'], data['turn']), (1, 2))
+        self.assertEqual(data['seats'][0]['money'], constants.INITIAL_MONEY + constants.SELL_VALUE)
+        self.assertEqual(data, self.rebuilt(self.reload()))
+
+    def test_finished(self):
+        game = simulation.play_turns(self.game, random.Random(0), simulation.Result())
+        data = board.decode(game.board)
+        self.assertTrue(data['finished'])
+        self.assertEqual(data, self.rebuilt(Game.objects.get(pk=game.pk)))
+        self.assertTrue(any(s['battles'] for s in data['seats']))
+        seats = game.public_board().seats
+        self.assertEqual([(s.pk, s.score) for s in seats], [(s.player_id, s.as_score()) for s in game.final_scores()])
+        self.assertEqual(
+            [(t.age.pk, t.direction, t.result, t.score()) for t in seats[0].battles],
+            [(r.age_id, r.direction, r.result, r.score()) for r in models.BattleResult.objects.filter(owner=seats[0].pk).order_by('age__order', 'pk')])
+        with count_queries() as queries:
+            response = self.client.get('/game/%d/score/' % game.pk)
+        self.assertContains(response, '<td>%d</td>' % seats[0].score.total())
+        self.assertLessEqual(queries.count, 3) # Session, user and game
+
+    def test_join(self):
+        game = create_game(1, start=False)
+        self.assertEqual(len(game.public_board().seats), 1)
+        self.client.get('/game/%d/watch/' % game.pk)
+        user = User.objects.create(username='late')
+        Game.objects.get(pk=game.pk).join(user)
+        game = Game.objects.get(pk=game.pk)
+        self.assertEqual([s.name for s in game.public_board().seats][1:], ['late'])
+        self.assertContains(self.client.get('/game/%d/watch/' % game.pk), 'late')
+
+    def test_player_info(self):
+        p = self.players[0]
+        p.buildings.add(rules.Building.objects.get(name='I-2'))
+        seat = self.game.public_board().seat(p.pk)
+        player = Player.objects.get(pk=p.pk)
+        for mine, theirs in zip(seat.building_list(), player.building_list()):
+            self.assertEqual((mine['kind'], mine['label'], unicode(mine['effect'])), (theirs['kind'], theirs['label'], unicode(theirs['effect'])))
+        self.assertEqual([s.pk for s in seat.all_specials()], [s.pk for s in player.all_specials()])
+
+    def test_views(self):
+        self.game.public_board()
+        for url in ('play/', 'watch/', 'score/'):
+            with count_queries() as queries:
+                response = self.client.get('/game/%d/%s' % (self.game.pk, url))
+            self.assertEqual(response.status_code, 200)
+            for p in self.players:
+                self.assertContains(response, p.user.username)
+            self.assertLessEqual(queries.count, 20 if url == 'play/' else 3)
+
+class InstrumentationTest(GameTestCase):
+
+    def setUp(self):
+        super(InstrumentationTest, self).setUp()
+        instrumentation.reset()
+        self.user = self.players[0].user
+        self.user.set_password('secret')
+        self.user.save()
+        self.client.login(username=self.user.username, password='secret')
+
+    def test_record(self):
+        self.client.get('/game/')
+        self.client.get('/game/%d/play/' % self.game.pk)
+        self.client.get('/game/%d/ajax/scores.json' % self.game.pk)
+        summary = instrumentation.summary()
+        self.assertEqual(sorted(summary), ['game_ajax_scores', 'game_list', 'game_play'])
+        play = summary['game_play']
+        self.assertEqual(play['count'], 1)
+        self.assertGreater(play['queries']['max'], 0)
+        self.assertGreater(play['template_ms']['max'], 0)
+        self.assertEqual(sum(play['total_ms']['histogram']), 1)
+        self.assertEqual(summary['game_ajax_scores']['template_ms']['max'], 0)
+        self.assertNotIn('cursor', vars(connection))
+
+    def test_not_instrumented(self):
+        self.client.get('/game/%d/' % self.game.pk)
+        self.assertEqual(instrumentation.summary(), {})
+
+    def test_stats_view(self):
+        self.client.get('/game/')
+        response = self.client.get('/instrumentation.json')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('game_list', response.content) # Login page
+        self.user.is_staff = True
+        self.user.save()
+        data = simplejson.loads(self.client.get('/instrumentation.json').content)
+        self.assertEqual(data['views']['game_list']['count'], 1)
+
+    def test_profile(self):
+        response = self.client.get('/game/%d/play/?profile=1' % self.game.pk)
+        self.assertNotIn('X-Profile', response)
+        self.user.is_staff = True
+        self.user.save()
+        cache.clear() # Payment tables
+        response = self.client.get('/game/%d/play/?profile=1' % self.game.pk)
+        data = simplejson.loads(response['X-Profile'])
+        self.assertGreater(data['calls']['economy.vector_payments'], 0)
+        self.assertIsNone(profiling.current())
+        self.assertNotIn('X-Profile', self.client.get('/game/%d/play/' % self.game.pk))
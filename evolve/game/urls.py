@@ -12,6 +12,8 @@ urlpatterns = patterns('evolve.game.views',
     url(r'^(?P<pk>\d+)/watch/$', 'game_watch', name='game-watch'),
     # AJAX views
     url(r'^(?P<pk>\d+)/ajax/waiting-players.json$', 'game_ajax_waiting_players', name='game-ajax-waiting-players'),
+    url(r'^(?P<pk>\d+)/ajax/wait-players.json$', 'game_ajax_wait_players', name='game-ajax-wait-players'),
+    url(r'^(?P<pk>\d+)/ajax/scores.json$', 'game_ajax_scores', name='game-ajax-scores'),
 )
 
 # /1/ : Main game screen, redirects according to state: If game...
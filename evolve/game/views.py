@@ -1,3 +1,6 @@
+import math
+
+from django.conf import settings
 from django.http import HttpResponse
 from django.template.response import TemplateResponse
 from django.views.generic.edit import CreateView, FormView
@@ -6,28 +9,23 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404, redirect
 from django.utils import simplejson
 
+from evolve.rules import catalog
 from evolve.game.models import Game, Player
+from evolve.game import channel, lobby
 from evolve.game.forms import NewGameForm, JoinForm, StartForm, PlayForm
 
 
 def game_list(request):
-    games = Game.objects.filter(finished=False) # Only non finished games   
-    if request.user.is_authenticated():
-        my_games = games.filter(player__user=request.user)
-        open_games = games.exclude(player__user=request.user).filter(started=False)
-        started_games = games.exclude(player__user=request.user).filter(started=True)
-        finished_games = Game.objects.filter(player__user=request.user, finished=True)
+    before = request.GET.get('before', '')
+    after = request.GET.get('after', '')
+    if before.isdigit() or after.isdigit():
+        # Later unfinished games or older finished ones; not cached
+        context = lobby.lobby(request.user,
+            before=int(before) if before.isdigit() else None,
+            after=int(after) if after.isdigit() else None)
     else:
-        my_games = games.none()
-        open_games = games.filter(started=False)
-        started_games = games.filter(started=True)
-        finished_games = games.none()
-    return TemplateResponse(request, 'game/list.html', {
-        'my_games': my_games,
-        'open_games': open_games,
-        'started_games': started_games,
-        'finished_games': finished_games,
-    })
+        context = lobby.cached_lobby(request.user)
+    return TemplateResponse(request, 'game/list.html', context)
 
 class NewGameView(CreateView):
     form_class = NewGameForm
@@ -38,6 +36,7 @@ class NewGameView(CreateView):
         result = super(NewGameView, self).form_valid(form)
         # Join current user to the game
         self.object.join(self.request.user)
+        lobby.forget(self.request.user)
         return result
 
 new_game = login_required(NewGameView.as_view())
@@ -86,6 +85,7 @@ class GameJoinView(GameActionView):
         game = self.object
         if game.is_joinable(self.request.user):
             game.join(self.request.user)
+            lobby.forget(self.request.user)
             return redirect(game.get_absolute_url())
         else:
             return self.form_invalid(form)
@@ -100,6 +100,7 @@ class GameStartView(GameActionView):
         game = self.object
         if game.is_startable and game.get_player(self.request.user) is not None:
             game.start()
+            lobby.forget(self.request.user)
             return redirect(game.get_absolute_url())
         else:
             return self.form_invalid(form)
@@ -114,37 +115,47 @@ class GamePlayView(GameActionView):
         form = super(GamePlayView, self).get_form(form_class)
         player = self.object.get_player(self.request.user)
         # Set build options for the current player
-        form.fields['option'].queryset = player.current_options.all()
+        form.fields['option'].queryset = player.current_options.select_related('building')
         # Remove the free build option if not available
         actions = Player.ACTIONS
         if not player.can_build_free():
             actions = [(value, label) for (value, label) in actions if value != Player.FREE_ACTION]
+        # Compute payments; can_build_special() uses them too
+        table = player.payment_table()
         # remove the build special option if not available
-        if not player.can_build_special():
+        can_build_special = player.can_build_special()
+        if not can_build_special:
             actions = [(value, label) for (value, label) in actions if value != Player.SPECIAL_ACTION]
         form.fields['action'].choices = actions
-        # Compute payments
         payment = [((0,0,0), '---')]
-        for o in player.current_options.all():
-            pay_options = player.payment_options(o.building)
-            for po in pay_options:
+        for o in form.fields['option'].queryset:
+            for po in table[o.pk]:
                 payment.append(((o.id, po.left_trade.cost(), po.right_trade.cost()),u"%s %s" % (o.building, po)))
-        if player.can_build_special():
-            pay_options = player.payment_options(player.next_special())
-            for po in pay_options:
-                payment.append(((-1, po.left_trade.cost(), po.right_trade.cost()),u"%s %s" % ("Special", po)))
+        if can_build_special:
+            for po in table[Player.SPECIAL_PAYMENT]:
+                payment.append(((Player.SPECIAL_PAYMENT, po.left_trade.cost(), po.right_trade.cost()),u"%s %s" % ("Special", po)))
         form.fields['payment'].choices = payment                
         # Add metadata:
         form.player = player
         return form
 
+    def get_context_data(self, **kwargs):
+        result = super(GamePlayView, self).get_context_data(**kwargs)
+        player = result['player_in_game']
+        rules = catalog.get()
+        result['board'] = board = self.object.public_board()
+        result['seat'] = board.seat(player.pk)
+        # The hand is private, so it is not on the board
+        result['hand'] = [rules.options[pk] for pk in player.current_options.values_list('pk', flat=True)]
+        return result
+
     def form_valid(self, form):
         game = self.object
         player = game.get_player(self.request.user)
-        if player.can_play():
-            payment = form.cleaned_data.get('payment')
-            option = form.cleaned_data.get('option')
-            action = form.cleaned_data.get('action')
+        payment = form.cleaned_data.get('payment') or (0,0,0)
+        option = form.cleaned_data.get('option')
+        action = form.cleaned_data.get('action')
+        if player.can_play() and player.can_pay(action, option, payment[1], payment[2]):
             player.play(action, option, payment[1], payment[2])
             return redirect(game.get_absolute_url())
         else:
@@ -158,7 +169,10 @@ class GameWaitView(DetailView):
 
     def get_context_data(self, **kwargs):
         result = super(GameWaitView, self).get_context_data(**kwargs)
-        result['player_in_game'] = self.object.get_player(self.request.user)
+        game = self.object
+        result['player_in_game'] = game.get_player(self.request.user)
+        board = game.public_board()
+        result['missing_players'] = [board.seat(pk) for pk in game.missing_players().values_list('pk', flat=True)]
         return result
 
 game_wait = login_required(GameWaitView.as_view())
@@ -167,16 +181,65 @@ class GameScoreView(DetailView):
     model = Game
     template_name = 'game/score.html'
 
+    def get_context_data(self, **kwargs):
+        result = super(GameScoreView, self).get_context_data(**kwargs)
+        # Final scores once finished, projected ones before
+        result['scores'] = [(s, s.score) for s in self.object.public_board().seats]
+        return result
+
 game_score = GameScoreView.as_view()
 
 class GameWatchView(DetailView):
     model = Game
     template_name = 'game/watch.html'
 
+    def get_context_data(self, **kwargs):
+        result = super(GameWatchView, self).get_context_data(**kwargs)
+        result['board'] = self.object.public_board()
+        return result
+
 game_watch = GameWatchView.as_view()
 
 def game_ajax_waiting_players(request, pk):
     game = get_object_or_404(Game, id=pk)
     result = [player.id for player in game.waiting_players()]
     return HttpResponse(simplejson.dumps(result), mimetype="application/json")
-        
+
+def game_ajax_scores(request, pk):
+    """Projected score of every player, in seating order"""
+    game = get_object_or_404(Game, id=pk)
+    result = []
+    for s in game.projected_scores():
+        score = s.as_score()
+        row = score._asdict()
+        row.update(player=s.player_id, total=score.total())
+        result.append(row)
+    return HttpResponse(simplejson.dumps(result), mimetype="application/json")
+
+def game_ajax_wait_players(request, pk):
+    """
+    Long polling version of game_ajax_waiting_players. Blocks until the game
+    changes from the version given in the request (or for up to timeout
+    seconds), and returns the new version and waiting players. If nothing
+    changed, only the version is returned, and the database is not used.
+    """
+    pk = int(pk)
+    try:
+        seen = int(request.GET['version'])
+    except (KeyError, ValueError):
+        seen, timeout = None, 0
+    else:
+        try:
+            timeout = float(request.GET.get('timeout', settings.GAME_CHANNEL_TIMEOUT))
+        except ValueError:
+            timeout = settings.GAME_CHANNEL_TIMEOUT
+        if math.isnan(timeout) or math.isinf(timeout):
+            timeout = settings.GAME_CHANNEL_TIMEOUT
+        timeout = max(0, min(timeout, settings.GAME_CHANNEL_TIMEOUT))
+    version = channel.wait(pk, seen, timeout)
+    result = {'version': version}
+    if version != seen:
+        game = get_object_or_404(Game, id=pk)
+        result['players'] = [player.id for player in game.waiting_players()]
+    return HttpResponse(simplejson.dumps(result), mimetype="application/json")
+
@@ -7,31 +7,53 @@ from evolve.rules.models import (
     Building, BuildOption
 )
 from evolve.rules.forms import EffectForm
+from evolve.rules import catalog
 
 site=AdminSite('rules')
 
-site.register(BuildingKind)
-site.register(Resource)
-site.register(Science)
-site.register(Variant)
-site.register(Age)
+class RulesAdmin(admin.ModelAdmin):
+    """ModelAdmin that reloads the rules catalog after any change"""
+
+    def save_model(self, request, obj, form, change):
+        super(RulesAdmin, self).save_model(request, obj, form, change)
+        catalog.invalidate()
+
+    def save_related(self, request, form, formsets, change):
+        super(RulesAdmin, self).save_related(request, form, formsets, change)
+        catalog.invalidate()
+
+    def delete_model(self, request, obj):
+        super(RulesAdmin, self).delete_model(request, obj)
+        catalog.invalidate()
+
+    def response_action(self, request, queryset):
+        # Bulk actions (like "delete selected") bypass delete_model
+        result = super(RulesAdmin, self).response_action(request, queryset)
+        catalog.invalidate()
+        return result
+
+site.register(BuildingKind, RulesAdmin)
+site.register(Resource, RulesAdmin)
+site.register(Science, RulesAdmin)
+site.register(Variant, RulesAdmin)
+site.register(Age, RulesAdmin)
 
 class CitySpecialInline(admin.TabularInline):
     model = CitySpecial
 
-class CityAdmin(admin.ModelAdmin):
+class CityAdmin(RulesAdmin):
     inlines = [CitySpecialInline]
     list_display = ('name', 'resource')
 
-class BuildingAdmin(admin.ModelAdmin):
+class BuildingAdmin(RulesAdmin):
     list_display = ('name', 'kind', 'cost','effect')
     list_filter = ('kind',)
 
-class BuildOptionAdmin(admin.ModelAdmin):
+class BuildOptionAdmin(RulesAdmin):
     list_display = ('building', 'players_needed', 'age')
     list_filter = ('players_needed','age')
 
-class EffectAdmin(admin.ModelAdmin):
+class EffectAdmin(RulesAdmin):
     form = EffectForm
 
 admin.site.register(City, CityAdmin)
@@ -41,7 +63,7 @@ admin.site.register(BuildOption, BuildOptionAdmin)
 class CostLineInline(admin.TabularInline):
     model = CostLine
 
-class CostAdmin(admin.ModelAdmin):
+class CostAdmin(RulesAdmin):
     inlines = [CostLineInline]
 
 admin.site.register(Cost, CostAdmin)
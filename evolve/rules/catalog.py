@@ -0,0 +1,438 @@
+"""
+Read-only, in-memory copy of the rules.
+
+Rule models are loaded from fixtures and not changed during play, so the
+game engine reads them from a RulesCatalog instead of following ORM
+relations on every call. The catalog is loaded once per process on first
+use, and reloaded only after the rules admin saves or deletes something (see
+invalidate()). Other processes learn about the change through a stamp kept
+in the Django cache, checked every CHECK_INTERVAL seconds; running several
+processes needs a shared cache backend, as channel.CacheBroker does.
+
+Records are immutable tuples keyed by primary key. Related objects are
+linked directly (a BuildingRecord has its EffectRecord and CostRecord) and
+building kinds are referred by name, which is the BuildingKind primary key.
+
+Resource amounts used by payments (costs, production, trade prices) are
+also kept as resource vectors: tuples of integers indexed by resource
+ordinal, in the order of RulesCatalog.resource_names. They are built once
+here and shared by every player, so payment searches don't convert or copy
+name keyed dicts (see economy.vector_payments()).
+"""
+import collections
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+from evolve.rules import constants
+from evolve.rules.models import (
+    Score, PERSONALITY, KINDS,
+    Resource, Science, Variant, Age, Cost, CostLine, City, Effect, CitySpecial,
+    Building, BuildOption,
+)
+
+KIND_LABELS = dict(KINDS)
+
+
+class ResourceRecord(collections.namedtuple('ResourceRecord', 'pk name is_basic')):
+    __slots__ = ()
+
+    def __unicode__(self):
+        return self.name
+
+
+class ScienceRecord(collections.namedtuple('ScienceRecord', 'pk name')):
+    __slots__ = ()
+
+    def __unicode__(self):
+        return self.name
+
+
+class VariantRecord(collections.namedtuple('VariantRecord', 'pk label')):
+    __slots__ = ()
+
+    def __unicode__(self):
+        return self.label
+
+
+class AgeRecord(collections.namedtuple('AgeRecord', 'pk name order direction victory_score defeat_score')):
+    __slots__ = ()
+
+    def __unicode__(self):
+        return self.name
+
+
+class CostRecord(collections.namedtuple('CostRecord', 'pk money lines vector')):
+    """
+    lines is a tuple of (amount, resource_name), in the order of CostLines,
+    and vector the same amounts as a resource vector
+    """
+    __slots__ = ()
+
+    def items(self):
+        """Same as Cost.items()"""
+        return [name if amount == 1 else u"%d\u00d7%s" % (amount, name) for amount, name in self.lines]
+
+    def __unicode__(self):
+        elements = ["$%d" % self.money] if self.money else []
+        elements.extend(self.items())
+        return ", ".join(elements) if elements else "Free"
+
+    def to_dict(self):
+        """Same as Cost.to_dict()"""
+        result = collections.defaultdict(lambda:0)
+        result['$'] = self.money
+        for amount, resource in self.lines:
+            result[resource] = amount
+        return result
+
+    def to_list(self):
+        """Same as Cost.to_list()"""
+        return list(self.lines)
+
+
+class CityRecord(collections.namedtuple('CityRecord', 'pk name resource production')):
+    """production is the resource vector of one unit of resource"""
+    __slots__ = ()
+
+    def __unicode__(self):
+        return self.name
+
+
+class EffectRecord(collections.namedtuple('EffectRecord', (
+        'pk production score military sciences science_mask '
+        'trade left_trade right_trade '
+        'kind_payed money_per_neighbor_building money_per_local_building '
+        'kinds_scored score_per_neighbor_building score_per_local_building '
+        'money_per_local_special score_per_local_special '
+        'money_per_neighbor_special score_per_neighbor_special '
+        'score_per_neighbor_defeat '
+        'free_building extra_turn use_discards copy_personality'))):
+    """
+    Same fields as Effect. production and trade are CostRecords (or None),
+    sciences is a tuple of science names (and science_mask the same sciences
+    as a bitmask over RulesCatalog.science_names), kind_payed a kind name
+    (or None), and kinds_scored a tuple of kind names
+    """
+    __slots__ = ()
+
+    def get_score(self, local, left, right):
+        """Same as Effect.get_score(), but count() is called with kind names"""
+        result = self.score
+        for k in self.kinds_scored:
+            result += self.score_per_local_building * local.count(k)
+            result += self.score_per_neighbor_building * left.count(k)
+            result += self.score_per_neighbor_building * right.count(k)
+        result += self.score_per_local_special * local.specials()
+        result += self.score_per_neighbor_special * (left.specials() + right.specials())
+        result += self.score_per_neighbor_defeat * (left.defeats() + right.defeats())
+        return result
+
+    def __unicode__(self):
+        """Same as Effect.__unicode__()"""
+        items = []
+        if self.production is not None:
+            if self.production.money > 0:
+                items.append("$%d" % self.production.money)
+            resources = self.production.items()
+            if resources:
+                items.append("/".join(resources))
+        if self.score:
+            items.append("%d pts" % self.score)
+        if self.military:
+            items.append("%d army" % self.military)
+        if self.sciences:
+            items.append("/".join(self.sciences))
+        if self.left_trade or self.right_trade:
+            trade = "< "if self.left_trade else ""
+            trade += "(%d) " % self.trade.money
+            trade += "/".join(self.trade.items())
+            trade += " >" if self.right_trade else ""
+            items.append(trade)
+        kinds_scored = ','.join(KIND_LABELS[k] for k in self.kinds_scored)
+        if self.money_per_local_building:
+            items.append("$%d/%s v" % (self.money_per_local_building, KIND_LABELS[self.kind_payed]))
+        if self.money_per_neighbor_building:
+            items.append("$%d/%s < >" % (self.money_per_neighbor_building, KIND_LABELS[self.kind_payed]))
+        if self.score_per_local_building:
+            items.append("%dpt/%s v" % (self.score_per_local_building, kinds_scored))
+        if self.score_per_neighbor_building:
+            items.append("%dpt/%s < >" % (self.score_per_neighbor_building, kinds_scored))
+        if self.money_per_local_special or self.score_per_local_special:
+            items.append("($%d+%dpt)/Special" % (self.money_per_local_special, self.score_per_local_special))
+        if self.money_per_neighbor_special or self.score_per_neighbor_special:
+            items.append("($%d+%dpt)/Special < >" % (self.money_per_neighbor_special, self.score_per_neighbor_special))
+        if self.score_per_neighbor_defeat:
+            items.append("%dpt/defeat < >" % self.score_per_neighbor_defeat)
+        if self.free_building:
+            items.append("1 Free building per age")
+        if self.extra_turn:
+            items.append("Can build last option")
+        if self.use_discards:
+            items.append("Build one discarded option")
+        if self.copy_personality:
+            items.append("Apply one personality option from a neighbor")
+        return ", ".join(items)
+
+    def money(self, local, left, right):
+        """Same as Effect.money(), but count() is called with kind names"""
+        result = 0
+        if self.production:
+            result += self.production.money
+        if self.money_per_neighbor_building:
+            result += self.money_per_neighbor_building * (left.count(self.kind_payed)+right.count(self.kind_payed))
+        if self.money_per_local_building:
+            result += self.money_per_local_building * local.count(self.kind_payed)
+        if self.money_per_neighbor_special:
+            result += self.money_per_neighbor_special * (left.specials()+right.specials())
+        if self.money_per_local_special:
+            result += self.money_per_local_special * local.specials()
+        return result
+
+
+class CitySpecialRecord(collections.namedtuple('CitySpecialRecord', 'pk city variant order cost effect')):
+    """city and variant are primary keys"""
+    __slots__ = ()
+
+
+class BuildingRecord(collections.namedtuple('BuildingRecord', 'pk name kind effect cost free_having')):
+    """kind is a kind name, free_having a frozenset of building primary keys"""
+    __slots__ = ()
+
+    def score(self, local, left, right):
+        """Same as Building.score()"""
+        amount = self.effect.get_score(local, left, right)
+        if self.kind == 'eco': # FIXME: hardcoded constant
+            return Score.new()._replace(economy=amount)
+        elif self.kind == 'civ': # FIXME: hardcoded constant
+            return Score.new()._replace(civilian=amount)
+        elif self.kind == PERSONALITY:
+            return Score.new()._replace(personality=amount)
+        else:
+            assert amount == 0
+            return Score.new()
+
+    def free_having_records(self):
+        """BuildingRecords of free_having, by name like Building.free_having.all()"""
+        buildings = get().buildings
+        return sorted((buildings[pk] for pk in self.free_having), key=lambda b: b.name)
+
+    def __unicode__(self):
+        return self.name
+
+
+class BuildOptionRecord(collections.namedtuple('BuildOptionRecord', 'pk players_needed building age')):
+    """building is a BuildingRecord, age a primary key"""
+    __slots__ = ()
+
+
+class RulesCatalog(object):
+    """
+    All the rules, loaded in a fixed number of queries.
+
+    Each attribute (resources, sciences, variants, ages, costs, cities,
+    effects, specials, buildings, options) is a dict from primary key to
+    record, except for
+    age_order (AgeRecords sorted by play order), science_names (sorted, the
+    bit order of science masks), resource_names (sorted by primary key, the
+    index order of resource vectors), default_prices (the resource vector of
+    trade prices without discounts), city_specials (tuples of
+    CitySpecialRecords sorted by order, keyed by (city, variant)),
+    age_options (tuples of BuildOptionRecords sorted by primary key, keyed
+    by age) and stamp (the stamp of the rules when loaded, see
+    shared_stamp(), for keying data cached from them)
+    """
+
+    def __init__(self, stamp=None):
+        self.stamp = stamp
+        self.resources = dict(
+            (r.pk, ResourceRecord(r.pk, r.name, r.is_basic))
+            for r in Resource.objects.all())
+        self.resource_names = tuple(self.resources[pk].name for pk in sorted(self.resources))
+        self.default_prices = (constants.DEFAULT_TRADE_COST,) * len(self.resource_names)
+        self.sciences = dict(
+            (s.pk, ScienceRecord(s.pk, s.name))
+            for s in Science.objects.all())
+        self.science_names = tuple(sorted(s.name for s in self.sciences.values()))
+        self.variants = dict(
+            (pk, VariantRecord(pk, label))
+            for pk, label in Variant.objects.values_list('pk', 'label'))
+        self.age_order = tuple(
+            AgeRecord(a.pk, a.name, a.order, a.direction, a.victory_score, a.defeat_score)
+            for a in Age.objects.order_by('order'))
+        self.ages = dict((a.pk, a) for a in self.age_order)
+
+        lines = collections.defaultdict(list)
+        for cost_id, amount, resource_id in CostLine.objects.order_by('resource', 'amount').values_list('cost', 'amount', 'resource'):
+            lines[cost_id].append((amount, self.resources[resource_id].name))
+        self.costs = dict(
+            (pk, CostRecord(pk, money, tuple(lines[pk]), self.vector(lines[pk])))
+            for pk, money in Cost.objects.values_list('pk', 'money'))
+
+        self.cities = dict(
+            (pk, CityRecord(pk, name, self.resources[resource_id], self.vector([(1, self.resources[resource_id].name)])))
+            for pk, name, resource_id in City.objects.values_list('pk', 'name', 'resource'))
+
+        sciences = collections.defaultdict(list)
+        for effect_id, science_id in Effect.sciences.through.objects.values_list('effect', 'science'):
+            sciences[effect_id].append(self.sciences[science_id].name)
+        kinds_scored = collections.defaultdict(list)
+        for effect_id, kind_id in Effect.kinds_scored.through.objects.values_list('effect', 'buildingkind'):
+            kinds_scored[effect_id].append(kind_id)
+        self.effects = {}
+        for e in Effect.objects.all():
+            self.effects[e.pk] = EffectRecord(
+                pk=e.pk,
+                production=self.costs.get(e.production_id),
+                score=e.score,
+                military=e.military,
+                sciences=tuple(sorted(sciences[e.pk])),
+                science_mask=self.science_mask(sciences[e.pk]),
+                trade=self.costs.get(e.trade_id),
+                left_trade=e.left_trade,
+                right_trade=e.right_trade,
+                kind_payed=e.kind_payed_id,
+                money_per_neighbor_building=e.money_per_neighbor_building,
+                money_per_local_building=e.money_per_local_building,
+                kinds_scored=tuple(sorted(kinds_scored[e.pk])),
+                score_per_neighbor_building=e.score_per_neighbor_building,
+                score_per_local_building=e.score_per_local_building,
+                money_per_local_special=e.money_per_local_special,
+                score_per_local_special=e.score_per_local_special,
+                money_per_neighbor_special=e.money_per_neighbor_special,
+                score_per_neighbor_special=e.score_per_neighbor_special,
+                score_per_neighbor_defeat=e.score_per_neighbor_defeat,
+                free_building=e.free_building,
+                extra_turn=e.extra_turn,
+                use_discards=e.use_discards,
+                copy_personality=e.copy_personality,
+            )
+
+        self.specials = {}
+        city_specials = collections.defaultdict(list)
+        for s in CitySpecial.objects.order_by('order'):
+            record = CitySpecialRecord(s.pk, s.city_id, s.variant_id, s.order, self.costs[s.cost_id], self.effects[s.effect_id])
+            self.specials[s.pk] = record
+            city_specials[s.city_id, s.variant_id].append(record)
+        self.city_specials = dict((key, tuple(value)) for key, value in city_specials.items())
+
+        free_having = collections.defaultdict(list)
+        for from_id, to_id in Building.free_having.through.objects.values_list('from_building', 'to_building'):
+            free_having[from_id].append(to_id)
+        self.buildings = dict(
+            (pk, BuildingRecord(pk, name, kind_id, self.effects[effect_id], self.costs[cost_id], frozenset(free_having[pk])))
+            for pk, name, kind_id, effect_id, cost_id in Building.objects.values_list('pk', 'name', 'kind', 'effect', 'cost'))
+
+        self.options = dict(
+            (pk, BuildOptionRecord(pk, players_needed, self.buildings[building_id], age_id))
+            for pk, players_needed, building_id, age_id in BuildOption.objects.values_list('pk', 'players_needed', 'building', 'age'))
+        age_options = collections.defaultdict(list)
+        for pk in sorted(self.options):
+            age_options[self.options[pk].age].append(self.options[pk])
+        self.age_options = dict((key, tuple(value)) for key, value in age_options.items())
+
+    def vector(self, lines):
+        """Resource vector for a list of (amount, resource_name)"""
+        amounts = [0] * len(self.resource_names)
+        for amount, name in lines:
+            amounts[self.resource_names.index(name)] += amount
+        return tuple(amounts)
+
+    def science_mask(self, names):
+        """Bitmask for the given science names"""
+        result = 0
+        for name in names:
+            result |= 1 << self.science_names.index(name)
+        return result
+
+    def first_age(self):
+        """Same as Age.first(), as an AgeRecord"""
+        return self.age_order[0]
+
+    def next_age(self, age_id):
+        """AgeRecord following the given age, None if it is the last one"""
+        order = self.ages[age_id].order
+        for a in self.age_order:
+            if a.order > order:
+                return a
+
+    def deck(self, age_id, players):
+        """
+        Options to deal in an age for the given number of players, as lists
+        of (regular, personality) BuildOptionRecords sorted by primary key
+        """
+        regular, personalities = [], []
+        for o in self.age_options.get(age_id, ()):
+            if o.players_needed <= players:
+                if o.building.kind == PERSONALITY:
+                    personalities.append(o)
+                else:
+                    regular.append(o)
+        return regular, personalities
+
+    def specials_for(self, city_id, variant_id):
+        """Every special for a city/variant, sorted by order"""
+        return self.city_specials.get((city_id, variant_id), ())
+
+    def next_special(self, city_id, variant_id, built):
+        """Special following the built ones, None if all built"""
+        for s in self.specials_for(city_id, variant_id):
+            if s.order >= built:
+                return s
+
+    def built_specials(self, city_id, variant_id, built):
+        """Specials already built, given the count of specials built"""
+        return tuple(s for s in self.specials_for(city_id, variant_id) if s.order < built)
+
+
+# Key of the stamp of the current rules in the cache, replaced by
+# invalidate(). A catalog loaded with another stamp is stale
+STAMP_KEY = 'evolve.rules.catalog.stamp'
+# Seconds the stamp is kept (the longest relative timeout memcached takes);
+# without it, the cache default of 5 minutes applies
+STAMP_TIMEOUT = 30 * 24 * 60 * 60
+# Seconds between checks of the stamp
+CHECK_INTERVAL = 1.0
+
+_catalog = None
+_checked = 0
+_lock = threading.Lock()
+
+def shared_stamp():
+    """The stamp of the current rules, set first if missing"""
+    stamp = cache.get(STAMP_KEY)
+    if stamp is None:
+        cache.add(STAMP_KEY, uuid.uuid4().hex, STAMP_TIMEOUT)
+        stamp = cache.get(STAMP_KEY)
+    return stamp
+
+def get():
+    """
+    The current RulesCatalog, loading it if needed, or if the rules changed
+    in another process
+    """
+    global _catalog, _checked
+    catalog = _catalog
+    now = time.time()
+    if catalog is None or now - _checked >= CHECK_INTERVAL:
+        with _lock:
+            if _catalog is None or now - _checked >= CHECK_INTERVAL:
+                # Read before loading, so changes made meanwhile reload it again
+                stamp = shared_stamp()
+                if _catalog is None or stamp != _catalog.stamp:
+                    _catalog = RulesCatalog(stamp)
+                _checked = now
+            catalog = _catalog
+    return catalog
+
+def invalidate():
+    """
+    Discard the current catalog, in this process and every other one; it
+    will be reloaded on next use
+    """
+    global _catalog
+    cache.set(STAMP_KEY, uuid.uuid4().hex, STAMP_TIMEOUT)
+    with _lock:
+        _catalog = None
@@ -1,3 +1,8 @@
+import collections
+import heapq
+
+from evolve.rules import profiling
+
 class ResourceSet(object):
     def __init__(self):
         self.data = {}
@@ -42,19 +47,344 @@ def empty_cost(cost):
     # returns True if there's something to pay
     return sum(cost.values())==0
 
+def vector(amounts, names):
+    """
+    Resource vector for amounts (a mapping from resource name, or a list of
+    (amount, resource) pairs), as a tuple indexed like names
+    """
+    if not isinstance(amounts, dict):
+        amounts = dict((resource, amount) for amount, resource in amounts)
+    return tuple(amounts.get(name, 0) for name in names)
+
+def vector_pairs(vector, names):
+    """Inverse of vector(): list of (amount, resource) for non zero amounts"""
+    return [(amount, name) for amount, name in zip(vector, names) if amount]
+
 def get_payments(cost, money, local_resources, left_resources, left_costs, right_resources, right_costs):
-    results = get_payments_base(cost, money, local_resources, left_resources, left_costs, right_resources, right_costs)
-    # This sorting order implies that, if an option is "better" than another, the "better" one is on the left
-    results.sort(key=lambda o: (o.left_trade.cost()+o.right_trade.cost(), o.left_trade.cost()))
-    clean_results = []
-    for o in results:
-        for c in clean_results:
-            if c.better_than(o): break
-        else: # If no item in clean_results better than o
-            clean_results.append(o)
-    return clean_results
+    """
+    List of the non dominated ways of paying for cost, cheapest first.
+
+    Arguments are the same as in get_payments_base(), which is kept as the
+    exhaustive reference implementation. They are converted to resource
+    vectors over the resources in cost and solved by vector_payments(),
+    which gives the same (left, right) trade options without enumerating
+    every combination.
+    """
+    names = tuple(sorted(r for r, amount in cost.items() if r != '$' and amount > 0))
+    return vector_payments(
+        names, vector(cost, names), cost.get('$', 0), money,
+        [vector(alternatives, names) for alternatives in local_resources],
+        [vector(alternatives, names) for alternatives in left_resources],
+        tuple(left_costs[name] for name in names),
+        [vector(alternatives, names) for alternatives in right_resources],
+        tuple(right_costs[name] for name in names),
+    )
+
+@profiling.hook('economy.vector_payments')
+def vector_payments(names, cost, price, money, local, left, left_prices, right, right_prices):
+    """
+    Same as get_payments(), with resources as vectors: tuples of integers
+    indexed like names. cost is the resource vector to pay and price the
+    money to pay. local, left and right are lists of production vectors,
+    each one a set of alternatives (any one of its non zero amounts can be
+    used); left_prices and right_prices are the unit trade prices.
+
+    The game passes the vectors precomputed in the rules catalog (see
+    RulesCatalog.resource_names), so nothing is converted per search.
+    Costs decided by precheck() are not searched.
+    """
+    result = precheck(names, cost, price, money, local, left, left_prices, right, right_prices)
+    if result is not None:
+        return result
+    search = PaymentSearch(names, cost, price, money, local, left, left_prices, right, right_prices)
+    result = search.options()
+    profiling.search_done(len(search.memo), search.branches, search.deepest)
+    return result
+
+def iter_payments(names, cost, price, money, local, left, left_prices, right, right_prices, max_left=None, max_right=None):
+    """
+    Generator of the same PaymentOptions as vector_payments(), in the same
+    order, computed as they are consumed (see PaymentSearch.iter_options()).
+    Options paying more than max_left or max_right in trade are skipped.
+    """
+    search = PaymentSearch(names, cost, price, money, local, left, left_prices, right, right_prices)
+    return search.iter_options(max_left, max_right)
+
+@profiling.hook('economy.is_affordable')
+def is_affordable(names, cost, price, money, local, left, left_prices, right, right_prices):
+    """True if vector_payments() would find some way of paying"""
+    result = precheck(names, cost, price, money, local, left, left_prices, right, right_prices)
+    if result is not None:
+        return bool(result)
+    options = iter_payments(names, cost, price, money, local, left, left_prices, right, right_prices)
+    return next(options, None) is not None
+
+@profiling.hook('economy.find_payment')
+def find_payment(names, cost, price, money, local, left, left_prices, right, right_prices, trade_left, trade_right):
+    """
+    Same as can_pay(vector_payments(...), trade_left, trade_right), but
+    only looking at options that pay no more than that in trade
+    """
+    result = precheck(names, cost, price, money, local, left, left_prices, right, right_prices)
+    if result is not None:
+        return can_pay(result, trade_left, trade_right)
+    options = iter_payments(names, cost, price, money, local, left, left_prices, right, right_prices, trade_left, trade_right)
+    for o in options:
+        if o.left_trade.cost() == trade_left and o.right_trade.cost() == trade_right:
+            return o
+
+# Outcomes of precheck()
+IMPOSSIBLE = 'impossible'
+FREE = 'free'
+SEARCH = 'search'
+
+# Count of precheck() outcomes in this process, see reset_prechecks()
+prechecks = collections.Counter()
+
+def precheck(names, cost, price, money, local, left, left_prices, right, right_prices):
+    """
+    Decide a payment from upper bounds, without searching. Arguments are
+    the same as in vector_payments(), and so is the result, if decided:
+     - IMPOSSIBLE: the price is above money, some resource can't be
+       covered even using every alternative of everyone's production, or
+       buying what local production can't cover at the best price
+       available is above money. The result is []
+     - FREE: local productions without alternatives cover the cost. The
+       option paying no trade dominates any other, so it's the only result
+     - SEARCH: none of the above. The result is None
+    Outcomes are counted in prechecks.
+    """
+    outcome, result = _precheck(names, cost, price, money, local, left, left_prices, right, right_prices)
+    prechecks[outcome] += 1
+    return result
+
+def _precheck(names, cost, price, money, local, left, left_prices, right, right_prices):
+    if price > money:
+        return IMPOSSIBLE, []
+    required = [i for i, amount in enumerate(cost) if amount]
+    # Local supply, counting alternatives fully (fixed has only productions
+    # without alternatives)
+    supply = dict((i, 0) for i in required)
+    fixed = dict(supply)
+    for production in local:
+        alternatives = len(production) - production.count(0)
+        for i in required:
+            supply[i] += production[i]
+            if alternatives == 1:
+                fixed[i] += production[i]
+    if all(fixed[i] >= cost[i] for i in required):
+        o = PaymentOption()
+        o.money = price
+        for i in required:
+            o.local.add(names[i], cost[i])
+        return FREE, [o]
+    # Cheapest trade for what local supply can't cover
+    trade = 0
+    for i in required:
+        missing = cost[i] - supply[i]
+        if missing > 0:
+            left_supply = sum(production[i] for production in left)
+            right_supply = sum(production[i] for production in right)
+            if missing > left_supply + right_supply:
+                return IMPOSSIBLE, []
+            trade += missing * min(
+                unit_cost for unit_cost, available in ((left_prices[i], left_supply), (right_prices[i], right_supply))
+                if available)
+    if price + trade > money:
+        return IMPOSSIBLE, []
+    return SEARCH, None
+
+def reset_prechecks():
+    """Forget the counted precheck() outcomes"""
+    prechecks.clear()
+
+def _pareto(candidates):
+    """
+    Keep only the non dominated (left, right, plan) candidates, one per
+    (left, right) pair. A candidate is dominated when another one needs no
+    more money in any direction.
+    """
+    candidates.sort(key=lambda c: (c[0], c[1]))
+    result = []
+    best_right = None
+    for c in candidates:
+        if best_right is None or c[1] < best_right:
+            result.append(c)
+            best_right = c[1]
+    return result
+
+class PaymentSearch(object):
+    """
+    Memoized search for payment options.
+
+    The search walks the production alternatives in a fixed order (local,
+    then left trade, then right trade), and for each state computes the
+    frontier of non dominated (left cost, right cost) ways of finishing the
+    payment. States are canonical (position, remaining cost, usable money)
+    tuples, so equivalent branches are solved once, and dominated partial
+    solutions are dropped as soon as they are found instead of after the
+    full enumeration.
+
+    iter_options() walks the same stages cheapest first instead, for callers
+    that only need the first options.
+    """
+
+    def __init__(self, names, cost, price, money, local, left, left_prices, right, right_prices):
+        # Only resources actually required take part in the search, indexed
+        # by their position in self.resources
+        useful = [i for i, amount in enumerate(cost) if amount > 0]
+        self.resources = tuple(names[i] for i in useful)
+        self.required = tuple(cost[i] for i in useful)
+        self.price = price
+        self.money = money
+        # Stages are (direction, alternatives); alternatives are
+        # (resource_index, amount, unit_cost), keeping only useful resources
+        self.stages = []
+        for direction, productions, prices in (
+                ('local', local, None),
+                ('left', left, left_prices),
+                ('right', right, right_prices)):
+            for production in productions:
+                alternatives = []
+                for index, i in enumerate(useful):
+                    if production[i]:
+                        unit_cost = prices[i] if prices is not None else 0
+                        assert prices is None or unit_cost > 0
+                        alternatives.append((index, production[i], unit_cost))
+                if alternatives:
+                    self.stages.append((direction, tuple(alternatives)))
+        # Most expensive unit price for each resource, used to canonicalize
+        # the available money in memo keys
+        self.max_unit_cost = [0] * len(self.resources)
+        for direction, alternatives in self.stages:
+            for i, amount, unit_cost in alternatives:
+                self.max_unit_cost[i] = max(self.max_unit_cost[i], unit_cost)
+        self.memo = {}
+        # Search size: solve() calls and deepest stage reached
+        self.branches = self.deepest = 0
+
+    def options(self):
+        """List of PaymentOption, sorted as in get_payments()"""
+        if self.price > self.money:
+            return [] # Not enough money
+        frontier = self.solve(0, self.required, self.money - self.price)
+        results = [self.option(plan) for left, right, plan in frontier]
+        results.sort(key=lambda o: (o.left_trade.cost()+o.right_trade.cost(), o.left_trade.cost()))
+        return results
+
+    def option(self, plan):
+        """PaymentOption for a plan (see solve())"""
+        o = PaymentOption()
+        o.money = self.price
+        while plan is not None:
+            (direction, i, amount, pay), plan = plan
+            getattr(o, direction if direction == 'local' else direction + '_trade').add(self.resources[i], amount, pay)
+        return o
+
+    def iter_options(self, max_left=None, max_right=None):
+        """
+        Generate options() lazily, skipping the ones that pay more than
+        max_left or max_right in trade.
+
+        Partial payments (total trade, left trade, position, remaining, plan)
+        are expanded cheapest first from a heap. Paying more never makes
+        (total, left) smaller, so complete payments come out sorted as in
+        options(), and each one can be checked against the ones before it
+        for dominance. Nothing is expanded beyond what the caller consumes.
+        """
+        if self.price > self.money:
+            return # Not enough money
+        budget = self.money - self.price
+        max_left = budget if max_left is None else min(max_left, budget)
+        max_right = budget if max_right is None else min(max_right, budget)
+        heap = [(0, 0, 0, self.required, None)]
+        seen = set()
+        found = []
+        while heap:
+            total, left, position, remaining, plan = heapq.heappop(heap)
+            self.branches += 1
+            if position > self.deepest:
+                self.deepest = position
+            right = total - left
+            if not any(remaining):
+                if not any(l <= left and r <= right for l, r in found):
+                    found.append((left, right))
+                    yield self.option(plan)
+                continue
+            if position == len(self.stages):
+                continue # Can't afford
+            direction, alternatives = self.stages[position]
+            # Without using any of the alternatives, or using each of them
+            steps = [(0, remaining, plan)]
+            for i, amount, unit_cost in alternatives:
+                if not remaining[i]:
+                    continue
+                used_amount = min(amount, remaining[i])
+                if direction == 'local':
+                    purchases = [used_amount]
+                else:
+                    limit = max_left - left if direction == 'left' else max_right - right
+                    purchases = range(1, min(used_amount, (budget - total) // unit_cost, limit // unit_cost)+1)
+                for bought in purchases:
+                    pay = bought * unit_cost
+                    updated = remaining[:i] + (remaining[i]-bought,) + remaining[i+1:]
+                    steps.append((pay, updated, ((direction, i, bought, pay), plan)))
+            for pay, updated, step_plan in steps:
+                state = (total+pay, left+pay if direction == 'left' else left, position+1, updated)
+                if state not in seen:
+                    seen.add(state)
+                    heapq.heappush(heap, state + (step_plan,))
+
+    def solve(self, position, remaining, money):
+        """
+        Frontier of (left, right, plan) ways to pay remaining using stages
+        from position onwards and spending at most money in trade. plan is
+        a linked list of (direction, resource_index, amount, pay) steps.
+        """
+        self.branches += 1
+        if position > self.deepest:
+            self.deepest = position
+        if not any(remaining):
+            return [(0, 0, None)]
+        if position == len(self.stages):
+            return [] # Can't afford
+        # Money beyond what could ever be spent does not change the result
+        money = min(money, sum(r*c for r, c in zip(remaining, self.max_unit_cost)))
+        key = (position, remaining, money)
+        if key in self.memo:
+            return self.memo[key]
+
+        direction, alternatives = self.stages[position]
+        # Ways to pay without using any of the alternatives
+        candidates = list(self.solve(position+1, remaining, money))
+        # Ways to pay using each of the alternatives
+        for i, amount, unit_cost in alternatives:
+            if not remaining[i]:
+                continue
+            used_amount = min(amount, remaining[i])
+            if direction == 'local':
+                purchases = [used_amount]
+            else:
+                purchases = range(1, min(used_amount, money//unit_cost)+1)
+            for bought in purchases:
+                pay = bought * unit_cost
+                updated = remaining[:i] + (remaining[i]-bought,) + remaining[i+1:]
+                step = (direction, i, bought, pay)
+                for left, right, plan in self.solve(position+1, updated, money-pay):
+                    if direction == 'left':
+                        left += pay
+                    elif direction == 'right':
+                        right += pay
+                    candidates.append((left, right, (step, plan)))
+        result = _pareto(candidates)
+        self.memo[key] = result
+        return result
 
+@profiling.hook('economy.get_payments_base') # Calls are branches, depth is recursion depth
 def get_payments_base(cost, money, local_resources, left_resources, left_costs, right_resources, right_costs):
+    # Exhaustive enumeration of every payment combination. Not used by the
+    # game anymore (see PaymentSearch), but kept as reference for tests and
+    # benchmarks. Note that it modifies cost.
     # cost is a dict, {resource_name: required_amount}. It also maps '$' to the needed money
     # money is an int, available money
     # local, left, right resources are lists of lists of (amount, resource). inner lists are alternatives
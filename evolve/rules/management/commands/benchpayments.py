@@ -0,0 +1,125 @@
+import collections
+import random
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from evolve.rules import constants, economy
+
+RESOURCES = ('Brick', 'Glass', 'Ore', 'Paper', 'Stone', 'Textile', 'Wood')
+
+def random_production(rng, size):
+    """A production list ([[(amount, resource)]]) with size items"""
+    result = []
+    for _ in range(size):
+        resources = rng.sample(RESOURCES, rng.choice((1, 1, 2)))
+        result.append([(rng.choice((1, 1, 2)), r) for r in resources])
+    return result
+
+def random_case(rng, size):
+    """Arguments for get_payments with production lists of the given size"""
+    cost = collections.defaultdict(lambda: 0)
+    cost['$'] = rng.choice((0, 0, 1))
+    for r in rng.sample(RESOURCES, 3):
+        cost[r] = rng.randint(1, 3)
+    left_costs = collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST)
+    right_costs = collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST)
+    for r in rng.sample(RESOURCES, 2):
+        left_costs[r] = right_costs[r] = 1
+    return (
+        cost,
+        rng.randint(5, 15),
+        random_production(rng, size),
+        random_production(rng, size),
+        left_costs,
+        random_production(rng, size),
+        right_costs,
+    )
+
+def vector_case(case):
+    """Arguments for economy.vector_payments equivalent to a random_case"""
+    cost, money, local, left, left_costs, right, right_costs = case
+    names = RESOURCES
+    return (
+        names,
+        economy.vector(cost, names),
+        cost['$'],
+        money,
+        [economy.vector(alternatives, names) for alternatives in local],
+        [economy.vector(alternatives, names) for alternatives in left],
+        tuple(left_costs[name] for name in names),
+        [economy.vector(alternatives, names) for alternatives in right],
+        tuple(right_costs[name] for name in names),
+    )
+
+def deep_size(value, seen=None):
+    """Bytes used by value and the containers and numbers inside it"""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(v, seen) for v in value)
+    return size
+
+def exhaustive_payments(cost, *args):
+    """The payment computation before PaymentSearch, for comparison"""
+    results = economy.get_payments_base(collections.defaultdict(lambda: 0, cost), *args)
+    results.sort(key=lambda o: (o.left_trade.cost()+o.right_trade.cost(), o.left_trade.cost()))
+    clean_results = []
+    for o in results:
+        for c in clean_results:
+            if c.better_than(o): break
+        else:
+            clean_results.append(o)
+    return clean_results
+
+def timed(function, cases):
+    """Average time in milliseconds of calling function on each case"""
+    start = time.time()
+    for case in cases:
+        function(*case)
+    return (time.time() - start) * 1000.0 / len(cases)
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark payment option search as production lists grow, with '
+        'resources keyed by name (converted on each search) and as resource '
+        'vectors (converted beforehand, like the rules catalog does)'
+    )
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-size', type='int', default=12,
+            help='Largest production list size to try (default 12)'),
+        make_option('--max-exhaustive-size', type='int', default=5,
+            help='Largest size where the exhaustive search is also timed (default 5)'),
+        make_option('--cases', type='int', default=20,
+            help='Random cases per size (default 20)'),
+        make_option('--seed', type='int', default=0,
+            help='Random seed (default 0)'),
+    )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.stdout.write("%5s %12s %12s %12s %12s %12s\n" % (
+            'size', 'search(ms)', 'vectors(ms)', 'exhaust.(ms)', 'names(B)', 'vectors(B)'))
+        for size in range(1, options['max_size']+1):
+            cases = [random_case(rng, size) for _ in range(options['cases'])]
+            vector_cases = [vector_case(case) for case in cases]
+            search = timed(economy.get_payments, cases)
+            vectors = timed(economy.vector_payments, vector_cases)
+            if size <= options['max_exhaustive_size']:
+                exhaustive = "%12.3f" % timed(exhaustive_payments, cases)
+            else:
+                exhaustive = "%12s" % '-'
+            # Average size of the arguments of a case, without the shared
+            # resource names
+            names_size = sum(deep_size(case) for case in cases) / len(cases)
+            vectors_size = sum(deep_size(case[1:]) for case in vector_cases) / len(cases)
+            self.stdout.write("%5d %12.3f %12.3f %s %12d %12d\n" % (
+                size, search, vectors, exhaustive, names_size, vectors_size))
@@ -0,0 +1,115 @@
+"""
+Opt-in profiling of the engine hot paths.
+
+Functions decorated with hook() count their calls and cumulative time in
+the Profile active in the current thread, if any (see active()); otherwise
+they only pay a thread local lookup. Payment searches also report their
+size (see search_done()), and code wrapped in dumping() runs under cProfile
+when the active profile has a dump directory, writing one pstats file per
+key (for example, per game and turn).
+"""
+import collections
+import contextlib
+import cProfile
+import functools
+import os
+import threading
+import time
+
+_state = threading.local()
+
+
+class Profile(object):
+    """
+    Totals for a profiling session: calls, cumulative seconds and deepest
+    recursion by hook name, and payment search sizes. Calls to hooks running
+    inside other calls to the same hook are counted, but their time is not
+    added again.
+    """
+
+    def __init__(self, dump_dir=None):
+        self.dump_dir = dump_dir
+        self.calls = collections.Counter()
+        self.time = collections.defaultdict(float)
+        self.running = collections.Counter()
+        self.depth = collections.Counter()
+        self.searches = collections.Counter()
+        self.dumps = []
+
+    def search_done(self, states, branches, depth):
+        self.searches['count'] += 1
+        self.searches['states'] += states
+        self.searches['branches'] += branches
+        self.searches['max_depth'] = max(self.searches['max_depth'], depth)
+
+    def summary(self):
+        """Plain dict with the totals, times in milliseconds"""
+        return {
+            'calls': dict(self.calls),
+            'ms': dict((name, t*1000) for name, t in self.time.items()),
+            'max_depth': dict(self.depth),
+            'searches': dict(self.searches),
+            'dumps': list(self.dumps),
+        }
+
+
+def current():
+    """The Profile active in this thread, or None"""
+    return getattr(_state, 'profile', None)
+
+@contextlib.contextmanager
+def active(profile):
+    """Make profile the active one inside the block"""
+    previous = current()
+    _state.profile = profile
+    try:
+        yield profile
+    finally:
+        _state.profile = previous
+
+def hook(name):
+    """Decorator counting calls and time of a function in the active Profile"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profile = getattr(_state, 'profile', None)
+            if profile is None:
+                return function(*args, **kwargs)
+            profile.calls[name] += 1
+            profile.running[name] += 1
+            profile.depth[name] = max(profile.depth[name], profile.running[name])
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.running[name] -= 1
+                if not profile.running[name]: # Outermost call
+                    profile.time[name] += time.time() - start
+        return wrapper
+    return decorator
+
+def search_done(states, branches, depth):
+    """Report the size of a finished payment search to the active Profile"""
+    profile = getattr(_state, 'profile', None)
+    if profile is not None:
+        profile.search_done(states, branches, depth)
+
+@contextlib.contextmanager
+def dumping(key):
+    """
+    Run the block under cProfile if the active Profile has a dump
+    directory, saving the stats to <dump_dir>/<key>.pstats
+    """
+    profile = current()
+    if profile is None or profile.dump_dir is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path = os.path.join(profile.dump_dir, '%s.pstats' % key)
+        profiler.dump_stats(path)
+        profile.dumps.append(path)
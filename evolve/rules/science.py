@@ -0,0 +1,73 @@
+"""
+Science scoring.
+
+Sciences are numbered, and the sciences an effect provides are a bitmask
+(see EffectRecord.science_mask). An effect with a single science always
+adds to that science; effects with more than one are "wildcards" where the
+player picks the science that gives the best score.
+"""
+import collections
+import itertools
+
+from evolve.rules import constants, profiling
+
+
+def group_value(counts):
+    """Score for a vector of science counts"""
+    return min(counts)*constants.SCIENCE_SCORE_PER_GROUP + sum(amount**2 for amount in counts)
+
+def _upper_bound(counts, extra):
+    """
+    Highest score reachable by adding extra wildcards to counts. The group
+    term can't grow beyond an even split, and the square term is maximized
+    by putting every wildcard on the largest count.
+    """
+    groups = min(min(counts)+extra, (sum(counts)+extra) // len(counts))
+    biggest = max(counts)
+    squares = sum(amount**2 for amount in counts) - biggest**2 + (biggest+extra)**2
+    return groups*constants.SCIENCE_SCORE_PER_GROUP + squares
+
+@profiling.hook('science.science_score')
+def science_score(masks, size):
+    """
+    Best score for a player with effects providing the given science masks,
+    when there are size sciences.
+
+    Works on count vectors: single science effects are added directly, and
+    wildcards with the same mask are placed together as a multiset (order
+    doesn't matter). Partial placements already seen, or that can't beat the
+    best score found, are not explored further.
+    """
+    if not size:
+        return 0
+    counts = [0] * size
+    wildcards = collections.Counter()
+    for mask in masks:
+        bits = [i for i in range(size) if mask & (1 << i)]
+        if len(bits) == 1:
+            counts[bits[0]] += 1
+        elif bits:
+            wildcards[tuple(bits)] += 1
+    groups = sorted(wildcards.items())
+    # Wildcards still to place after each group
+    remaining = [sum(amount for bits, amount in groups[i:]) for i in range(len(groups)+1)]
+
+    best = [group_value(counts)] if not groups else [-1]
+    seen = set()
+
+    def search(i, counts):
+        if i == len(groups):
+            best[0] = max(best[0], group_value(counts))
+            return
+        if (i, counts) in seen or _upper_bound(counts, remaining[i]) <= best[0]:
+            return
+        seen.add((i, counts))
+        bits, amount = groups[i]
+        for placement in itertools.combinations_with_replacement(bits, amount):
+            updated = list(counts)
+            for b in placement:
+                updated[b] += 1
+            search(i+1, tuple(updated))
+
+    search(0, tuple(counts))
+    return best[0]
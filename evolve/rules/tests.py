@@ -1,7 +1,13 @@
+import collections
+import itertools
+import random
+
 import mock
 
+from django.core.cache import cache
 from django.test import TestCase
-from evolve.rules import models
+from evolve.rules import models, economy, catalog, science, profiling
+from evolve.rules.admin import RulesAdmin
 
 class ScoreTest(TestCase):
 
@@ -378,5 +384,367 @@ class BuildOptionTest(TestCase):
         bo = models.BuildOption(players_needed=3, building=b)
         self.assertNotEqual(unicode(bo), '')
 
-# TODO: test economy.py (ResourceSet, PaymentOption, empty_cost, get_payments, can_pay)
+def payment_cost(**amounts):
+    result = collections.defaultdict(lambda: 0)
+    result.update(amounts)
+    return result
+
+def trade_costs(**prices):
+    result = collections.defaultdict(lambda: 2)
+    result.update(prices)
+    return result
+
+def payment_summary(options):
+    return [(o.money, o.left_trade.cost(), o.right_trade.cost()) for o in options]
+
+class GetPaymentsTest(TestCase):
+
+    def test_free(self):
+        options = economy.get_payments(payment_cost(), 0, [], [], trade_costs(), [], trade_costs())
+        self.assertEqual(payment_summary(options), [(0, 0, 0)])
+
+    def test_money_only(self):
+        options = economy.get_payments(payment_cost(**{'$': 2}), 3, [], [], trade_costs(), [], trade_costs())
+        self.assertEqual(payment_summary(options), [(2, 0, 0)])
+
+    def test_not_enough_money(self):
+        options = economy.get_payments(payment_cost(**{'$': 4}), 3, [], [], trade_costs(), [], trade_costs())
+        self.assertEqual(options, [])
+
+    def test_local(self):
+        options = economy.get_payments(payment_cost(Wood=2), 0, [[(1, 'Wood')], [(1, 'Ore'), (1, 'Wood')]], [], trade_costs(), [], trade_costs())
+        self.assertEqual(payment_summary(options), [(0, 0, 0)])
+        self.assertEqual(options[0].local.get('Wood'), (2, 0))
+
+    def test_unpayable(self):
+        options = economy.get_payments(payment_cost(Wood=2), 10, [[(1, 'Wood')]], [[(1, 'Ore')]], trade_costs(), [], trade_costs())
+        self.assertEqual(options, [])
+
+    def test_trade_frontier(self):
+        # 2 Wood can be bought at left ($1 each) or right ($2 each). Mixed
+        # options are not dominated, paying more at both sides is
+        options = economy.get_payments(
+            payment_cost(Wood=2), 10,
+            [],
+            [[(2, 'Wood')]], trade_costs(Wood=1),
+            [[(2, 'Wood')]], trade_costs())
+        self.assertEqual(payment_summary(options), [(0, 2, 0), (0, 1, 2), (0, 0, 4)])
+
+    def test_trade_limited_by_money(self):
+        options = economy.get_payments(
+            payment_cost(Wood=2, **{'$': 1}), 4,
+            [],
+            [[(2, 'Wood')]], trade_costs(),
+            [[(2, 'Wood')]], trade_costs())
+        self.assertEqual(options, [])
+
+    def test_same_as_exhaustive_search(self):
+        rng = random.Random(1234)
+        resources = ['R1', 'R2', 'R3', 'R4']
+        def production():
+            return [[(rng.randint(1, 2), r) for r in rng.sample(resources, rng.randint(1, 2))] for _ in range(rng.randint(0, 3))]
+        for _ in range(300):
+            cost = payment_cost(**{'$': rng.choice([0, 0, 1, 2])})
+            for r in rng.sample(resources, rng.randint(1, 3)):
+                cost[r] = rng.randint(1, 3)
+            left_costs = trade_costs(**dict((r, 1) for r in resources if rng.random() < 0.3))
+            right_costs = trade_costs(**dict((r, 1) for r in resources if rng.random() < 0.3))
+            args = (rng.randint(0, 8), production(), production(), left_costs, production(), right_costs)
+
+            expected = economy.get_payments_base(payment_cost(**cost), *args)
+            expected.sort(key=lambda o: (o.left_trade.cost()+o.right_trade.cost(), o.left_trade.cost()))
+            clean_expected = []
+            for o in expected:
+                if not any(c.better_than(o) for c in clean_expected):
+                    clean_expected.append(o)
+            result = economy.get_payments(cost, *args)
+            self.assertEqual(payment_summary(result), payment_summary(clean_expected))
+
+class ProfilingTest(TestCase):
+
+    def test_inactive(self):
+        self.assertIsNone(profiling.current())
+        options = economy.get_payments(payment_cost(Wood=1), 0, [[(1, 'Wood')]], [], trade_costs(), [], trade_costs())
+        self.assertEqual(payment_summary(options), [(0, 0, 0)])
+
+    def test_hooks(self):
+        profile = profiling.Profile()
+        with profiling.active(profile):
+            self.assertIs(profiling.current(), profile)
+            economy.get_payments(
+                payment_cost(Wood=2), 10,
+                [],
+                [[(2, 'Wood')]], trade_costs(Wood=1),
+                [[(2, 'Wood')]], trade_costs())
+            economy.get_payments_base(payment_cost(Wood=1), 0, [[(1, 'Wood')]], [], trade_costs(), [], trade_costs())
+        self.assertIsNone(profiling.current())
+        self.assertEqual(profile.calls['economy.vector_payments'], 1)
+        self.assertGreater(profile.calls['economy.get_payments_base'], 1)
+        self.assertGreater(profile.depth['economy.get_payments_base'], 1)
+        self.assertEqual(profile.searches['count'], 1)
+        self.assertGreater(profile.searches['branches'], 0)
+        self.assertGreater(profile.searches['max_depth'], 0)
+        self.assertEqual(sorted(profile.summary()['calls']), ['economy.get_payments_base', 'economy.vector_payments'])
+
+class VectorPaymentsTest(TestCase):
+
+    def test_vector(self):
+        names = ('Ore', 'Wood')
+        self.assertEqual(economy.vector(payment_cost(Wood=2, **{'$': 1}), names), (0, 2))
+        self.assertEqual(economy.vector([(1, 'Ore'), (2, 'Wood')], names), (1, 2))
+        self.assertEqual(economy.vector_pairs((0, 2), names), [(2, 'Wood')])
+
+    def test_same_as_get_payments(self):
+        names = ('Ore', 'Stone', 'Wood')
+        options = economy.vector_payments(
+            names, (0, 0, 2), 1, 10,
+            [(1, 0, 0)],
+            [(0, 0, 2)], (2, 2, 1),
+            [(0, 1, 2)], (2, 2, 2))
+        expected = economy.get_payments(
+            payment_cost(Wood=2, **{'$': 1}), 10,
+            [[(1, 'Ore')]],
+            [[(2, 'Wood')]], trade_costs(Wood=1),
+            [[(1, 'Stone'), (2, 'Wood')]], trade_costs())
+        self.assertEqual(payment_summary(options), payment_summary(expected))
+        self.assertEqual(payment_summary(options), [(1, 2, 0), (1, 1, 2), (1, 0, 4)])
+        self.assertEqual(options[0].left_trade.get('Wood'), (2, 2))
+
+def random_vector_case(rng):
+    """Random arguments for vector_payments(), over 4 resources"""
+    def vector():
+        return tuple(rng.choice((0, 0, 1, 2)) for _ in range(4))
+    def production():
+        return [v for v in (vector() for _ in range(rng.randint(0, 3))) if any(v)]
+    def prices():
+        return tuple(rng.choice((1, 2, 2)) for _ in range(4))
+    return (('R1', 'R2', 'R3', 'R4'), vector(), rng.choice((0, 0, 1)), rng.randint(0, 8),
+        production(), production(), prices(), production(), prices())
+
+class IterPaymentsTest(TestCase):
+
+    def test_same_as_vector_payments(self):
+        rng = random.Random(4321)
+        for _ in range(300):
+            args = random_vector_case(rng)
+            expected = economy.vector_payments(*args)
+            self.assertEqual(payment_summary(economy.iter_payments(*args)), payment_summary(expected))
+            self.assertEqual(economy.is_affordable(*args), bool(expected))
+            for left, right in [(0, 0), (1, 0), (0, 2), (2, 2), (1, 3)]:
+                found = economy.find_payment(*args + (left, right))
+                self.assertEqual(found is not None, economy.can_pay(expected, left, right) is not None)
+
+    def test_bounded(self):
+        args = (('Wood',), (2,), 0, 10, [], [(2,)], (1,), [(2,)], (2,))
+        self.assertEqual(payment_summary(economy.iter_payments(*args, max_left=1)), [(0, 1, 2), (0, 0, 4)])
+        self.assertEqual(payment_summary(economy.iter_payments(*args, max_right=0)), [(0, 2, 0)])
+
+    def test_lazy(self):
+        search = economy.PaymentSearch(('Wood',), (2,), 0, 10, [(1,)], [(2,)], (1,), [(2,)], (2,))
+        options = search.iter_options()
+        self.assertEqual(unicode(next(options)), '$1 ($1 left, $0 right)')
+        expanded = search.branches
+        self.assertEqual(len(list(options)), 1) # $2 right
+        self.assertGreater(search.branches, expanded)
+
+class PrecheckTest(TestCase):
+
+    def setUp(self):
+        economy.reset_prechecks()
+
+    def test_free(self):
+        options = economy.precheck(('Ore', 'Wood'), (0, 2), 1, 3, [(0, 1), (1, 1), (0, 1)], [], (2, 2), [], (2, 2))
+        self.assertEqual(payment_summary(options), [(1, 0, 0)])
+        self.assertEqual(options[0].local.get('Wood'), (2, 0))
+        self.assertEqual(economy.prechecks[economy.FREE], 1)
+
+    def test_impossible(self):
+        args = ([(1, 0)], [(0, 1)], (2, 2), [(0, 1)], (1, 3))
+        # Not enough money
+        self.assertEqual(economy.precheck(('Ore', 'Wood'), (1, 0), 4, 3, *args), [])
+        # Not enough Wood even with every alternative
+        self.assertEqual(economy.precheck(('Ore', 'Wood'), (0, 3), 0, 10, *args), [])
+        # Buying 2 Wood costs at least $3
+        self.assertEqual(economy.precheck(('Ore', 'Wood'), (0, 2), 0, 2, *args), [])
+        self.assertEqual(economy.prechecks[economy.IMPOSSIBLE], 3)
+
+    def test_search(self):
+        args = (('Ore', 'Wood'), (0, 2), 0, 3, [(1, 1)], [(0, 1)], (2, 2), [(0, 1)], (1, 3))
+        self.assertIsNone(economy.precheck(*args))
+        self.assertEqual(economy.prechecks, {economy.SEARCH: 1})
+        self.assertEqual(payment_summary(economy.vector_payments(*args)), [(0, 2, 0), (0, 0, 3)])
+
+    def test_same_as_search(self):
+        rng = random.Random(2468)
+        for _ in range(300):
+            args = random_vector_case(rng)
+            options = economy.precheck(*args)
+            if options is not None:
+                self.assertEqual(payment_summary(options), payment_summary(economy.iter_payments(*args)))
+        self.assertTrue(all(economy.prechecks[outcome] for outcome in (economy.IMPOSSIBLE, economy.FREE, economy.SEARCH)))
+
+class CanPayTest(TestCase):
+
+    def test_can_pay(self):
+        options = economy.get_payments(
+            payment_cost(Wood=1), 10,
+            [],
+            [[(1, 'Wood')]], trade_costs(),
+            [[(1, 'Wood')]], trade_costs(Wood=1))
+        self.assertIs(economy.can_pay(options, 0, 1), options[0])
+        self.assertIsNone(economy.can_pay(options, 2, 1))
+
+class CatalogTest(TestCase):
+
+    def setUp(self):
+        self.wood = models.Resource.objects.create(name='Wood', is_basic=True)
+        self.ore = models.Resource.objects.create(name='Ore', is_basic=True)
+        self.gear = models.Science.objects.create(name='Gear')
+        self.tablet = models.Science.objects.create(name='Tablet')
+        self.civ = models.BuildingKind.objects.create(name='civ')
+        self.age_2 = models.Age.objects.create(name='II', order=2, direction='r', victory_score=3)
+        self.age_1 = models.Age.objects.create(name='I', order=1, direction='l', victory_score=1)
+        self.cost = models.Cost.objects.create(money=2)
+        models.CostLine.objects.create(cost=self.cost, amount=2, resource=self.wood)
+        models.CostLine.objects.create(cost=self.cost, amount=1, resource=self.ore)
+        self.effect = models.Effect.objects.create(score=1, score_per_local_building=2, production=self.cost)
+        self.effect.sciences.add(self.gear, self.tablet)
+        self.effect.kinds_scored.add(self.civ)
+        self.building = models.Building.objects.create(name='B', kind=self.civ, effect=self.effect, cost=self.cost)
+        self.city = models.City.objects.create(name='C', resource=self.ore)
+        self.variant = models.Variant.objects.create(label='V')
+        for order in (1, 0):
+            models.CitySpecial.objects.create(city=self.city, variant=self.variant, order=order, cost=self.cost, effect=self.effect)
+        catalog.invalidate()
+        self.catalog = catalog.get()
+
+    def test_cost(self):
+        record = self.catalog.costs[self.cost.pk]
+        self.assertEqual(record.to_dict(), self.cost.to_dict())
+        self.assertEqual(sorted(record.to_list()), sorted(self.cost.to_list()))
+        names = self.catalog.resource_names
+        self.assertEqual(economy.vector_pairs(record.vector, names), sorted(record.to_list(), key=lambda l: names.index(l[1])))
+        self.assertEqual(record.vector, economy.vector(self.cost.to_dict(), names))
+
+    def test_city(self):
+        record = self.catalog.cities[self.city.pk]
+        self.assertEqual(economy.vector_pairs(record.production, self.catalog.resource_names), [(1, 'Ore')])
+
+    def test_effect(self):
+        record = self.catalog.effects[self.effect.pk]
+        self.assertEqual(record.sciences, ('Gear', 'Tablet'))
+        self.assertEqual(record.science_mask, 3)
+        self.assertEqual(record.kinds_scored, ('civ',))
+        self.assertEqual(record.production, self.catalog.costs[self.cost.pk])
+
+    def test_text(self):
+        trade = models.Cost.objects.create(money=1)
+        models.CostLine.objects.create(cost=trade, amount=1, resource=self.wood)
+        other = models.Effect.objects.create(military=2, trade=trade, left_trade=True, kind_payed=self.civ,
+            money_per_neighbor_building=1, score_per_neighbor_defeat=1, free_building=True)
+        empty_effect, free = models.Effect.objects.create(), models.Cost.objects.create()
+        catalog.invalidate()
+        rules = catalog.get()
+        for effect in (self.effect, other, empty_effect):
+            self.assertEqual(unicode(rules.effects[effect.pk]), unicode(effect))
+        for cost in (self.cost, trade, free):
+            self.assertEqual(unicode(rules.costs[cost.pk]), unicode(cost))
+        self.assertEqual(unicode(rules.variants[self.variant.pk]), u'V')
+
+    def test_effect_score_and_money(self):
+        record = self.catalog.effects[self.effect.pk]
+        p1 = mock_player(2, 1, {'civ': 3})
+        p2 = mock_player(1, 1, {'civ': 1})
+        p1.count.side_effect = lambda kind: {'civ': 3}.get(kind, 0)
+        p2.count.side_effect = lambda kind: {'civ': 1}.get(kind, 0)
+        self.assertEqual(record.get_score(p1, p2, p2), 7) # 1 + 2*3
+        self.assertEqual(record.money(p1, p2, p2), 2)
+
+    def test_building(self):
+        record = self.catalog.buildings[self.building.pk]
+        self.assertEqual(record.kind, 'civ')
+        self.assertIs(record.effect, self.catalog.effects[self.effect.pk])
+        self.assertEqual(record.free_having, frozenset())
+        other = models.Building.objects.create(name='A', kind=self.civ, effect=self.effect, cost=self.cost)
+        other.free_having.add(self.building)
+        catalog.invalidate()
+        self.assertEqual(catalog.get().buildings[other.pk].free_having_records(), [catalog.get().buildings[self.building.pk]])
+
+    def test_ages(self):
+        self.assertEqual(self.catalog.first_age().pk, self.age_1.pk)
+        self.assertEqual(self.catalog.next_age(self.age_1.pk).pk, self.age_2.pk)
+        self.assertIsNone(self.catalog.next_age(self.age_2.pk))
+
+    def test_specials(self):
+        specials = self.catalog.specials_for(self.city.pk, self.variant.pk)
+        self.assertEqual([s.order for s in specials], [0, 1])
+        self.assertEqual(self.catalog.next_special(self.city.pk, self.variant.pk, 1).order, 1)
+        self.assertIsNone(self.catalog.next_special(self.city.pk, self.variant.pk, 2))
+        self.assertEqual(len(self.catalog.built_specials(self.city.pk, self.variant.pk, 1)), 1)
+
+    def test_loaded_once(self):
+        self.assertIs(catalog.get(), self.catalog)
+
+    def test_invalidated_by_admin(self):
+        admin = RulesAdmin(models.Resource, None)
+        admin.save_model(None, models.Resource(name='Stone'), None, False)
+        self.assertIsNot(catalog.get(), self.catalog)
+        self.assertIn('Stone', [r.name for r in catalog.get().resources.values()])
+
+    def test_invalidated_by_other_process(self):
+        # Another process changing the rules only replaces the shared stamp
+        models.Resource.objects.create(name='Stone')
+        cache.set(catalog.STAMP_KEY, 'other', catalog.STAMP_TIMEOUT)
+        with mock.patch.object(catalog, 'CHECK_INTERVAL', 3600):
+            self.assertIs(catalog.get(), self.catalog) # Until the next check
+        with mock.patch.object(catalog, 'CHECK_INTERVAL', 0):
+            rules = catalog.get()
+            self.assertIsNot(rules, self.catalog)
+            self.assertIn('Stone', [r.name for r in rules.resources.values()])
+            self.assertIs(catalog.get(), rules)
+
+    def test_stamp_lost(self):
+        cache.clear()
+        with mock.patch.object(catalog, 'CHECK_INTERVAL', 0):
+            rules = catalog.get()
+            self.assertIsNot(rules, self.catalog)
+            self.assertIs(catalog.get(), rules)
+
+def brute_force_science_score(masks, size):
+    """Score trying every science for every effect"""
+    options = [[i for i in range(size) if mask & (1 << i)] for mask in masks]
+    best = 0
+    for choice in itertools.product(*options):
+        counts = [0] * size
+        for i in choice:
+            counts[i] += 1
+        best = max(best, science.group_value(counts))
+    return best
+
+class ScienceScoreTest(TestCase):
+
+    def test_empty(self):
+        self.assertEqual(science.science_score([], 3), 0)
+
+    def test_single_sciences(self):
+        # 1 group (7) + 2^2 + 1 + 1
+        self.assertEqual(science.science_score([1, 1, 2, 4], 3), 13)
+
+    def test_wildcard(self):
+        # The wildcard completes a group: 7 + 1 + 1 + 1
+        self.assertEqual(science.science_score([1, 2, 7], 3), 10)
+        # Without the third science, it's better to stack: 2^2 + 1
+        self.assertEqual(science.science_score([1, 2, 3], 3), 5)
+
+    def test_same_as_brute_force(self):
+        rng = random.Random(4321)
+        for _ in range(300):
+            size = rng.randint(1, 4)
+            masks = [rng.randint(1, 2**size - 1) for _ in range(rng.randint(0, 7))]
+            self.assertEqual(
+                science.science_score(masks, size),
+                brute_force_science_score(masks, size),
+                masks)
+
+# TODO: test economy.py (ResourceSet, PaymentOption, empty_cost)
 # TODO: test forms.py (EffectForm.clean)
@@ -13,6 +13,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3', # Add 'postgresql_psycopg2', 'postgresql', 'mysql', 'sqlite3' or 'oracle'.
         'NAME': 'game.db',                      # Or path to database file if using sqlite3.
+        # A file, so test threads with their own connections share it
+        'TEST_NAME': 'test-game.db',
         'USER': '',                      # Not used with sqlite3.
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
@@ -94,10 +96,12 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'evolve.base.instrumentation.InstrumentationMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'evolve.base.instrumentation.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
 )
@@ -114,6 +118,45 @@ TEMPLATE_DIRS = (
 
 LOGIN_REDIRECT_URL='/game/'
 
+# Broker notifying game changes to waiting clients (see evolve.game.channel).
+# LocalBroker only works with a single process; use CacheBroker with a shared
+# cache when running more
+GAME_CHANNEL_BROKER = 'evolve.game.channel.LocalBroker'
+# Longest time (in seconds) a client waits for a game change in one request
+GAME_CHANNEL_TIMEOUT = 25
+# Runs the end of turn when the last player plays (see evolve.game.resolver).
+# ThreadResolver does it in a pool of GAME_TURN_RESOLVER_WORKERS threads, so
+# the last request doesn't wait for it; ImmediateResolver in the request
+GAME_TURN_RESOLVER = 'evolve.game.resolver.ThreadResolver'
+GAME_TURN_RESOLVER_WORKERS = 2
+# Times a failed end of turn is tried again, the first one after
+# GAME_TURN_RESOLVER_RETRY_DELAY seconds, and twice as long each time after
+GAME_TURN_RESOLVER_RETRIES = 3
+GAME_TURN_RESOLVER_RETRY_DELAY = 1.0
+
+# Views measured by evolve.base.instrumentation, and how many of their last
+# requests are summarized (see /instrumentation.json, for staff users)
+INSTRUMENTED_VIEWS = (
+    'evolve.game.views.game_list',
+    'evolve.game.views.game_play',
+    'evolve.game.views.game_wait',
+    'evolve.game.views.game_watch',
+    'evolve.game.views.game_score',
+    'evolve.game.views.game_ajax_waiting_players',
+    'evolve.game.views.game_ajax_wait_players',
+    'evolve.game.views.game_ajax_scores',
+)
+INSTRUMENTATION_WINDOW = 1000
+# Seconds the first page of the game list is cached for each user (see
+# evolve.game.lobby)
+LOBBY_CACHE_SECONDS = 5
+# Seconds the player views of a turn, and payment searches, are cached for
+# (see evolve.game.models.Game.player_views() and Player.payment_table())
+GAME_CACHE_SECONDS = 60 * 60
+# Directory for the cProfile stats of requests profiled by staff users with
+# ?profile=1 (see evolve.base.instrumentation.ProfilingMiddleware), or None
+PROFILING_DUMP_DIR = None
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -12,6 +12,7 @@ urlpatterns = patterns('',
     url(r'^login/$', 'django.contrib.auth.views.login', name='login'),
     url(r'^logout/$', 'evolve.base.views.logout', name='logout'),
     url(r'^register/$', 'evolve.base.views.register', name='register'),
+    url(r'^instrumentation.json$', 'evolve.base.views.instrumentation_stats', name='instrumentation'),
     url(r'^game/', include('evolve.game.urls')),
 
     url(r'^rules-admin/', include(rules_admin.urls)),